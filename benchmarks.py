@@ -0,0 +1,434 @@
+"""Benchmarks for tagstore.
+
+Run a benchmark by name::
+
+    python benchmarks.py ofs_get --requests 2000 --threads 8
+
+"""
+import json
+import logging
+import os
+import os.path
+import random
+import sys
+from copy import deepcopy
+from argparse import ArgumentParser
+from multiprocessing import Process
+from StringIO import StringIO
+from shutil import rmtree
+from tempfile import mkdtemp
+from threading import Thread
+from time import time
+from urlparse import urlsplit
+from uuid import uuid4
+
+log = logging.getLogger(__name__)
+
+import requests
+from flask import Flask, Blueprint, jsonify, request
+from flask.ext.restless.search import QueryBuilder, SearchParameters
+from ofs.local import PTOFS
+from sqlalchemy import event
+from sqlalchemy.dialects import postgresql
+from werkzeug.serving import make_server
+
+from tagstore import server
+from tagstore.server import OFSEngine, OFSWrapper, ofs
+from tagstore.models import db, Data, Tag, tags
+from tagstore.patch.lockfile import LOCK_BACKENDS
+from tagstore.patch.restless import SERIALIZERS
+from tagstore.tagsets import rewrite_filters
+
+
+API_ENDPOINT = '/api/v1'
+
+
+def _create_bench_app(ptofs_dir, **config):
+    app = Flask(__name__)
+    app.config.from_object('tagstore.settings.default')
+    app.config.from_object('tagstore.settings.test')
+    app.config['PTOFS_DIR'] = ptofs_dir
+    app.config.update(config)
+    server.init_app(app)
+    with app.app_context():
+        db.create_all()
+    return app
+
+
+def _report(name, count, elapsed):
+    print '{0:>24}: {1:8d} in {2:8.3f}s {3:10.1f}/s'.format(
+        name, count, elapsed, count / elapsed)
+
+
+def _run_threads(nthreads, target, *args):
+    threads = [Thread(target=target, args=args) for iii in range(nthreads)]
+    start = time()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return time() - start
+
+
+class PerRequestOFSEngine(OFSEngine):
+    """Rebuild the OFSWrapper on every use, as was done per request."""
+    def get(self):
+        return OFSWrapper(**self.kwargs)
+
+
+def bench_ofs_get(args):
+    """GET /api/v1/ofs/<label> with a shared vs per-request OFS engine."""
+    tmpdir = mkdtemp()
+    try:
+        app = _create_bench_app(os.path.join(tmpdir, 'tagstore-bench'))
+        client = app.test_client()
+        resp = client.post('{0}/ofs'.format(API_ENDPOINT),
+                           data={'blob': (StringIO('x' * args.size), 'bench')},
+                           content_type='multipart/form-data')
+        path = urlsplit(json.loads(resp.data)['uri']).path
+        per_thread = args.requests // args.threads
+
+        def get_many():
+            client = app.test_client()
+            for iii in range(per_thread):
+                resp = client.get(path)
+                assert resp.status_code == 200
+                resp.close()
+
+        shared = app.extensions['tagstore_ofs']
+        engines = [
+            ('per-request', PerRequestOFSEngine(**shared.kwargs)),
+            ('shared', shared),
+        ]
+        for name, engine in engines:
+            app.extensions['tagstore_ofs'] = engine
+            elapsed = _run_threads(args.threads, get_many)
+            _report(name, per_thread * args.threads, elapsed)
+    finally:
+        rmtree(tmpdir)
+
+
+def _run_processes(nprocs, target, *args):
+    procs = [Process(target=target, args=(iii, ) + args)
+             for iii in range(nprocs)]
+    start = time()
+    for proc in procs:
+        proc.start()
+    for proc in procs:
+        proc.join()
+    return time() - start
+
+
+def bench_lock_contention(args):
+    """Concurrent PersistentState edits by processes for each lock backend.
+
+    Modelled on tests.TestViews.test_ofs_processsafe, each process repeatedly
+    reads the persisted state, updates its own key and syncs it while holding
+    the PTOFS lock.
+
+    """
+    bucket = 'testbucket'
+
+    def edit(iii, ofs_dir, lock_class):
+        wrapper = OFSWrapper(storage_dir=ofs_dir, lock_class=lock_class)
+        for jjj in range(args.iterations):
+            wrapper.locks.ptofs.acquire()
+            try:
+                _, json_payload = wrapper.ofs._get_object(bucket)
+                json_payload.update({str(iii): jjj})
+                json_payload.sync()
+            finally:
+                wrapper.locks.ptofs.release()
+
+    for name, lock_class in sorted(LOCK_BACKENDS.items()):
+        tmpdir = mkdtemp()
+        try:
+            ofs_dir = os.path.join(tmpdir, 'tagstore-bench')
+            wrapper = OFSWrapper(storage_dir=ofs_dir, lock_class=lock_class)
+            elapsed = _run_processes(
+                args.processes, edit, ofs_dir, lock_class)
+            _, json_payload = wrapper.ofs._get_object(bucket)
+            expected = dict((str(iii), args.iterations - 1)
+                            for iii in range(args.processes))
+            assert json_payload == expected, json_payload
+            del json_payload
+            _report(name, args.processes * args.iterations, elapsed)
+        finally:
+            rmtree(tmpdir)
+
+
+def bench_ofs_read(args):
+    """get_metadata throughput from 1..processes concurrent processes."""
+    tmpdir = mkdtemp()
+    try:
+        ofs_dir = os.path.join(tmpdir, 'tagstore-bench')
+        wrapper = OFSWrapper(storage_dir=ofs_dir)
+        wrapper.call('put_stream', 'bench', StringIO('x' * args.size))
+
+        def read(iii):
+            wrapper = OFSWrapper(storage_dir=ofs_dir)
+            for jjj in range(args.iterations):
+                wrapper.call('get_metadata', 'bench')
+
+        for nprocs in range(1, args.processes + 1):
+            elapsed = _run_processes(nprocs, read)
+            _report('{0} processes'.format(nprocs),
+                    nprocs * args.iterations, elapsed)
+    finally:
+        rmtree(tmpdir)
+
+
+legacy_blueprint = Blueprint('legacy', __name__)
+
+
+@legacy_blueprint.route('/legacy/ofs', methods=['POST'])
+def legacy_ofs_create():
+    """Upload as done before streaming: spooled by Werkzeug, then copied
+    and rehashed by stock PTOFS."""
+    fobj = request.files['blob']
+    label = str(uuid4())
+    ofs.locks.ptofs.acquire()
+    try:
+        PTOFS.put_stream(ofs.ofs, ofs.bucket_id, label, fobj,
+                         {'fname': fobj.filename})
+    finally:
+        ofs.locks.ptofs.release()
+    return jsonify(dict(label=label))
+
+
+class _MultipartFile(object):
+    """File-like multipart/form-data body for a file on disk.
+
+    requests would otherwise read the whole file into memory to encode it.
+
+    """
+    def __init__(self, path, boundary):
+        self.boundary = boundary
+        head = ('--{0}\r\nContent-Disposition: form-data; name="blob"; '
+                'filename="{1}"\r\nContent-Type: application/octet-stream'
+                '\r\n\r\n').format(boundary, os.path.basename(path))
+        tail = '\r\n--{0}--\r\n'.format(boundary)
+        self._parts = [StringIO(head), open(path, 'rb'), StringIO(tail)]
+        self._len = len(head) + os.path.getsize(path) + len(tail)
+
+    def __len__(self):
+        return self._len
+
+    def read(self, size=-1):
+        chunks = []
+        while self._parts and (size < 0 or size > 0):
+            chunk = self._parts[0].read(size)
+            if not chunk:
+                self._parts.pop(0).close()
+                continue
+            chunks.append(chunk)
+            if size > 0:
+                size -= len(chunk)
+        return ''.join(chunks)
+
+
+def bench_ofs_upload(args):
+    """Upload throughput in MB/s of --upload-mb sized blobs over HTTP."""
+    tmpdir = mkdtemp()
+    try:
+        app = _create_bench_app(os.path.join(tmpdir, 'tagstore-bench'))
+        app.register_blueprint(legacy_blueprint)
+        blob_path = os.path.join(tmpdir, 'blob')
+        with open(blob_path, 'wb') as fff:
+            chunk = os.urandom(2 ** 20)
+            for iii in range(args.upload_mb):
+                fff.write(chunk)
+
+        server = make_server('127.0.0.1', 0, app, threaded=True)
+        thread = Thread(target=server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        base = 'http://127.0.0.1:{0}'.format(server.server_port)
+
+        def multipart(url):
+            boundary = uuid4().hex
+            body = _MultipartFile(blob_path, boundary)
+            return requests.post(url, data=body, headers={
+                'Content-Type':
+                    'multipart/form-data; boundary={0}'.format(boundary)})
+
+        def raw(url):
+            with open(blob_path, 'rb') as body:
+                return requests.post(
+                    url + '?fname=blob', data=body,
+                    headers={'Content-Type': 'application/octet-stream'})
+
+        runs = [
+            ('legacy multipart MB', multipart,
+             '{0}/legacy/ofs'.format(base)),
+            ('streamed multipart MB', multipart,
+             '{0}{1}/ofs'.format(base, API_ENDPOINT)),
+            ('streamed raw MB', raw, '{0}{1}/ofs'.format(base, API_ENDPOINT)),
+        ]
+        for name, upload, url in runs:
+            start = time()
+            resp = upload(url)
+            elapsed = time() - start
+            assert resp.status_code == 200, resp.status_code
+            _report(name, args.upload_mb, elapsed)
+        server.shutdown()
+    finally:
+        rmtree(tmpdir)
+
+
+def _any_tag(op, value, negated=False):
+    return dict(name='tags', op='not_any' if negated else 'any',
+                val=dict(name='tag', op=op, val=value))
+
+
+def _populate_tags(ndata, ntags, per_data):
+    """ndata Data with per_data random tags each of ntags key:value tags."""
+    rand = random.Random(0)
+    db.session.execute(Tag.__table__.insert(), [
+        dict(tag=u'k{0}:{1}'.format(iii % 10, iii), key=u'k{0}'.format(iii % 10),
+             value=unicode(iii)) for iii in range(ntags)])
+    db.session.execute(Data.__table__.insert(), [
+        dict(uri=u'bench{0}'.format(iii)) for iii in range(ndata)])
+    tag_ids = [tag_id for tag_id, in db.session.query(Tag.id)]
+    data_ids = [data_id for data_id, in db.session.query(Data.id)]
+    db.session.execute(tags.insert(), [
+        dict(data_id=data_id, tag_id=tag_id) for data_id in data_ids
+        for tag_id in rand.sample(tag_ids, per_data)])
+    db.session.commit()
+
+
+def bench_tag_filters(args):
+    """Restless tag filters as per-row EXISTS vs set operations on tags.
+
+    Runs on SQLite by default or any database given by --database-uri, e.g. a
+    PostgreSQL one. --show-sql prints both plans as PostgreSQL SQL.
+
+    """
+    tmpdir = mkdtemp()
+    try:
+        app = _create_bench_app(os.path.join(tmpdir, 'tagstore-bench'),
+                                SQLALCHEMY_DATABASE_URI=args.database_uri)
+        with app.app_context():
+            _populate_tags(args.data, args.tags, args.tags_per_data)
+            ntags = args.tags
+            queries = [
+                ('all of 2', [_any_tag('eq', u'k1:1'),
+                              _any_tag('eq', u'k2:2')]),
+                ('all of 3 none of 1', [_any_tag('eq', u'k1:1'),
+                                        _any_tag('eq', u'k2:2'),
+                                        _any_tag('eq', u'k3:3'),
+                                        _any_tag('eq', u'k4:4', True)]),
+                ('prefix none of 2', [
+                    _any_tag('startswith', u'k5:'),
+                    _any_tag('in', [u'k6:6', u'k7:7'], True),
+                    _any_tag('eq', u'k8:{0}'.format(ntags - 2), True)]),
+                ('none of 2', [_any_tag('eq', u'k1:1', True),
+                               _any_tag('eq', u'k2:2', True)]),
+            ]
+            for name, filters in queries:
+                exists = dict(filters=filters)
+                sets = deepcopy(exists)
+                rewrite_filters(sets)
+                results = []
+                for plan, params in [('exists', exists), ('sets', sets)]:
+                    query = QueryBuilder.create_query(
+                        db.session, Data,
+                        SearchParameters.from_dictionary(params)
+                    ).with_entities(Data.id)
+                    if args.show_sql:
+                        print '-- {0} {1}'.format(name, plan)
+                        print query.statement.compile(
+                            dialect=postgresql.dialect())
+                    start = time()
+                    for iii in range(args.iterations):
+                        ids = sorted(data_id for data_id, in query)
+                    _report('{0} {1}'.format(name, plan), args.iterations,
+                            time() - start)
+                    results.append(ids)
+                assert results[0] == results[1], name
+    finally:
+        rmtree(tmpdir)
+
+
+def bench_data_listing(args):
+    """Pages of GET /api/v1/data serialized by restless vs from rows.
+
+    Reports the SQL statements run per page as well as the pages per second.
+
+    """
+    tmpdir = mkdtemp()
+    try:
+        app = _create_bench_app(os.path.join(tmpdir, 'tagstore-bench'),
+                                SQLALCHEMY_DATABASE_URI=args.database_uri)
+        with app.app_context():
+            _populate_tags(args.data, args.tags, args.tags_per_data)
+            statements = []
+            event.listen(db.engine, 'before_cursor_execute',
+                         lambda *args: statements.append(1))
+        client = app.test_client()
+        per_page = app.config['MAX_RESULTS_PER_PAGE_DATA']
+        npages = min(args.iterations, args.data // per_page)
+        serializer = SERIALIZERS.pop(Data)
+        try:
+            pages = []
+            for name in ('restless', 'rows'):
+                if name == 'rows':
+                    SERIALIZERS[Data] = serializer
+                del statements[:]
+                start = time()
+                for page in range(1, npages + 1):
+                    resp = client.get(
+                        '{0}/data'.format(API_ENDPOINT), query_string=dict(
+                            page=page, results_per_page=per_page))
+                    assert resp.status_code == 200, resp.status_code
+                    pages.append(json.loads(resp.data)['objects'])
+                _report('{0} pages'.format(name), npages, time() - start)
+                print '{0:>24}: {1:8.1f}'.format(
+                    '{0} queries/page'.format(name),
+                    float(len(statements)) / npages)
+            for objects in pages:
+                for datum in objects:
+                    datum['tags'].sort(key=lambda tag: tag['id'])
+            assert pages[:npages] == pages[npages:]
+        finally:
+            SERIALIZERS[Data] = serializer
+    finally:
+        rmtree(tmpdir)
+
+
+BENCHMARKS = {
+    'ofs_get': bench_ofs_get,
+    'lock_contention': bench_lock_contention,
+    'ofs_read': bench_ofs_read,
+    'ofs_upload': bench_ofs_upload,
+    'tag_filters': bench_tag_filters,
+    'data_listing': bench_data_listing,
+}
+
+
+def main(argv=None):
+    parser = ArgumentParser(description='Run tagstore benchmarks.')
+    parser.add_argument('benchmark', choices=sorted(BENCHMARKS.keys()))
+    parser.add_argument('--requests', type=int, default=1000)
+    parser.add_argument('--threads', type=int, default=4)
+    parser.add_argument('--processes', type=int, default=4)
+    parser.add_argument('--iterations', type=int, default=20)
+    parser.add_argument('--size', type=int, default=1024,
+                        help='Size in bytes of stored blobs')
+    parser.add_argument('--upload-mb', type=int, default=1024,
+                        help='Size in MB of uploaded blobs')
+    parser.add_argument('--database-uri', default='sqlite://',
+                        help='Database of the tag benchmarks')
+    parser.add_argument('--data', type=int, default=20000,
+                        help='Number of Data of the tag benchmarks')
+    parser.add_argument('--tags', type=int, default=500,
+                        help='Number of tags of the tag benchmarks')
+    parser.add_argument('--tags-per-data', type=int, default=10)
+    parser.add_argument('--show-sql', action='store_true',
+                        help='Print the SQL of the tag benchmarks')
+    args = parser.parse_args(argv)
+    BENCHMARKS[args.benchmark](args)
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
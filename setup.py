@@ -37,4 +37,17 @@ setup(
     packages=find_packages(),
     test_suite='tests',
     install_requires=requires,
+    entry_points={
+        'console_scripts': [
+            'tagstore-migrate-ofs = tagstore.migrate:main_ofs_metadata',
+            'tagstore-migrate-tag-keys = tagstore.migrate:main_tag_keys',
+            'tagstore-migrate-tag-changes = tagstore.migrate:main_tag_changes',
+            'tagstore-migrate-tag-generations = '
+            'tagstore.migrate:main_tag_generations',
+            'tagstore-gc = tagstore.ofsgc:main',
+            'tagstore-scrub = tagstore.scrub:main',
+            'tagstore-rebalance-ofs = tagstore.shard:main',
+            'tagstore-tagindex = tagstore.tagindex:main',
+        ],
+    },
 )
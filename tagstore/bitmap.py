@@ -0,0 +1,278 @@
+"""Compressed bitmaps of non-negative integers.
+
+The integers are split by their high bits into chunks of 2**16. A chunk with
+few integers is a sorted array of their low 16 bits and a fuller one is a
+bitset held in a Python int, as in Roaring bitmaps. Sparse and dense sets
+both stay small and set operations on dense chunks run at C speed.
+
+"""
+from array import array
+from binascii import hexlify, unhexlify
+
+
+CHUNK_BITS = 16
+CHUNK_MASK = (1 << CHUNK_BITS) - 1
+# Chunks with more integers than this are bitsets. Above it a bitset (8KiB)
+# is smaller than the array.
+ARRAY_MAX = 4096
+
+# Positions of the set bits of each byte value
+_BYTE_BITS = [tuple(bit for bit in range(8) if value & (1 << bit))
+              for value in range(256)]
+
+
+def _array_to_bits(values):
+    buf = bytearray(1 << (CHUNK_BITS - 3))
+    for value in values:
+        buf[value >> 3] |= 1 << (value & 7)
+    buf.reverse()
+    return int(hexlify(buf), 16)
+
+
+def _bits_to_values(bits):
+    """Yield the positions of the set bits of bits in ascending order."""
+    digits = '{0:x}'.format(bits)
+    if len(digits) % 2:
+        digits = '0' + digits
+    buf = bytearray(unhexlify(digits))
+    buf.reverse()
+    for offset, value in enumerate(buf):
+        if value:
+            base = offset << 3
+            for bit in _BYTE_BITS[value]:
+                yield base + bit
+
+
+def _popcount(container):
+    if isinstance(container, array):
+        return len(container)
+    return bin(container).count('1')
+
+
+def _normalize(bits):
+    """The smallest container for the bitset bits, or None if empty."""
+    if not bits:
+        return None
+    if _popcount(bits) > ARRAY_MAX:
+        return bits
+    return array('H', _bits_to_values(bits))
+
+
+def _as_bits(container):
+    if isinstance(container, array):
+        return _array_to_bits(container)
+    return container
+
+
+def _sorted_array(values):
+    return array('H', sorted(values))
+
+
+class Bitmap(object):
+    """Set of non-negative integers.
+
+    Bitmaps combine with &, | and - into new bitmaps that may share
+    containers with their operands, so containers are never changed in
+    place.
+
+    """
+    __slots__ = ('_chunks', )
+
+    def __init__(self, values=()):
+        # high bits -> array of low bits or int bitset
+        self._chunks = {}
+        grouped = {}
+        for value in values:
+            grouped.setdefault(value >> CHUNK_BITS, set()).add(
+                value & CHUNK_MASK)
+        for high, lows in grouped.items():
+            if len(lows) > ARRAY_MAX:
+                self._chunks[high] = _array_to_bits(lows)
+            else:
+                self._chunks[high] = _sorted_array(lows)
+
+    @classmethod
+    def _from_chunks(cls, chunks):
+        bitmap = cls()
+        bitmap._chunks = chunks
+        return bitmap
+
+    def copy(self):
+        return self._from_chunks(dict(self._chunks))
+
+    def __contains__(self, value):
+        container = self._chunks.get(value >> CHUNK_BITS)
+        if container is None:
+            return False
+        low = value & CHUNK_MASK
+        if isinstance(container, array):
+            return low in container
+        return bool((container >> low) & 1)
+
+    def add(self, value):
+        high, low = value >> CHUNK_BITS, value & CHUNK_MASK
+        container = self._chunks.get(high)
+        if container is None:
+            self._chunks[high] = array('H', [low])
+        elif isinstance(container, array):
+            if low not in container:
+                lows = set(container)
+                lows.add(low)
+                if len(lows) > ARRAY_MAX:
+                    self._chunks[high] = _array_to_bits(lows)
+                else:
+                    self._chunks[high] = _sorted_array(lows)
+        else:
+            self._chunks[high] = container | (1 << low)
+
+    def discard(self, value):
+        high, low = value >> CHUNK_BITS, value & CHUNK_MASK
+        container = self._chunks.get(high)
+        if container is None:
+            return
+        if isinstance(container, array):
+            if low in container:
+                lows = set(container)
+                lows.discard(low)
+                if lows:
+                    self._chunks[high] = _sorted_array(lows)
+                else:
+                    del self._chunks[high]
+        else:
+            container = _normalize(container & ~(1 << low))
+            if container is None:
+                del self._chunks[high]
+            else:
+                self._chunks[high] = container
+
+    def __and__(self, other):
+        chunks = {}
+        for high, container in self._chunks.items():
+            ocontainer = other._chunks.get(high)
+            if ocontainer is None:
+                continue
+            if isinstance(container, array) and \
+                    isinstance(ocontainer, array):
+                lows = set(container).intersection(ocontainer)
+                result = _sorted_array(lows) if lows else None
+            else:
+                result = _normalize(
+                    _as_bits(container) & _as_bits(ocontainer))
+            if result is not None:
+                chunks[high] = result
+        return self._from_chunks(chunks)
+
+    def __or__(self, other):
+        chunks = dict(self._chunks)
+        for high, ocontainer in other._chunks.items():
+            container = chunks.get(high)
+            if container is None:
+                chunks[high] = ocontainer
+            elif isinstance(container, array) and \
+                    isinstance(ocontainer, array) and \
+                    len(container) + len(ocontainer) <= ARRAY_MAX:
+                chunks[high] = _sorted_array(
+                    set(container).union(ocontainer))
+            else:
+                chunks[high] = _normalize(
+                    _as_bits(container) | _as_bits(ocontainer))
+        return self._from_chunks(chunks)
+
+    def __sub__(self, other):
+        chunks = {}
+        for high, container in self._chunks.items():
+            ocontainer = other._chunks.get(high)
+            if ocontainer is None:
+                chunks[high] = container
+                continue
+            if isinstance(container, array) and \
+                    isinstance(ocontainer, array):
+                lows = set(container).difference(ocontainer)
+                result = _sorted_array(lows) if lows else None
+            else:
+                result = _normalize(
+                    _as_bits(container) & ~_as_bits(ocontainer))
+            if result is not None:
+                chunks[high] = result
+        return self._from_chunks(chunks)
+
+    @classmethod
+    def union(cls, bitmaps):
+        result = cls()
+        for bitmap in bitmaps:
+            result = result | bitmap
+        return result
+
+    def __len__(self):
+        return sum(_popcount(container)
+                   for container in self._chunks.values())
+
+    def __nonzero__(self):
+        return bool(self._chunks)
+
+    def __iter__(self):
+        for high in sorted(self._chunks):
+            container = self._chunks[high]
+            base = high << CHUNK_BITS
+            if isinstance(container, array):
+                lows = container
+            else:
+                lows = _bits_to_values(container)
+            for low in lows:
+                yield base + low
+
+    def slice(self, start, stop):
+        """The integers from the start-th to before the stop-th, ascending.
+
+        Whole chunks before start are skipped by their counts.
+
+        """
+        values = []
+        skip = start
+        for high in sorted(self._chunks):
+            if len(values) >= stop - start:
+                break
+            container = self._chunks[high]
+            count = _popcount(container)
+            if skip >= count:
+                skip -= count
+                continue
+            base = high << CHUNK_BITS
+            if isinstance(container, array):
+                lows = container
+            else:
+                lows = _bits_to_values(container)
+            for low in lows:
+                if skip:
+                    skip -= 1
+                    continue
+                values.append(base + low)
+                if len(values) >= stop - start:
+                    break
+        return values
+
+    def __eq__(self, other):
+        return isinstance(other, Bitmap) and list(self) == list(other)
+
+    def __ne__(self, other):
+        return not self == other
+
+    def dump(self):
+        """Marshallable representation, see load()."""
+        return [(high, container.tostring()
+                 if isinstance(container, array) else container)
+                for high, container in self._chunks.items()]
+
+    @classmethod
+    def load(cls, dumped):
+        chunks = {}
+        for high, container in dumped:
+            if isinstance(container, str):
+                lows = array('H')
+                lows.fromstring(container)
+                container = lows
+            chunks[high] = container
+        return cls._from_chunks(chunks)
+
+    def __repr__(self):
+        return '<Bitmap of {0}>'.format(len(self))
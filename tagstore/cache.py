@@ -0,0 +1,80 @@
+"""Small in-process caches."""
+from collections import OrderedDict
+from threading import Lock
+from time import time
+
+
+class LRUCache(object):
+    """Thread-safe mapping bounded to maxsize entries with optional expiry.
+
+    The least recently used entry is evicted when full. Entries older than ttl
+    seconds are treated as missing. Lookups are counted as hits and misses.
+
+    """
+    def __init__(self, maxsize=1024, ttl=None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()
+        self._lock = Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            try:
+                value, stored = self._data.pop(key)
+            except KeyError:
+                self.misses += 1
+                return default
+            if self.ttl is not None and time() - stored > self.ttl:
+                self.misses += 1
+                return default
+            self._data[key] = (value, stored)
+            self.hits += 1
+            return value
+
+    def set(self, key, value):
+        with self._lock:
+            self._data.pop(key, None)
+            self._data[key] = (value, time())
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def pop(self, key, default=None):
+        with self._lock:
+            try:
+                return self._data.pop(key)[0]
+            except KeyError:
+                return default
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self):
+        return len(self._data)
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        hit_rate = None
+        if lookups:
+            hit_rate = float(self.hits) / lookups
+        return dict(hits=self.hits, misses=self.misses, size=len(self),
+                    maxsize=self.maxsize, hit_rate=hit_rate)
+
+
+class GenerationalLRUCache(LRUCache):
+    """LRUCache that is cleared whenever it is told of a new generation of
+    what it caches, e.g. one kept beside the cached values in a store shared
+    by several processes.
+
+    """
+    def __init__(self, maxsize=1024, ttl=None):
+        super(GenerationalLRUCache, self).__init__(maxsize, ttl)
+        self.generation = None
+
+    def check_generation(self, generation):
+        with self._lock:
+            if generation != self.generation:
+                self._data.clear()
+                self.generation = generation
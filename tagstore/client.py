@@ -1,5 +1,11 @@
+import os
 import os.path
 from copy import copy
+from itertools import islice
+from hashlib import sha256
+from io import UnsupportedOperation
+from threading import Lock
+from multiprocessing.pool import ThreadPool
 from urlparse import urlunsplit, urlsplit
 from uuid import uuid4
 import logging
@@ -25,7 +31,10 @@ class DataResponse(object):
         return self.fname
 
     def open(self):
-        return requests.get(self.uri, stream=True).raw
+        raw = requests.get(self.uri, stream=True).raw
+        # Blobs stored compressed may be sent gzip encoded
+        raw.decode_content = True
+        return raw
 
     def __repr__(self):
         return '<DataResponse({0}, {1}, {2}, {3})>'.format(
@@ -48,7 +57,30 @@ def ensure_response_status(response, *statuses):
         response.request.method, response.request.url, response.status_code)
 
 
+class UploadIncomplete(IOError):
+    """Chunks of an upload could not be sent.
+
+    Pass session to TagStoreClient.upload() to resume.
+
+    """
+    def __init__(self, session, missing):
+        IOError.__init__(self, u'Upload {0} is missing chunks {1}'.format(
+            session, missing))
+        self.session = session
+        self.missing = missing
+
+
 class QueryResponse(object):
+    """Results of a query, fetched a page at a time as they are used.
+
+    Pages after the first are fetched by the next token of the previous page
+    when the server gives one, so that walking all the results costs the
+    server the same for every page, and by page number otherwise.
+
+    Pages are fetched without counting the results. The count is only asked
+    for when len() is taken before the last page.
+
+    """
     def __init__(self, client, endpoint, wrapper, params, preload=False):
         self.client = client
         self.endpoint = endpoint
@@ -58,43 +90,80 @@ class QueryResponse(object):
         self.objects = []
         self.iii = 0
         self.page = 1
+        # Unknown until counted
+        self.num_results = None
+        self.num_pages = None
+        # Whether results follow the last page fetched and the token of the
+        # page after it
+        self.more = False
+        self.after = None
+        self.by_cursor = False
 
         self.get_page()
         if preload:
-            while self.page < self.num_pages:
-                self.page += 1
+            while self.more:
                 # Some large number because fewer pages is better here
-                self.get_page(self.page, self.client.preload_page_num_results)
+                self._next_page(self.client.preload_page_num_results)
 
     @classmethod
     def query(cls, endpoint, client, params):
         return requests.get(client._api_endpoint(endpoint), params=params,
                             headers=client.headers_json)
 
-    def get_page(self, page=None, results_per_page=None):
-        params = copy(self.params)
-        if page is not None:
-            if page > self.num_pages:
-                raise IndexError()
-            params['page'] = page
+    def _fetch(self, params, results_per_page=None):
         if results_per_page is None:
             results_per_page = self.client.results_per_page
         params['results_per_page'] = results_per_page
+        params['count'] = 'false'
 
         response = self.query(self.endpoint, self.client, params)
         ensure_response_status(response, 200)
 
         json = response.json()
         self.objects += [self.wrapper(self.client, obj) for obj in json['objects']]
-        self.num_pages = json['total_pages']
-        self.num_results = json['num_results']
+        self.after = json.get('next')
+        if self.after is not None:
+            self.by_cursor = True
+        try:
+            self.more = json['more']
+        except KeyError:
+            self.more = json['page'] < json['total_pages']
+        return json
+
+    def get_page(self, page=None, results_per_page=None):
+        params = copy(self.params)
+        if page is not None:
+            if self.num_pages is not None and page > self.num_pages:
+                raise IndexError()
+            params['page'] = page
+        json = self._fetch(params, results_per_page)
+        if 'num_results' in json:
+            self.num_pages = json['total_pages']
+            self.num_results = json['num_results']
+
+    def _next_page(self, results_per_page=None):
+        self.page += 1
+        if self.after is None:
+            self.get_page(self.page, results_per_page)
+            return
+        params = copy(self.params)
+        params['after'] = self.after
+        self._fetch(params, results_per_page)
+
+    def count(self):
+        """Ask the server for the number of results."""
+        response = self.query('{0}/count'.format(self.endpoint), self.client,
+                              copy(self.params))
+        ensure_response_status(response, 200)
+        return response.json()['num_results']
 
     def __getitem__(self, value):
         try:
             return self.objects[value]
         except IndexError:
-            self.page += 1
-            self.get_page(self.page)
+            if not self.more:
+                raise
+            self._next_page()
             return self[value]
 
     def __iter__(self):
@@ -102,25 +171,32 @@ class QueryResponse(object):
 
     def next(self):
         if self.iii >= len(self.objects):
-            if self.page >= self.num_pages:
+            if not self.more:
                 raise StopIteration
             else:
-                self.page += 1
-                self.get_page(self.page)
+                self._next_page()
         self.iii += 1
         # If you get an error here, you might be editing the results of the
         # query while using the results.
         return self.objects[self.iii - 1]
 
     def __len__(self):
+        if self.num_results is None:
+            if self.more:
+                self.num_results = self.count()
+            else:
+                self.num_results = len(self.objects)
         return self.num_results
 
     def __repr__(self):
-        return '<QueryResponse({0}, {1})>'.format(self.endpoint, len(self))
+        return '<QueryResponse({0}, {1})>'.format(
+            self.endpoint, '?' if self.num_results is None else self.num_results)
 
 
 class TagStoreClient(object):
     headers_json = {'Content-Type': 'application/json'}
+    # Filter operators whose value is a filter on related objects
+    relation_ops = ('any', 'has', 'not_any')
 
     def __init__(self, endpoint, results_per_page=500,
                  preload_page_num_results=1000):
@@ -128,6 +204,8 @@ class TagStoreClient(object):
 
         self.preload_page_num_results = preload_page_num_results
         self.results_per_page = results_per_page
+        # Whether the OFS links known contents, asked on first upload
+        self._dedup = None
 
     def _api_endpoint(self, *segments):
         return '/'.join([self.endpoint] + map(unicode, segments))
@@ -141,8 +219,15 @@ class TagStoreClient(object):
         """JSON representation of a Datum."""
         return dict(uri=uri, fname=fname, tags=map(self._wrap_tag, tags))
 
-    def create(self, uri_or_fobj, fname=None, tags=[]):
-        """Create a Datum."""
+    def create(self, uri_or_fobj, fname=None, tags=[], on_conflict=None):
+        """Create a Datum.
+
+        If its URI is already present, None is returned unless on_conflict
+        is 'ignore', 'merge' or 'replace', in which case the server leaves
+        the Datum, adds the tags and fname to it or replaces them, and the
+        Datum is returned.
+
+        """
         if not isinstance(uri_or_fobj, basestring):
             # Store the file first.
             fobj = uri_or_fobj
@@ -151,11 +236,13 @@ class TagStoreClient(object):
                     fname = fobj.name
                 except AttributeError:
                     fname = 'blob'
-            files = {'blob': (fname, fobj)}
-            resp = requests.post(self._api_endpoint('ofs'), files=files)
-            ensure_response_status(resp, 200, 201)
-            data = resp.json()
-            uri = data['uri']
+            uri = self._link_stored(fobj, fname)
+            if uri is None:
+                files = {'blob': (fname, fobj)}
+                resp = requests.post(self._api_endpoint('ofs'), files=files)
+                ensure_response_status(resp, 200, 201)
+                data = resp.json()
+                uri = data['uri']
         else:
             uri = uri_or_fobj
             if fname is None:
@@ -164,13 +251,161 @@ class TagStoreClient(object):
                     fname = 'blob'
 
         data = json.dumps(self._data(uri, fname, tags))
-        response = requests.post(self._api_endpoint('data'),
+        params = {}
+        if on_conflict is not None:
+            params['on_conflict'] = on_conflict
+        response = requests.post(self._api_endpoint('data'), params=params,
                                  data=data, headers=self.headers_json)
-        ensure_response_status(response, 201, 409)
-        if response.status_code == 201:
-            return DataResponse(self, response.json())
-        else:
+        ensure_response_status(response, 200, 201, 409)
+        if response.status_code == 409:
             return None
+        return DataResponse(self, response.json())
+
+    def create_many(self, records, chunk_size=1000):
+        """Create Data from an iterable of (uri, fname, tags), chunk_size at
+        a time by POST /data/bulk.
+
+        records is read lazily, so it may be a generator over an archive too
+        large to list. Unlike create(), records only give URIs.
+
+        Returns the ids of the new Data in order, None for those whose URI
+        was already present.
+
+        """
+        ids = []
+        records = iter(records)
+        while True:
+            chunk = []
+            for uri, fname, tags in islice(records, chunk_size):
+                if fname is None:
+                    fname = os.path.basename(uri) or 'blob'
+                chunk.append(self._data(uri, fname, tags))
+            if not chunk:
+                return ids
+            response = requests.post(
+                self._api_endpoint('data', 'bulk'),
+                data=json.dumps(dict(objects=chunk)),
+                headers=self.headers_json)
+            ensure_response_status(response, 201)
+            ids.extend(response.json()['ids'])
+
+    def _ofs_dedup(self):
+        """Whether the OFS links known contents by their sha256."""
+        if self._dedup is None:
+            resp = requests.get(self._api_endpoint('ofs'))
+            # Older tagstores do not describe their OFS
+            self._dedup = resp.status_code == 200 and \
+                resp.json().get('dedup') is True and \
+                resp.json().get('hashing_type') == 'sha256'
+        return self._dedup
+
+    def _link_stored(self, fobj, fname):
+        """Return the URI of a new blob if the contents of fobj are already
+        stored by a deduplicating tagstore, otherwise None.
+
+        fobj is only read, and rewound, if the tagstore deduplicates and fobj
+        is seekable.
+
+        """
+        if not self._ofs_dedup():
+            return None
+        try:
+            if not fobj.seekable():
+                return None
+        except AttributeError:
+            # Python 2 files and StringIO have no seekable()
+            pass
+        try:
+            start = fobj.tell()
+            fobj.seek(start)
+        except (AttributeError, IOError, UnsupportedOperation):
+            return None
+        digest = sha256()
+        for data in iter(lambda: fobj.read(2 ** 16), ''):
+            digest.update(data)
+        fobj.seek(start)
+        if fobj.tell() != start:
+            raise IOError(u'{0} could not be rewound after hashing'.format(
+                fname))
+        resp = requests.post(self._api_endpoint('ofs'), params=dict(
+            sha256=digest.hexdigest(), fname=fname))
+        if resp.status_code == 200:
+            return resp.json()['uri']
+        return None
+
+    def upload(self, fobj, fname=None, chunk_size=8 * 2 ** 20, parallelism=4,
+               retries=3, session=None, label=None):
+        """Store a file in chunks sent concurrently and return its URI.
+
+        Chunks that fail are sent again up to retries times. If chunks are
+        still missing UploadIncomplete is raised; its session may be passed
+        back in to resume the upload. A label replaces that stored blob.
+
+        """
+        if fname is None:
+            fname = os.path.basename(getattr(fobj, 'name', '')) or 'blob'
+        if session is None and label is None:
+            uri = self._link_stored(fobj, fname)
+            if uri is not None:
+                return uri
+        if session is None:
+            try:
+                size = os.fstat(fobj.fileno()).st_size
+            except (AttributeError, IOError, OSError):
+                fobj.seek(0, os.SEEK_END)
+                size = fobj.tell()
+            resp = requests.post(
+                self._api_endpoint('ofs', 'uploads'), data=json.dumps(dict(
+                    size=size, chunk_size=chunk_size, fname=fname)),
+                headers=self.headers_json)
+            ensure_response_status(resp, 201)
+            session = resp.headers['Location']
+            state = resp.json()
+        else:
+            resp = requests.get(session)
+            ensure_response_status(resp, 200)
+            state = resp.json()
+        chunk_size = state['chunk_size']
+        read_lock = Lock()
+
+        def send(index):
+            with read_lock:
+                fobj.seek(index * chunk_size)
+                data = fobj.read(chunk_size)
+            try:
+                resp = requests.put(u'{0}/{1}'.format(session, index),
+                                    data=data)
+            except requests.RequestException as err:
+                log.warn(u'Chunk {0} failed: {1}'.format(index, err))
+            else:
+                if resp.status_code != 204:
+                    log.warn(u'Chunk {0} failed: {1}'.format(
+                        index, resp.status_code))
+
+        missing = state['missing']
+        pool = ThreadPool(parallelism)
+        try:
+            for attempt in range(retries + 1):
+                if not missing:
+                    break
+                pool.map(send, [index for first, last in missing
+                                for index in range(first, last + 1)])
+                resp = requests.get(session)
+                ensure_response_status(resp, 200)
+                missing = resp.json()['missing']
+        finally:
+            pool.close()
+            pool.join()
+        if missing:
+            raise UploadIncomplete(session, missing)
+
+        commit = dict(fname=fname)
+        if label is not None:
+            commit['label'] = label
+        resp = requests.post(u'{0}/commit'.format(session),
+                             data=json.dumps(commit), headers=self.headers_json)
+        ensure_response_status(resp, 200)
+        return resp.json()['uri']
 
     def edit(self, instanceid, uri_or_fobj=None, fname=None, tags=None):
         """Edit a Datum."""
@@ -207,35 +442,18 @@ class TagStoreClient(object):
         return DataResponse(self, response.json())
 
     def swap_tags(self, tag_old, tag_new, *filters, **kwargs):
-        """Swap out old tag for new tag for all Data that match."""
-        told = self.query_tags(['tag', 'eq', tag_old], limit=1, single=True)
-        tnew = self.query_tags(['tag', 'eq', tag_new], limit=1, single=True)
-        data = dict(tags={})
-        if tnew:
-            add_term = [dict(id=tnew.id)]
-        else:
-            add_term = [self._wrap_tag(tag_new)]
-        data['tags']['remove'] = [dict(id=told.id)]
-
-        # Two cases, in order
-        # If add does not happen first it will be deleted and replace will not
-        # happen.
-        # 1. new tag not present, add new and remove old tag
-        # 2. new tag already present, just remove old tag
-        case2_filters = [['tags__tag', 'any', tag_old]] + list(filters)
-        case1_filters = [['tags__tag', 'not_any', tag_new]] + case2_filters
-
-        data['q'] = self.list_to_q(*case1_filters, **kwargs)
-        data['tags']['add'] = add_term
-        response = requests.put(self._api_endpoint('data'), data=json.dumps(data),
-                                headers=self.headers_json)
-        ensure_response_status(response, 200)
+        """Swap out old tag for new tag for all Data that match.
 
-        data['q'] = self.list_to_q(*case2_filters, **kwargs)
-        del data['tags']['add']
-        response = requests.put(self._api_endpoint('data'), data=json.dumps(data),
-                                headers=self.headers_json)
+        Returns the number of Data retagged.
+
+        """
+        data = dict(old=tag_old, new=tag_new,
+                    q=self.list_to_q(*filters, **kwargs))
+        response = requests.post(self._api_endpoint('data', 'retag'),
+                                 data=json.dumps(data),
+                                 headers=self.headers_json)
         ensure_response_status(response, 200)
+        return response.json()['num_results']
 
     def edit_tag(self, instanceid, tag):
         """Edit a Tag."""
@@ -248,6 +466,16 @@ class TagStoreClient(object):
         ensure_response_status(response, 200)
         return TagResponse(self, response.json())
 
+    def merge_tags(self, instanceid, into):
+        """Merge the Tag into the Tag with id into, deleting it."""
+        merge_endpoint = self._api_endpoint('tags', unicode(instanceid),
+                                            'merge')
+        response = requests.post(merge_endpoint,
+                                 data=json.dumps(dict(into=into)),
+                                 headers=self.headers_json)
+        ensure_response_status(response, 200)
+        return TagResponse(self, response.json())
+
     @classmethod
     def _tagobjs_to_tags(cls, tagobjs):
         return [tagobj['tag'] for tagobj in tagobjs]
@@ -321,6 +549,19 @@ class TagStoreClient(object):
         """
         return self._query('data', DataResponse, *filters, **kwargs)
 
+    def query_data_tags(self, query, preload=False):
+        """Query the tag index for Data whose tags satisfy query.
+
+        query is built with Query.tag(), Query.all_of(), Query.any_of() and
+        Query.not_(), e.g. Data tagged a but not b:
+
+            Query.all_of(Query.tag('eq', 'a'), Query.not_(Query.tag('eq', 'b')))
+
+        """
+        params = dict(q=json.dumps(query))
+        return QueryResponse(self, 'data/tagquery', DataResponse, params,
+                             preload)
+
     def query_tags(self, *filters, **kwargs):
         """Query the tag store for Tags that satisfy the filters.
 
@@ -329,6 +570,20 @@ class TagStoreClient(object):
         """
         return self._query('tags', TagResponse, *filters, **kwargs)
 
+    def tag_keys(self, prefix=None):
+        """List the keys of key:value tags, optionally only those starting
+        with prefix, as (key, number of tags) pairs.
+
+        """
+        params = {}
+        if prefix:
+            params['prefix'] = prefix
+        response = requests.get(self._api_endpoint('tags', 'keys'),
+                                params=params)
+        ensure_response_status(response, 200)
+        return [(obj['key'], obj['num_tags'])
+                for obj in response.json()['objects']]
+
     @classmethod
     def _filter(cls, name=None, op=None, val=None):
         """Shorthand to create a filter object for REST API."""
@@ -338,7 +593,9 @@ class TagStoreClient(object):
     def _list_to_filter(cls, lll):
         """Convert the client's 3-ple filter format to that of restless."""
         name, op, val = lll
-        if isinstance(val, tuple) or isinstance(val, list):
+        # Other operators such as in and between take lists as values
+        if op in cls.relation_ops and \
+                (isinstance(val, tuple) or isinstance(val, list)):
             val = cls._list_to_filter(val)
         return cls._filter(name, op, val)
 
@@ -358,3 +615,31 @@ class Query(object):
     @classmethod
     def tags_any(cls, op, value):
         return ['tags', 'any', ['tag', op, value]]
+
+    @classmethod
+    def tags_key(cls, key):
+        """Data with a key:value tag of key."""
+        return ['tags', 'any', ['key', 'eq', key]]
+
+    @classmethod
+    def tags_startswith(cls, prefix):
+        return ['tags', 'any', ['tag', 'startswith', prefix]]
+
+    # Tag index queries, see TagStoreClient.query_data_tags()
+
+    @classmethod
+    def tag(cls, op, value, name='tag'):
+        """Predicate on the tag, or the key or value of key:value tags."""
+        return dict(name=name, op=op, val=value)
+
+    @classmethod
+    def all_of(cls, *queries):
+        return {'and': list(queries)}
+
+    @classmethod
+    def any_of(cls, *queries):
+        return {'or': list(queries)}
+
+    @classmethod
+    def not_(cls, query):
+        return {'not': query}
@@ -0,0 +1,185 @@
+"""One-shot migrations of existing tagstore data."""
+import sys
+from argparse import ArgumentParser
+from logging import getLogger
+
+from sqlalchemy import inspect, bindparam
+
+from tagstore.models import db, Tag, TagChange, TagGeneration, split_tag
+from tagstore.store import TagstorePTOFS
+from tagstore.patch.ptofs import patch_ptofs
+
+
+log = getLogger(__name__)
+
+
+def migrate_ofs_metadata(storage_dir):
+    """Copy the PersistentState metadata of every bucket into SQLite.
+
+    Existing rows for the same labels are replaced so the migration may be
+    rerun. The JSON files are left in place.
+
+    Returns a dict of bucket to number of labels migrated.
+
+    """
+    locks = patch_ptofs(storage_dir)
+    ptofs = TagstorePTOFS(storage_dir, metadata='sqlite',
+                          uri_base='urn:uuid:', hashing_type='sha256')
+    counts = {}
+    for bucket in ptofs.list_buckets():
+        locks.ptofs.acquire(shared=True)
+        try:
+            _, json_payload = ptofs._get_object(bucket)
+            items = json_payload.items()
+        finally:
+            locks.ptofs.release()
+        ptofs.metadata.update_many(bucket, items)
+        counts[bucket] = len(items)
+    return counts
+
+
+def main_ofs_metadata(argv=None):
+    parser = ArgumentParser(
+        description='Index OFS metadata in SQLite. Set PTOFS_METADATA to '
+                    'sqlite once migrated.')
+    parser.add_argument('storage_dir', nargs='+',
+                        help='PTOFS_DIR of the tagstore to migrate')
+    args = parser.parse_args(argv)
+    for storage_dir in args.storage_dir:
+        counts = migrate_ofs_metadata(storage_dir)
+        for bucket, count in sorted(counts.items()):
+            print '{0} {1}: {2} labels'.format(storage_dir, bucket, count)
+
+
+def migrate_tag_keys(batch_size=1000):
+    """Add the key and value columns to the tag table and fill them in.
+
+    Columns and indices already present are left alone so the migration may
+    be rerun.
+
+    Returns the number of key:value tags split.
+
+    """
+    engine = db.engine
+    table = Tag.__table__
+    preparer = engine.dialect.identifier_preparer
+    present = set(column['name']
+                  for column in inspect(engine).get_columns(table.name))
+    with engine.begin() as conn:
+        for column in (table.c.key, table.c.value):
+            if column.name not in present:
+                conn.execute('ALTER TABLE {0} ADD COLUMN {1} {2}'.format(
+                    preparer.format_table(table),
+                    preparer.format_column(column),
+                    column.type.compile(engine.dialect)))
+    present = set(index['name']
+                  for index in inspect(engine).get_indexes(table.name))
+    for index in table.indexes:
+        if index.name not in present:
+            index.create(engine)
+
+    update = table.update().where(table.c.id == bindparam('_id')).values(
+        key=bindparam('_key'), value=bindparam('_value'))
+    count = 0
+    after = 0
+    while True:
+        rows = db.session.query(Tag.id, Tag.tag).filter(
+            Tag.id > after).order_by(Tag.id).limit(batch_size).all()
+        if not rows:
+            break
+        after = rows[-1][0]
+        params = []
+        for tag_id, tag in rows:
+            key, value = split_tag(tag)
+            if key is not None:
+                params.append(dict(_id=tag_id, _key=key, _value=value))
+        if params:
+            db.session.execute(update, params)
+            count += len(params)
+        db.session.commit()
+    return count
+
+
+def main_tag_keys(argv=None):
+    parser = ArgumentParser(
+        description='Split key:value tags into the indexed key and value '
+                    'columns of the tag table.')
+    parser.add_argument('config', help='tagstore configuration file')
+    parser.add_argument('--batch-size', type=int, default=1000)
+    args = parser.parse_args(argv)
+
+    from tagstore.server import create_app
+    app = create_app(args.config)
+    with app.app_context():
+        count = migrate_tag_keys(args.batch_size)
+    print '{0} tags split'.format(count)
+
+
+def _create_table(table):
+    """Create table unless it exists, returning whether it was created."""
+    engine = db.engine
+    if table.name in inspect(engine).get_table_names():
+        return False
+    table.create(engine)
+    return True
+
+
+def migrate_tag_changes():
+    """Create the tag_changes table that logs changes for the tag index.
+
+    An existing table is left alone so the migration may be rerun.
+
+    Returns whether the table was created.
+
+    """
+    return _create_table(TagChange.__table__)
+
+
+def main_tag_changes(argv=None):
+    parser = ArgumentParser(
+        description='Create the log of tag changes needed by the tag index. '
+                    'Set TAGINDEX_ENABLED once migrated.')
+    parser.add_argument('config', help='tagstore configuration file')
+    args = parser.parse_args(argv)
+
+    from tagstore.server import create_app
+    app = create_app(args.config)
+    with app.app_context():
+        created = migrate_tag_changes()
+    if created:
+        print 'tag_changes created'
+    else:
+        print 'tag_changes already present'
+
+
+def migrate_tag_generations():
+    """Create the tag_generations table by which processes tell that the tag
+    ids they have cached are stale.
+
+    An existing table is left alone so the migration may be rerun.
+
+    Returns whether the table was created.
+
+    """
+    return _create_table(TagGeneration.__table__)
+
+
+def main_tag_generations(argv=None):
+    parser = ArgumentParser(
+        description='Create the generations of tag names needed to cache '
+                    'tag ids.')
+    parser.add_argument('config', help='tagstore configuration file')
+    args = parser.parse_args(argv)
+
+    from tagstore.server import create_app
+    app = create_app(args.config)
+    with app.app_context():
+        created = migrate_tag_generations()
+    if created:
+        print 'tag_generations created'
+    else:
+        print 'tag_generations already present'
+
+
+if __name__ == '__main__':
+    main_ofs_metadata(sys.argv[1:])
@@ -1,11 +1,17 @@
+import sys
+
 from flask.ext.sqlalchemy import SQLAlchemy
 
-from sqlalchemy import UniqueConstraint
+from sqlalchemy import UniqueConstraint, Index, and_
+from sqlalchemy.orm import validates
 
 
 db = SQLAlchemy()
 # NOTE: SQLite performance is surprisingly slow.
 
+# Keep IN clauses under the SQLite limit on host parameters
+MAX_IN_PARAMS = 500
+
 
 tags = db.Table('tags',
     db.Column('tag_id', db.Integer, db.ForeignKey('tag.id')),
@@ -33,12 +39,85 @@ class Data(db.Model):
         return u'<Data {0!r}>'.format(self.uri)
 
 
+def split_tag(tag):
+    """Split a key:value tag into its key and value.
+
+    Tags without a colon have neither.
+
+    """
+    if tag is None or u':' not in tag:
+        return None, None
+    return tuple(tag.split(u':', 1))
+
+
+def startswith(column, prefix):
+    """Condition that column starts with prefix.
+
+    Unlike LIKE this is a range that an index on column can answer.
+
+    """
+    if not prefix:
+        return column != None
+    stop = prefix
+    while stop and stop[-1] == unichr(sys.maxunicode):
+        stop = stop[:-1]
+    if not stop:
+        return column >= prefix
+    stop = stop[:-1] + unichr(ord(stop[-1]) + 1)
+    return and_(column >= prefix, column < stop)
+
+
+def chunks(values, size=MAX_IN_PARAMS):
+    """Lists of at most size of values, e.g. for the values of IN clauses."""
+    values = list(values)
+    for start in range(0, len(values), size):
+        yield values[start:start + size]
+
+
 class Tag(db.Model):
+    __table_args__ = (
+        Index('ix_tag_key_value', 'key', 'value'),
+    )
     id = db.Column(db.Integer, primary_key=True)
     tag = db.Column(db.Unicode(2**9), unique=True)
 
+    # Parts of a key:value tag, kept in step with tag
+    key = db.Column(db.Unicode(2**9))
+    value = db.Column(db.Unicode(2**9))
+
     def __init__(self, tag):
         self.tag = tag
 
+    @validates('tag')
+    def _split_tag(self, name, tag):
+        self.key, self.value = split_tag(tag)
+        return tag
+
     def __repr__(self):
         return u'<Tag {0!r}>'.format(self.tag)
+
+
+class TagChange(db.Model):
+    """Log of the Data whose tags changed, by which the tag index of every
+    process catches up with writes. tag_id is None when the Data itself was
+    created or deleted.
+
+    """
+    __tablename__ = 'tag_changes'
+    __table_args__ = {'sqlite_autoincrement': True}
+    id = db.Column(db.Integer, primary_key=True)
+    data_id = db.Column(db.Integer, nullable=False)
+    tag_id = db.Column(db.Integer)
+
+    def __repr__(self):
+        return u'<TagChange {0} {1}>'.format(self.data_id, self.tag_id)
+
+
+class TagGeneration(db.Model):
+    """Generations of the names of tags. A new one, the highest id, is begun
+    whenever tags are renamed or deleted and the older ones removed.
+
+    """
+    __tablename__ = 'tag_generations'
+    __table_args__ = {'sqlite_autoincrement': True}
+    id = db.Column(db.Integer, primary_key=True)
@@ -0,0 +1,204 @@
+"""Garbage collection of OFS blobs that no Data refers to.
+
+Collection is a streaming mark and sweep. One pass over the URIs of Data
+stored in the OFS collects the distinct prefixes that precede a label, which
+are few (one per host the API has been reached by). Labels are then paged
+through in sorted batches; each batch is marked by looking up prefix + label
+in the unique index on Data.uri and the unmarked labels that are older than
+the grace period are swept. Memory is bounded by the batch size.
+
+Progress is saved to a checkpoint after every deletion and every batch so
+that an interrupted collection resumes where it stopped. The prefixes are
+collected again on resuming, as Data may have been created under new ones.
+
+"""
+import os
+import os.path
+import sys
+import json
+from uuid import uuid4
+from time import time, sleep
+from datetime import datetime, timedelta
+from argparse import ArgumentParser
+from logging import getLogger
+
+from tagstore.models import db, Data, chunks
+
+
+log = getLogger(__name__)
+
+
+OFS_URI_PATTERN = u'%/api/%/ofs/%'
+
+
+def ofs_uri_prefixes(yield_per=1000):
+    """Distinct prefixes of the URIs of Data stored in the OFS."""
+    prefixes = set()
+    query = db.session.query(Data.uri).filter(
+        Data.uri.like(OFS_URI_PATTERN)).yield_per(yield_per)
+    for uri, in query:
+        prefixes.add(uri[:uri.rindex('/') + 1])
+    return sorted(prefixes)
+
+
+def referenced_labels(labels, prefixes):
+    """The subset of labels that some Data refers to."""
+    uris = {}
+    for prefix in prefixes:
+        for label in labels:
+            uris[prefix + label] = label
+    referenced = set()
+    for chunk in chunks(uris):
+        for uri, in db.session.query(Data.uri).filter(Data.uri.in_(chunk)):
+            referenced.add(uris[uri])
+    return referenced
+
+
+def _load_checkpoint(path):
+    if path is None:
+        return None
+    try:
+        with open(path) as fff:
+            return json.load(fff)
+    except (IOError, ValueError):
+        return None
+
+
+def _save_checkpoint(path, state):
+    if path is None:
+        return
+    tmppath = '{0}.{1}'.format(path, uuid4().hex)
+    with open(tmppath, 'w') as fff:
+        json.dump(state, fff)
+    os.rename(tmppath, path)
+
+
+def _clear_checkpoint(path):
+    if path is None:
+        return
+    try:
+        os.remove(path)
+    except OSError:
+        pass
+
+
+def collect(ofs, grace=60, batch_size=1000, rate=None, checkpoint=None,
+            dry_run=False, report=None):
+    """Delete OFS blobs that no Data refers to.
+
+    ofs is an OFSWrapper or ShardedOFSWrapper. Blobs modified in the last grace seconds are kept as
+    they may not have been associated with their Data yet. At most rate blobs
+    are deleted per second. If checkpoint is a path, progress is saved there
+    and resumed from. A dry run only reports what would be deleted. report is
+    called with each label deleted.
+
+    Returns counts of the labels examined, referenced, kept for the grace
+    period and deleted.
+
+    """
+    state = None
+    if not dry_run:
+        state = _load_checkpoint(checkpoint)
+    if state is None:
+        state = dict(
+            after=None,
+            stats=dict(examined=0, referenced=0, in_grace=0, deleted=0))
+    else:
+        log.info(u'Resuming collection after {0}'.format(state['after']))
+        # Checkpoints of older versions kept prefixes, which may be stale
+        state.pop('prefixes', None)
+    prefixes = ofs_uri_prefixes()
+    stats = state['stats']
+    grace_time = datetime.now() - timedelta(seconds=grace)
+    interval = 0
+    if rate:
+        interval = 1.0 / rate
+
+    while True:
+        labels = ofs.call('list_labels', after=state['after'],
+                          limit=batch_size)
+        if not labels:
+            break
+        referenced = referenced_labels(labels, prefixes)
+        for label in labels:
+            stats['examined'] += 1
+            if label in referenced:
+                stats['referenced'] += 1
+                continue
+            try:
+                meta = ofs.call('get_metadata', label)
+            except Exception:
+                # Deleted meanwhile
+                continue
+            mtime = datetime.strptime(
+                meta['_last_modified'], '%Y-%m-%dT%H:%M:%S')
+            # Still within the grace period
+            if mtime >= grace_time:
+                stats['in_grace'] += 1
+                continue
+            start = time()
+            if not dry_run:
+                ofs.call('del_stream', label)
+            stats['deleted'] += 1
+            if not dry_run:
+                # Labels are handled in order, so the deletion is recorded
+                # along with everything examined before it.
+                state['after'] = label
+                _save_checkpoint(checkpoint, state)
+            if report:
+                report(label)
+            if interval and not dry_run:
+                sleep(max(0, interval - (time() - start)))
+        state['after'] = labels[-1]
+        if not dry_run:
+            _save_checkpoint(checkpoint, state)
+
+    if not dry_run:
+        ofs.call('sweep_shared', grace)
+        ofs.call('sweep_parts', grace)
+        _clear_checkpoint(checkpoint)
+    return stats
+
+
+def main(argv=None):
+    parser = ArgumentParser(
+        description='Delete OFS blobs that no Data refers to.')
+    parser.add_argument('config', help='tagstore configuration file')
+    parser.add_argument('--grace', type=int, default=60,
+                        help='Keep blobs modified in the last GRACE seconds')
+    parser.add_argument('--rate', type=float, default=None,
+                        help='Delete at most RATE blobs per second')
+    parser.add_argument('--batch-size', type=int, default=1000)
+    parser.add_argument('--checkpoint', default=None,
+                        help='Progress file, default PTOFS_DIR/gc.checkpoint')
+    parser.add_argument('--restart', action='store_true',
+                        help='Ignore the progress of an interrupted run')
+    parser.add_argument('--dry-run', action='store_true',
+                        help='List the blobs that would be deleted')
+    args = parser.parse_args(argv)
+
+    from tagstore.server import create_app, ofs, uploads
+    app = create_app(args.config)
+    checkpoint = args.checkpoint
+    if checkpoint is None:
+        checkpoint = os.path.join(app.config['PTOFS_DIR'], 'gc.checkpoint')
+    if args.restart:
+        _clear_checkpoint(checkpoint)
+
+    report = None
+    if args.dry_run:
+        def report(label):
+            print label
+
+    with app.app_context():
+        stats = collect(ofs, grace=args.grace, batch_size=args.batch_size,
+                        rate=args.rate, checkpoint=checkpoint,
+                        dry_run=args.dry_run, report=report)
+        if not args.dry_run:
+            uploads.expire(app.config['OFS_UPLOAD_EXPIRY'])
+    print ('{examined} examined, {referenced} referenced, {in_grace} in grace '
+           'period, {deleted} deleted').format(**stats)
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
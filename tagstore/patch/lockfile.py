@@ -1,6 +1,9 @@
 import os
 import os.path
+import errno
+import fcntl
 from logging import getLogger, CRITICAL
+from threading import local
 from time import sleep
 from uuid import getnode
 
@@ -23,10 +26,11 @@ class RLockFile(object):
         self.pidfile = self.name + '.pid'
         self.locks = 0
 
-    def acquire(self):
+    def acquire(self, shared=False):
         """Spin until locked.
 
-        Acquire is reentrant.
+        Acquire is reentrant. The lock is always exclusive; shared is accepted
+        for compatibility with FlockRLock.
 
         """
         pid = '{0}_{1}'.format(getnode(), os.getpid())
@@ -52,6 +56,9 @@ class RLockFile(object):
             sleep(0.5)
         log.debug('acquired {0} {1}'.format(self.name, pid))
 
+    def held_shared(self):
+        return False
+
     def release(self):
         #if self.locks != 0:
         #    self.locks -= 1
@@ -62,3 +69,115 @@ class RLockFile(object):
         except (AttributeError, NotLockedError):
             pass
         log.debug('released {0}'.format(self.name))
+
+
+def _open_lockfile(name):
+    try:
+        return os.open(name, os.O_RDWR | os.O_CREAT, 0644)
+    except OSError as err:
+        if err.errno != errno.ENOENT:
+            raise
+    try:
+        os.makedirs(os.path.dirname(name))
+    except OSError as err:
+        if err.errno != errno.EEXIST:
+            raise
+    return os.open(name, os.O_RDWR | os.O_CREAT, 0644)
+
+
+class FlockRLock(object):
+    """Reentrant reader-writer lock on a file using kernel advisory locks.
+
+    Each thread opens its own descriptor for the lock file so threads of one
+    process exclude each other just like processes do. Acquisitions are
+    counted per thread and the kernel lock is dropped when the count returns
+    to zero. Acquire blocks in the kernel until the lock is free instead of
+    polling.
+
+    Any number of threads may hold the lock shared. A thread that already
+    holds it shared and asks for it exclusively is upgraded; flock does not
+    upgrade atomically so another writer may get in between.
+
+    """
+    def __init__(self, name):
+        self.name = name
+        self._local = local()
+
+    def _state(self):
+        state = self._local
+        pid = os.getpid()
+        if getattr(state, 'pid', None) != pid:
+            # Either a new thread or a forked child of a holder. Neither owns
+            # the lock; drop an inherited descriptor so it does not keep the
+            # parent's lock alive.
+            fd = getattr(state, 'fd', None)
+            if fd is not None:
+                try:
+                    os.close(fd)
+                except OSError:
+                    pass
+            state.pid = pid
+            state.fd = None
+            # Modes of the nested acquisitions, True for shared.
+            state.modes = []
+        return state
+
+    @classmethod
+    def _operation(cls, modes):
+        if all(modes):
+            return fcntl.LOCK_SH
+        return fcntl.LOCK_EX
+
+    def held_shared(self):
+        """Whether the current thread holds the lock in shared mode only."""
+        modes = self._state().modes
+        return bool(modes) and self._operation(modes) == fcntl.LOCK_SH
+
+    def acquire(self, shared=False):
+        """Block until locked.
+
+        Acquire is reentrant.
+
+        """
+        state = self._state()
+        modes = state.modes + [shared]
+        operation = self._operation(modes)
+        if not state.modes:
+            log.debug('acquiring {0} {1}'.format(self.name, os.getpid()))
+            fd = _open_lockfile(self.name)
+            try:
+                fcntl.flock(fd, operation)
+            except:
+                os.close(fd)
+                raise
+            state.fd = fd
+            log.debug('acquired {0} {1}'.format(self.name, os.getpid()))
+        else:
+            log.debug(u'reentrant acquisition')
+            if operation != self._operation(state.modes):
+                fcntl.flock(state.fd, operation)
+        state.modes = modes
+
+    def release(self):
+        state = self._state()
+        if not state.modes:
+            raise RuntimeError(u'cannot release un-acquired lock')
+        modes = state.modes[:-1]
+        if not modes:
+            fd, state.fd = state.fd, None
+            # Closing the only descriptor releases the flock.
+            os.close(fd)
+            log.debug('released {0}'.format(self.name))
+        elif self._operation(modes) != self._operation(state.modes):
+            # Downgrade to shared once the exclusive section is left.
+            fcntl.flock(state.fd, self._operation(modes))
+        state.modes = modes
+
+
+LOCK_BACKENDS = {
+    'flock': FlockRLock,
+    'lockfile': RLockFile,
+}
+
+
+DEFAULT_LOCK = FlockRLock
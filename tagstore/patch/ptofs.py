@@ -1,70 +1,133 @@
 """Patch ofs.local.storedjson.PersistentState to be more threadsafe
 
 * Prevent concurrent access to persistence file
-* Prevent concurrent access to PersistentState by PTOFS (This will also prevent
-concurrent read and write to PTOFS)
+* Provide the PTOFS lock that prevents concurrent access to PersistentState by
+PTOFS (This will also prevent concurrent read and write to PTOFS)
+
+Reading the persistence file only needs the persistence lock shared. The PTOFS
+lock is not taken by PersistentState itself: the caller holds it around the
+whole PTOFS call (see OFSWrapper.call) and releases it in the same call path.
+Lock state is per thread, so it must not be left for __del__ to release on
+whichever thread happens to collect the PersistentState.
+
+The patch is applied to PersistentState once per process. Each storage
+directory registers its own locks and a PersistentState picks the locks of the
+storage directory that contains it, so patching again for the same (or
+another) storage directory does not stack wrappers.
 
 """
 
 import os
 import os.path
+from threading import Lock
 from ofs.local import PTOFS
 from ofs.local.storedjson import PersistentState, PERSISTENCE_FILENAME
 from logging import getLogger, DEBUG, WARN
 
-from lockfile import RLockFile, lockpath
+from lockfile import DEFAULT_LOCK, lockpath
 
 
 log = getLogger(__name__)
 log.setLevel(WARN)
 
 
-def patch_ptofs(storage_dir):
-    persistence_lock = RLockFile(lockpath(storage_dir, 'persistence'))
-    ptofs_lock = RLockFile(lockpath(storage_dir, 'ptofs'))
+_registry_lock = Lock()
+# Locks are bound to the process that created them
+_registry_pid = None
+_registry = {}
+_patched = False
+
+
+class StorageLocks(object):
+    def __init__(self, storage_dir, lock_class=None):
+        if lock_class is None:
+            lock_class = DEFAULT_LOCK
+        self.storage_dir = storage_dir
+        self.lock_class = lock_class
+        self.persistence = lock_class(lockpath(storage_dir, 'persistence'))
+        self.ptofs = lock_class(lockpath(storage_dir, 'ptofs'))
+        # Held shared by writes through a sharded OFS and exclusively while a
+        # label is moved between shards
+        self.moves = lock_class(lockpath(storage_dir, 'moves'))
+
+
+def get_storage_locks(storage_dir, lock_class=None):
+    """Return the locks for storage_dir, creating them if necessary.
+
+    The lock class of the first registration for a directory wins.
 
-    old_revert = PersistentState.revert 
+    """
+    global _registry_pid, _registry
+    storage_dir = os.path.abspath(storage_dir)
+    with _registry_lock:
+        if _registry_pid != os.getpid():
+            # Forked; lock state belongs to the parent.
+            _registry = dict(
+                (key, StorageLocks(key, locks.lock_class))
+                for key, locks in _registry.items())
+            _registry_pid = os.getpid()
+        try:
+            return _registry[storage_dir]
+        except KeyError:
+            locks = _registry[storage_dir] = StorageLocks(
+                storage_dir, lock_class)
+            return locks
+
+
+def _find_storage_locks(filepath):
+    """Return the locks of the registered storage dir containing filepath."""
+    if not filepath:
+        return None
+    filepath = os.path.abspath(filepath)
+    for storage_dir in list(_registry.keys()):
+        if filepath.startswith(storage_dir + os.sep):
+            return get_storage_locks(storage_dir)
+    return None
+
+
+def patch_ptofs(storage_dir, lock_class=None):
+    """Register locks for storage_dir and patch PersistentState once."""
+    global _patched
+    locks = get_storage_locks(storage_dir, lock_class)
+    with _registry_lock:
+        if _patched:
+            return locks
+        _patched = True
+
+    old_revert = PersistentState.revert
     def new_revert(self):
+        locks = getattr(self, '_tagstore_locks', None)
+        if locks is None:
+            return old_revert(self)
         log.debug('lock persist acquiring {0}'.format(os.getpid()))
-        persistence_lock.acquire()
+        locks.persistence.acquire(shared=True)
         log.debug('lock persist acquired {0}'.format(os.getpid()))
         try:
             old_revert(self)
         finally:
-            persistence_lock.release()
+            locks.persistence.release()
         log.debug('lock persist released {0}'.format(os.getpid()))
     PersistentState.revert = new_revert
 
     old_sync = PersistentState.sync
     def new_sync(self):
+        locks = getattr(self, '_tagstore_locks', None)
+        if locks is None:
+            return old_sync(self)
         log.debug('lock persist acquiring {0}'.format(os.getpid()))
-        persistence_lock.acquire()
+        locks.persistence.acquire()
         log.debug('lock persist acquired {0}'.format(os.getpid()))
         try:
             old_sync(self)
         finally:
-            persistence_lock.release()
+            locks.persistence.release()
             log.debug('lock persist released {0}'.format(os.getpid()))
     PersistentState.sync = new_sync
 
     old_init = PersistentState.__init__
     def new_init(self, filepath=None, filename=PERSISTENCE_FILENAME, create=True):
-        log.debug('lock PTOFS acquiring {0}'.format(os.getpid()))
-        ptofs_lock.acquire()
-        log.debug('lock PTOFS acquired {0}'.format(os.getpid()))
+        self._tagstore_locks = _find_storage_locks(filepath)
         old_init(self, filepath, filename, create)
     PersistentState.__init__ = new_init
 
-    try:
-        old_del = PersistentState.__del__
-    except AttributeError:
-        old_del = lambda x: None
-    def new_del(self):
-        old_del(self)
-        # Release PTOFS lock whenever persisted state is collected.
-        try:
-            ptofs_lock.release()
-            log.debug('lock PTOFS released {0}'.format(os.getpid()))
-        except RuntimeError:
-            log.error('lock PTOFS failed to release {0}'.format(os.getpid()))
-    PersistentState.__del__ = new_del
+    return locks
@@ -1,7 +1,114 @@
-"""Add operators to restless"""
-from flask.ext.restless import search
+"""Add operators, faster pages and upserts to restless"""
+from flask import request
+from werkzeug.exceptions import BadRequest
+from flask.ext.restless import search, views
+from flask.ext.restless.helpers import to_dict, count
+
+from tagstore.models import startswith
+from tagstore.tagsets import in_tagset
 
 
 search.OPERATORS['not_any'] = lambda f, a, fn: ~f.any(search._sub_operator(f, a, fn))
 search.OPERATORS['not_ilike'] = lambda f, a: ~f.ilike(a)
 search.OPERATORS['not_like'] = lambda f, a: ~f.like(a)
+# Index friendly alternatives to like 'prefix%'
+search.OPERATORS['startswith'] = lambda f, a: startswith(f, a)
+search.OPERATORS['between'] = lambda f, a: f.between(*a)
+search.OPERATORS['in_tagset'] = lambda f, a: in_tagset(f, a)
+
+
+# Serializers of listings of a model by something faster than to_dict. Each
+# is called with the query of the listing and the start and stop of the page
+# and returns what to_dict would for its rows.
+SERIALIZERS = {}
+
+# Upserts of a model, used by POST with the on_conflict argument instead of
+# the POST preprocessors and insert. Each is called with the posted data and
+# on_conflict and returns what to_dict would for the row written and whether
+# it was created. ValueErrors are answered with 400.
+UPSERTS = {}
+
+
+def counting():
+    """Whether the request wants the results of searches counted."""
+    return request.args.get('count') not in ('0', 'false')
+
+
+_paginated = views.API._paginated
+
+
+def _serialize(self, instances, start, stop, deep):
+    # Slicing adds to the offset of a search but replaces its limit
+    if instances._limit is not None:
+        stop = min(stop, instances._limit)
+        start = min(start, stop)
+    serializer = SERIALIZERS.get(self.model)
+    if serializer is not None and self.include_columns is None and \
+            self.exclude_columns is None and not self.include_methods:
+        return serializer(instances, start, stop)
+    return [to_dict(x, deep, exclude=self.exclude_columns,
+                    exclude_relations=self.exclude_relations,
+                    include=self.include_columns,
+                    include_relations=self.include_relations,
+                    include_methods=self.include_methods)
+            for x in instances.slice(start, stop)]
+
+
+def _paginated_fast(self, instances, deep):
+    """Page results through SERIALIZERS, and without counting them if the
+    count argument is false.
+
+    Uncounted pages fetch one row more than the page to tell whether more
+    results follow, given as more. num_results is left out and total_pages
+    is the page, plus one while more follow.
+
+    """
+    results_per_page = self._compute_results_per_page()
+    if isinstance(instances, list) or results_per_page <= 0:
+        return _paginated(self, instances, deep)
+    page_num = int(request.args.get('page', 1))
+    start = (page_num - 1) * results_per_page
+    if counting():
+        num_results = count(self.session, instances)
+        objects = _serialize(self, instances, start,
+                             start + results_per_page, deep)
+        return dict(page=page_num, objects=objects, num_results=num_results,
+                    total_pages=-(-num_results // results_per_page))
+    objects = _serialize(self, instances, start,
+                         start + results_per_page + 1, deep)
+    more = len(objects) > results_per_page
+    return dict(page=page_num, objects=objects[:results_per_page], more=more,
+                total_pages=page_num + 1 if more else page_num)
+
+
+views.API._paginated = _paginated_fast
+
+
+_post = views.API.post
+
+
+def _post_upsert(self):
+    """POST through UPSERTS if the on_conflict argument is given.
+
+    Responds 201 if the instance was created and 200 otherwise.
+
+    """
+    on_conflict = request.args.get('on_conflict')
+    upsert = UPSERTS.get(self.model)
+    if on_conflict is None or upsert is None:
+        return _post(self)
+    try:
+        data = request.get_json(force=True) or {}
+    except (BadRequest, TypeError, ValueError, OverflowError):
+        return dict(message='Unable to decode data'), 400
+    try:
+        result, created = upsert(data, on_conflict)
+    except ValueError as err:
+        return dict(message=unicode(err)), 400
+    headers = dict(Location='{0}/{1}'.format(request.base_url, result['id']))
+    for postprocessor in self.postprocessors['POST']:
+        postprocessor(result=result)
+    return result, 201 if created else 200, headers
+
+
+views.API.post = _post_upsert
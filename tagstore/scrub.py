@@ -0,0 +1,265 @@
+"""Integrity scrubbing of OFS blobs.
+
+Every blob is read back and compared with the length and checksum recorded
+when it was stored. Blobs are hashed by a pool of processes, which together
+read no faster than the given bandwidth so that scrubbing does not starve the
+server. A blob found intact is marked _verified so that incremental scrubs
+only reread blobs not verified recently.
+
+Problems reported:
+
+missing
+    Metadata without a blob.
+truncated
+    A blob shorter or longer than recorded.
+corrupt
+    A blob whose checksum differs from the one recorded.
+orphan
+    A file in the bucket without metadata, or a pairtree directory that is not
+    the bucket's.
+
+"""
+import os
+import os.path
+import sys
+import hashlib
+from time import time, sleep
+from datetime import datetime, timedelta
+from multiprocessing import Pool, cpu_count
+from argparse import ArgumentParser
+from logging import getLogger
+
+from ofs.local.storedjson import PERSISTENCE_FILENAME
+from pairtree import FileNotFoundException
+
+from tagstore.store import CAS_DIRNAME, PART_INFIX, DecodingReader
+
+
+log = getLogger(__name__)
+
+
+PROBLEMS = ('missing', 'truncated', 'corrupt', 'orphan')
+
+# Bytes per second each worker may read, set by _init_worker
+_worker_rate = None
+
+
+def _init_worker(rate):
+    global _worker_rate
+    _worker_rate = rate
+
+
+def _verify(task):
+    """Check the blob at path against its recorded length and checksum.
+
+    Compressed blobs are checked after decoding.
+
+    Returns (label, status, bytes read).
+
+    """
+    label, path, length, checksum, encoding = task
+    digest = None
+    if checksum:
+        hashing_type, expected = checksum.split(':', 1)
+        digest = hashlib.new(hashing_type)
+    read = 0
+    start = time()
+    try:
+        fff = open(path, 'rb')
+    except (IOError, OSError):
+        return label, 'missing', read
+    if encoding:
+        fff = DecodingReader(fff, encoding)
+    try:
+        for data in iter(lambda: fff.read(2 ** 20), ''):
+            read += len(data)
+            if digest is not None:
+                digest.update(data)
+            if _worker_rate:
+                ahead = float(read) / _worker_rate - (time() - start)
+                if ahead > 0:
+                    sleep(ahead)
+    except (IOError, OSError):
+        return label, 'missing', read
+    except Exception:
+        # Undecodable
+        return label, 'corrupt', read
+    finally:
+        fff.close()
+    if length is not None and read != length:
+        return label, 'truncated', read
+    if digest is not None and digest.hexdigest() != expected:
+        return label, 'corrupt', read
+    return label, 'ok', read
+
+
+def _is_reserved(fname):
+    """Files in the bucket that are not blobs."""
+    return fname in (PERSISTENCE_FILENAME, CAS_DIRNAME) or \
+        (fname.startswith('.') and PART_INFIX in fname)
+
+
+def _iter_labels(ofs, batch_size):
+    after = None
+    while True:
+        labels = ofs.call('list_labels', after=after, limit=batch_size)
+        if not labels:
+            return
+        for label in labels:
+            yield label
+        after = labels[-1]
+
+
+def orphaned_files(ofs, batch_size=1000):
+    """Files in the bucket directory that no label's metadata refers to."""
+    dirpath = ofs.ofs._store._id_to_dirpath(ofs.bucket_id)
+    fnames = sorted(fname for fname in os.listdir(dirpath)
+                    if not _is_reserved(fname))
+    # Merge with the sorted labels
+    labels = _iter_labels(ofs, batch_size)
+    label = next(labels, None)
+    for fname in fnames:
+        while label is not None and label < fname:
+            label = next(labels, None)
+        if label != fname:
+            yield os.path.join(dirpath, fname)
+
+
+def orphaned_dirs(ofs):
+    """Pairtree directories that do not lead to the bucket."""
+    store = ofs.ofs._store
+    bucket_dir = store._id_to_dirpath(ofs.bucket_id)
+    for dirpath, dirnames, fnames in os.walk(store.pairtree_root):
+        if dirpath == bucket_dir:
+            dirnames[:] = []
+        elif fnames:
+            # Another object
+            dirnames[:] = []
+            yield dirpath
+        elif not dirnames:
+            yield dirpath
+
+
+def _tasks(ofs, labels, verified_since, stats, report):
+    for label in labels:
+        try:
+            meta = ofs.call('get_metadata', label)
+        except FileNotFoundException:
+            # Deleted meanwhile
+            continue
+        if verified_since is not None and \
+                meta.get('_verified', '') >= verified_since:
+            stats['skipped'] += 1
+            continue
+        try:
+            path = ofs.call('get_path', label)
+        except FileNotFoundException:
+            stats['missing'] += 1
+            report(label, 'missing')
+            continue
+        yield (label, path, meta.get('_content_length'),
+               meta.get('_checksum'), meta.get('_encoding'))
+
+
+def scrub(ofs, processes=None, bandwidth=None, max_age=None, batch_size=1000,
+          orphans=True, report=None):
+    """Verify the blobs in ofs, an OFSWrapper or ShardedOFSWrapper.
+
+    processes hash blobs in parallel (default one per core) reading at most
+    bandwidth bytes per second together. Blobs verified in the last max_age
+    days are skipped. report is called with the label (or path, for orphans)
+    and the problem for each one found.
+
+    Returns counts of blobs checked, skipped and read, and of each problem.
+
+    """
+    if report is None:
+        report = lambda name, problem: log.warn(
+            u'{0} {1}'.format(problem, name))
+    stats = dict(checked=0, ok=0, skipped=0, bytes=0)
+    for problem in PROBLEMS:
+        stats[problem] = 0
+
+    verified_since = None
+    if max_age is not None:
+        since = datetime.now() - timedelta(days=max_age)
+        verified_since = since.isoformat().split('.')[0]
+    if processes is None:
+        processes = cpu_count()
+    rate = None
+    if bandwidth:
+        rate = float(bandwidth) / processes
+
+    pool = Pool(processes, _init_worker, (rate, ))
+    try:
+        after = None
+        while True:
+            labels = ofs.call('list_labels', after=after, limit=batch_size)
+            if not labels:
+                break
+            after = labels[-1]
+            tasks = list(_tasks(ofs, labels, verified_since, stats, report))
+            verified = []
+            for label, status, read in pool.imap_unordered(_verify, tasks):
+                stats['checked'] += 1
+                stats['bytes'] += read
+                stats[status] += 1
+                if status == 'ok':
+                    verified.append(label)
+                else:
+                    report(label, status)
+            if verified:
+                ofs.call('mark_verified', verified)
+    finally:
+        pool.close()
+        pool.join()
+
+    if orphans:
+        for shard in ofs.shards:
+            for path in orphaned_files(shard, batch_size):
+                stats['orphan'] += 1
+                report(path, 'orphan')
+            for path in orphaned_dirs(shard):
+                stats['orphan'] += 1
+                report(path, 'orphan')
+    return stats
+
+
+def main(argv=None):
+    parser = ArgumentParser(
+        description='Verify OFS blobs against their recorded checksums.')
+    parser.add_argument('config', help='tagstore configuration file')
+    parser.add_argument('--processes', type=int, default=None,
+                        help='Hashing processes, default one per core')
+    parser.add_argument('--bandwidth', type=float, default=None,
+                        help='Read at most BANDWIDTH MB per second')
+    parser.add_argument('--days', type=float, default=None,
+                        help='Skip blobs verified in the last DAYS days')
+    parser.add_argument('--batch-size', type=int, default=1000)
+    parser.add_argument('--no-orphans', action='store_true',
+                        help='Do not look for orphaned files')
+    args = parser.parse_args(argv)
+
+    from tagstore.server import create_app, ofs
+    app = create_app(args.config)
+
+    def report(name, problem):
+        print u'{0} {1}'.format(problem, name)
+
+    bandwidth = None
+    if args.bandwidth:
+        bandwidth = args.bandwidth * 2 ** 20
+    with app.app_context():
+        stats = scrub(ofs._get_current_object(), processes=args.processes,
+                      bandwidth=bandwidth, max_age=args.days,
+                      batch_size=args.batch_size,
+                      orphans=not args.no_orphans, report=report)
+    print ('{checked} checked, {skipped} skipped, {bytes} bytes read: '
+           '{missing} missing, {truncated} truncated, {corrupt} corrupt, '
+           '{orphan} orphaned').format(**stats)
+    if any(stats[problem] for problem in PROBLEMS):
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -1,83 +1,317 @@
 from uuid import uuid4
+import os
 import os.path
 import logging
-from datetime import datetime, timedelta
+from datetime import datetime
 from mimetypes import guess_type
+from urllib import quote
+from shutil import copyfileobj
 from traceback import format_exc
+from threading import Lock
+from time import mktime
 import json
+from heapq import merge
+from itertools import izip
+from base64 import urlsafe_b64encode, urlsafe_b64decode
 
 log = logging.getLogger(__name__)
 
 import requests
 
 from flask import (
-    Flask, g, Blueprint, current_app, jsonify, abort, request, send_file,
-    make_response, Response, stream_with_context
+    Flask, Blueprint, current_app, jsonify, abort, request,
+    make_response, Response, stream_with_context, url_for
 )
 from flask.ext.restless import APIManager, ProcessingException, search
+from flask.ext.restless.search import create_query
 
 from werkzeug.local import LocalProxy
+from werkzeug.wsgi import wrap_file
+from werkzeug.formparser import parse_form_data
+from werkzeug.http import http_date, quote_etag
 
-from ofs.local import PTOFS
+from pairtree import FileNotFoundException
 
+from sqlalchemy import (
+    func, select, literal, and_, inspect as sqlalchemy_inspect
+)
+from sqlalchemy.exc import IntegrityError
 
-from models import db, Tag, Data, tags
+from models import db, Tag, Data, TagChange, tags, startswith, chunks
+from store import TagstorePTOFS, CachedMetadata
+from shard import HashRing
+from uploads import UploadSessions, ChunkError
+from cache import LRUCache, GenerationalLRUCache
+from ofsgc import collect
+from tagindex import (
+    TagIndex, QueryError, log_tag_changes, logs_changes, log_changes
+)
+from tagsets import rewrite_filters
+from upsert import (
+    resolve_tags, cached_tag_ids, begin_tag_generation, upsert_data
+)
 from tempfilezipstream import TempFileStreamingZipFile, FileWrapper
 from patch.ptofs import patch_ptofs
 import patch.restless
-from patch.lockfile import RLockFile, lockpath
+from patch.lockfile import DEFAULT_LOCK, LOCK_BACKENDS, lockpath
 
 
 class OFSWrapper(object):
     # 2-char bucket label for shallower pairtree
     BUCKET_LABEL = u'ts'
 
-    def __init__(self, **kwargs):
-        self.ofslock = RLockFile(lockpath(
+    # PTOFS methods that may share the storage lock with each other. All other
+    # methods hold it exclusively.
+    READ_METHODS = frozenset([
+        'exists', 'list_labels', 'get_stream', 'get_metadata', 'get_url',
+        'get_path', 'open_blob',
+    ])
+
+    # Position in PTOFS_DIRS when this is one shard of a ShardedOFSWrapper
+    shard_index = None
+
+    def __init__(self, lock_class=DEFAULT_LOCK, **kwargs):
+        self.lock_class = lock_class
+        self.ofslock = lock_class(lockpath(
             os.path.dirname(kwargs['storage_dir']), 'ofs'))
         self.init(**kwargs)
 
     def init(self, **kwargs):
+        self.locks = patch_ptofs(kwargs['storage_dir'], self.lock_class)
         self.ofslock.acquire()
-        self.ofs = PTOFS(uri_base='urn:uuid:', hashing_type='sha256', **kwargs)
-        if self.BUCKET_LABEL not in self.ofs.list_buckets():
-            self.bucket_id = self.ofs.claim_bucket(self.BUCKET_LABEL)
-        else:
-            self.bucket_id = self.BUCKET_LABEL
-        self.ofslock.release()
-        patch_ptofs(self.ofs.storage_dir)
+        try:
+            self.ofs = TagstorePTOFS(
+                uri_base='urn:uuid:', hashing_type='sha256', **kwargs)
+            self.locks.ptofs.acquire()
+            try:
+                if self.BUCKET_LABEL not in self.ofs.list_buckets():
+                    self.bucket_id = self.ofs.claim_bucket(self.BUCKET_LABEL)
+                else:
+                    self.bucket_id = self.BUCKET_LABEL
+            finally:
+                self.locks.ptofs.release()
+        finally:
+            self.ofslock.release()
 
     def call(self, method, *args, **kwargs):
+        # Metadata backends other than the PersistentState JSON do their own
+        # locking.
+        lock = None
+        if self.ofs.metadata.global_lock:
+            lock = self.locks.ptofs
+            lock.acquire(shared=method in self.READ_METHODS)
         try:
             return getattr(self.ofs, method)(self.bucket_id, *args, **kwargs)
         except Exception as exc:
             log.error(u'{0} failed for {1}\n{2}'.format(
                 method, args, format_exc(exc)))
             raise
+        finally:
+            if lock is not None:
+                lock.release()
+
+    @property
+    def shards(self):
+        return [self]
+
+    def locate(self, label):
+        """The OFSWrapper storing label."""
+        return self
+
+
+class ShardedOFSWrapper(object):
+    """OFS spread over several storage directories by consistent hashing.
+
+    Each storage directory is an OFSWrapper with its own lock files. New blobs
+    go to the shard the ring assigns their label to. Stored labels are looked
+    for on the other shards too, so that they stay reachable until
+    tagstore-rebalance-ofs has moved them after a shard was added.
+
+    """
+    # Methods on a stored label, sent to the shard that has it
+    LOCATED_METHODS = frozenset([
+        'exists', 'get_stream', 'get_metadata', 'get_url', 'get_path',
+        'update_metadata', 'del_metadata_keys', 'del_stream', 'refcount',
+        'replace_metadata',
+    ])
+    # Methods storing a label, sent to the shard the ring assigns it to
+    STORE_METHODS = frozenset(['put_stream', 'link_blob', 'commit_blob'])
+    # Methods that may not run while a label is moved between shards
+    WRITE_METHODS = STORE_METHODS | frozenset([
+        'update_metadata', 'del_metadata_keys', 'del_stream',
+        'replace_metadata', 'mark_verified',
+    ])
+
+    def __init__(self, storage_dirs, **kwargs):
+        self.shards = []
+        for index, storage_dir in enumerate(storage_dirs):
+            shard = OFSWrapper(storage_dir=storage_dir, **kwargs)
+            shard.shard_index = index
+            self.shards.append(shard)
+        # Keyed by path so that the ring does not depend on the order of
+        # storage_dirs
+        self.ring = HashRing(storage_dirs)
+        self._shard_by_node = dict(zip(storage_dirs, self.shards))
+
+    def shard_for(self, label):
+        """The OFSWrapper the ring assigns label to."""
+        return self._shard_by_node[self.ring.node_for(label)]
+
+    def locate(self, label):
+        """The OFSWrapper storing label, or the one it belongs on."""
+        primary = self.shard_for(label)
+        if primary.call('exists', label):
+            return primary
+        for shard in self.shards:
+            if shard is not primary and shard.call('exists', label):
+                return shard
+        return primary
+
+    def call(self, method, *args, **kwargs):
+        if method not in self.WRITE_METHODS:
+            return self._call(method, *args, **kwargs)
+        # Shards are locked in order, as move_label does
+        held = []
+        try:
+            for shard in self.shards:
+                shard.locks.moves.acquire(shared=True)
+                held.append(shard)
+            return self._call(method, *args, **kwargs)
+        finally:
+            for shard in reversed(held):
+                shard.locks.moves.release()
+
+    def _call(self, method, *args, **kwargs):
+        if method in self.LOCATED_METHODS:
+            return self.locate(args[0]).call(method, *args, **kwargs)
+        if method == 'open_blob':
+            return self.shard_for(args[0]).call(method, *args, **kwargs)
+        if method in self.STORE_METHODS:
+            label = args[0]
+            if method == 'commit_blob':
+                label = args[0].label
+            shard = self.shard_for(label)
+            result = shard.call(method, *args, **kwargs)
+            # Drop a copy stored before a shard was added
+            for other in self.shards:
+                if other is not shard and other.call('exists', label):
+                    other.call('del_stream', label)
+            return result
+        if method == 'list_labels':
+            return self._list_labels(*args, **kwargs)
+        if method == 'mark_verified':
+            labels = args[0]
+            by_shard = {}
+            for label in labels:
+                by_shard.setdefault(self.locate(label), []).append(label)
+            for shard, shard_labels in by_shard.items():
+                shard.call(method, shard_labels, *args[1:], **kwargs)
+            return
+        # Bucket wide maintenance such as sweep_parts runs on every shard
+        return [shard.call(method, *args, **kwargs) for shard in self.shards]
+
+    def _list_labels(self, after=None, limit=None):
+        labels = []
+        for label in merge(*[
+                shard.call('list_labels', after=after, limit=limit) or []
+                for shard in self.shards]):
+            # A label being moved may be on two shards
+            if labels and labels[-1] == label:
+                continue
+            labels.append(label)
+            if limit and len(labels) >= limit:
+                break
+        return labels
+
+
+class OFSEngine(object):
+    """Process-wide holder of the OFSWrapper shared by all requests.
+
+    The PTOFS is built on first use instead of once per request. A forked
+    worker builds its own so that lock state is never shared with the parent.
+
+    """
+    def __init__(self, **kwargs):
+        self.kwargs = kwargs
+        self._lock = Lock()
+        self._pid = None
+        self._wrapper = None
+
+    def get(self):
+        pid = os.getpid()
+        if self._pid != pid:
+            with self._lock:
+                if self._pid != pid:
+                    if 'storage_dirs' in self.kwargs:
+                        self._wrapper = ShardedOFSWrapper(**self.kwargs)
+                    else:
+                        self._wrapper = OFSWrapper(**self.kwargs)
+                    self._pid = pid
+        return self._wrapper
 
 
 def get_ofs():
-    ofs = getattr(g, '_ofs', None)
-    if ofs is None:
-        ofs = g._ofs = OFSWrapper(storage_dir=current_app.config['PTOFS_DIR'])
-    return ofs
+    return current_app.extensions['tagstore_ofs'].get()
 
 
 ofs = LocalProxy(get_ofs)
 
 
+def get_uploads():
+    return current_app.extensions['tagstore_uploads']
+
+
+uploads = LocalProxy(get_uploads)
+
+
+def get_tagindex():
+    return current_app.extensions['tagstore_tagindex']
+
+
+tagindex = LocalProxy(get_tagindex)
+
+
+def get_counts():
+    return current_app.extensions['tagstore_counts']
+
+
+counts = LocalProxy(get_counts)
+
+
+def get_tag_id_cache():
+    return current_app.extensions['tagstore_tag_ids']
+
+
+tag_id_cache = LocalProxy(get_tag_id_cache)
+
+
+def forget_tags():
+    """Have the tag id cache of every process cleared once the current
+    transaction, which renames or deletes tags, commits.
+
+    """
+    begin_tag_generation(db.session)
+
+
 api_v1_prefix = '/api/v1'
 
 
 def replace_existing_tags(data):
-    """Replace any existing tags with the tag id."""
+    """Replace any existing tags with the tag id.
+
+    Ids are taken from the tag id cache, so the tags table is only queried
+    for tags not seen lately.
+
+    """
     try:
         tags = data['tags']
-        new_tags = [tag['tag'] for tag in tags]
-        old_tags = Tag.query.filter(Tag.tag.in_(new_tags)).all()
-        old_tag_ids = {}
-        for tag in old_tags:
-            old_tag_ids[tag.tag] = tag.id
+        new_tags = set(tag['tag'] for tag in tags)
+        old_tag_ids = cached_tag_ids(db.session, new_tags, tag_id_cache)
+        missing = new_tags.difference(old_tag_ids)
+        if missing:
+            for tag in Tag.query.filter(Tag.tag.in_(missing)):
+                old_tag_ids[tag.tag] = tag.id
+                tag_id_cache.set(tag.tag, tag.id)
         for tag in tags:
             ttt = tag['tag']
             if ttt in old_tag_ids:
@@ -107,6 +341,65 @@ def is_uri_present_for_data(data):
     return False
 
 
+def data_search(search_params=None, **kw):
+    """Query the tags of Data by sets rather than row by row."""
+    rewrite_filters(search_params)
+
+
+def _pages_by_cursor(search_params):
+    """Whether the search can be paged by cursor: restless orders it by id, as
+    it does by default, and it has no limit or offset that the cursor's
+    filter would apply again on every page.
+
+    """
+    order_by = search_params.get('order_by')
+    if order_by and order_by != [dict(field='id', direction='asc')]:
+        return False
+    return search_params.get('limit') is None and \
+        search_params.get('offset') is None
+
+
+def encode_cursor(last_id):
+    return urlsafe_b64encode(str(last_id))
+
+
+def decode_cursor(token):
+    try:
+        return int(urlsafe_b64decode(str(token)))
+    except (TypeError, ValueError):
+        raise ProcessingException(description='Invalid after', code=400)
+
+
+def page_after(search_params=None, **kw):
+    """Page from the after argument, the next token of the previous page.
+
+    Unlike page numbers, which restless turns into an OFFSET, the token
+    restricts the search to ids after the last one seen so that deep pages
+    cost no more than the first.
+
+    """
+    token = request.args.get('after')
+    if token is None:
+        return
+    if not _pages_by_cursor(search_params):
+        raise ProcessingException(
+            description='after only pages results in id order without a '
+                        'limit or offset', code=400)
+    search_params.setdefault('filters', []).append(
+        dict(name='id', op='gt', val=decode_cursor(token)))
+
+
+def next_cursor(result=None, search_params=None, **kw):
+    """Give pages that have more after them a next token if the search can be
+    paged by cursor.
+
+    """
+    objects = result.get('objects')
+    if objects and result['page'] < result['total_pages'] and \
+            _pages_by_cursor(search_params or {}):
+        result['next'] = encode_cursor(objects[-1]['id'])
+
+
 def data_post(data=None, **kw):
     if is_uri_present_for_data(data):
         raise ProcessingException(description='Already present', code=409)
@@ -114,29 +407,69 @@ def data_post(data=None, **kw):
     replace_existing_tags(data)
 
 
-class TagPatchSingle(object):
-    new_tag = None
-
-    @classmethod
-    def pre(cls, instance_id=None, data=None, **kw):
-        tag = Tag.query.filter_by(tag=data['tag']).first()
-        if tag:
-            # The "new" tag is really replacing with a preexisting tag.
-            tags.update().where(
-                tags.c.tag_id == instance_id).values(tag_id=tag.id)
-            data['tag'] = 'newtag{0}'.format(tag.id)
-            cls.new_tag = tag.id
-
-    @classmethod
-    def post(cls, result=None, **kw):
-        if cls.new_tag != None:
-            tag = Tag.query.get(result['id'])
-            db.session.delete(tag)
-            db.session.commit()
-            newtag = Tag.query.get(cls.new_tag)
-            result['id'] = newtag.id
-            result['tag'] = newtag.tag
-            cls.new_tag = None
+def retag(old_id, new_id, data_ids=None):
+    """Move the tag old_id to the tag new_id on the Data in data_ids, a select
+    of their ids, or on all Data, in the current transaction.
+
+    One UPDATE of the tags table moves the tag on the Data without the new
+    one and a DELETE removes it from the rest. If the tag index is enabled,
+    the pairs touched are logged for it by INSERT ... SELECT first.
+
+    Returns the number of Data retagged.
+
+    """
+    retagged = tags.c.tag_id == old_id
+    if data_ids is not None:
+        retagged = and_(retagged, tags.c.data_id.in_(data_ids))
+    if logs_changes(db.session):
+        changes = TagChange.__table__.insert()
+        for tag_id in (new_id, old_id):
+            db.session.execute(changes.from_select(
+                ['data_id', 'tag_id'],
+                select([tags.c.data_id, literal(tag_id)]).where(
+                    retagged).where(tags.c.data_id != None)))
+    tagged_new = tags.alias()
+    num_results = db.session.execute(tags.update().where(retagged).where(
+        ~tags.c.data_id.in_(select([tagged_new.c.data_id]).where(
+            tagged_new.c.tag_id == new_id).where(
+            tagged_new.c.data_id != None))).values(tag_id=new_id)).rowcount
+    num_results += db.session.execute(
+        tags.delete().where(retagged)).rowcount
+    return num_results
+
+
+def merge_tags(old_id, new_id):
+    """Merge the tag old_id into the tag new_id and delete it, in the
+    current transaction.
+
+    Returns the number of Data that had the old tag.
+
+    """
+    # Nothing may be tagged with old_id while it is merged
+    db.session.query(Tag.id).filter(
+        Tag.id.in_([old_id, new_id])).with_for_update().all()
+    num_results = retag(old_id, new_id)
+    db.session.execute(Tag.__table__.delete().where(Tag.id == old_id))
+    return num_results
+
+
+def tag_patch_single(instance_id=None, data=None, **kw):
+    """Rename the tag, merging it into the tag that already has the new name
+    if there is one.
+
+    Restless then answers with the tag merged into, as the preprocessor
+    returns its id, and commits the merge with the rest of the request.
+
+    """
+    tag = Tag.query.get(instance_id)
+    if tag is None:
+        # Left for restless to answer 404
+        return
+    forget_tags()
+    existing = Tag.query.filter_by(tag=data.get('tag')).first()
+    if existing is not None and existing.id != tag.id:
+        merge_tags(tag.id, existing.id)
+        return existing.id
 
 
 def tag_delete(instance_id=None, **kw):
@@ -144,12 +477,18 @@ def tag_delete(instance_id=None, **kw):
         tags.c.tag_id == instance_id).count()
     if any_referencing:
         raise ProcessingException(description='Tag is referenced', code=409)
+    forget_tags()
 
 
 def _is_local_ofs(ofs_endpoint, uri):
     return uri.startswith(ofs_endpoint)
 
 
+# Remote blobs are archived as they are, not as the server may have encoded
+# them for transfer
+IDENTITY_ENCODING = {'Accept-Encoding': 'identity'}
+
+
 zip_blueprint = Blueprint('zip', __name__, )
 
 
@@ -170,7 +509,8 @@ class DataWrapper(FileWrapper):
             stream = ofs.call('get_stream', self.uri)
         else:
             try:
-                stream = requests.get(self.uri, stream=True).raw
+                stream = requests.get(self.uri, stream=True,
+                                      headers=IDENTITY_ENCODING).raw
             except requests.exceptions.RequestException:
                 return None
         return stream
@@ -181,7 +521,7 @@ class DataWrapper(FileWrapper):
             content_len = metadata['_content_length']
         else:
             try:
-                resp = requests.head(self.uri)
+                resp = requests.head(self.uri, headers=IDENTITY_ENCODING)
             except requests.exceptions.RequestException:
                 content_len = 0
             else:
@@ -189,8 +529,9 @@ class DataWrapper(FileWrapper):
         return content_len
 
 
-@zip_blueprint.route('{0}/zip'.format(api_v1_prefix), methods=['POST'])
-def zip():
+@zip_blueprint.route('{0}/zip'.format(api_v1_prefix), methods=['POST'],
+                     endpoint='zip')
+def zip_data():
     json = request.get_json()
     ofs_endpoint = json['ofs_endpoint']
     wrappers = []
@@ -208,20 +549,555 @@ def zip():
     return response
 
 
+query_blueprint = Blueprint('query', __name__, )
+
+
+def serialize_data(query, start=None, stop=None):
+    """Dicts of the Data selected by query, from start to stop, as restless
+    gives them.
+
+    They are built from rows rather than instances and the tags of all of
+    them are loaded by one query instead of one per Data.
+
+    """
+    data_columns = sqlalchemy_inspect(Data).column_attrs.keys()
+    tag_columns = sqlalchemy_inspect(Tag).column_attrs.keys()
+    rows = query.with_entities(
+        *[getattr(Data, column) for column in data_columns]).slice(
+        start, stop)
+    objects = []
+    data_tags = {}
+    for row in rows:
+        datum = dict(izip(data_columns, row))
+        datum['tags'] = data_tags[datum['id']] = []
+        objects.append(datum)
+    for chunk in chunks(data_tags):
+        rows = db.session.query(
+            tags.c.data_id, *[getattr(Tag, column) for column in tag_columns]
+        ).join(Tag, Tag.id == tags.c.tag_id).filter(
+            tags.c.data_id.in_(chunk))
+        for row in rows:
+            data_tags[row[0]].append(dict(izip(tag_columns, row[1:])))
+    return objects
+
+
+patch.restless.SERIALIZERS[Data] = serialize_data
+
+
+def data_upsert(data, on_conflict):
+    """POST /data with the on_conflict argument, see upsert.ON_CONFLICT.
+
+    The Data and its tags are written without first looking for its URI, so
+    that concurrent posts of the same URI settle in the database rather than
+    by failing.
+
+    """
+    (uri, fname, tag_names), = _data_records([data])
+    try:
+        data_id, created = upsert_data(db.session, uri, fname, tag_names,
+                                       on_conflict, tag_id_cache)
+        db.session.commit()
+    except Exception:
+        db.session.rollback()
+        raise
+    return serialize_data(Data.query.filter(Data.id == data_id))[0], created
+
+
+patch.restless.UPSERTS[Data] = data_upsert
+
+
+@query_blueprint.route('{0}/data/tagquery'.format(api_v1_prefix),
+                       methods=['GET'])
+def data_tagquery():
+    """Data matching a boolean query on their tags, answered from the tag
+    index. See TagIndex.evaluate() for the q format.
+
+    Results are paged as restless pages them, in id order.
+
+    """
+    if not current_app.config['TAGINDEX_ENABLED']:
+        abort(404)
+    max_results_per_page = current_app.config['MAX_RESULTS_PER_PAGE_DATA']
+    try:
+        query = json.loads(request.args['q'])
+        page = int(request.args.get('page', 1))
+        results_per_page = int(request.args.get('results_per_page', 10))
+    except (KeyError, ValueError):
+        abort(400)
+    if page < 1 or results_per_page < 1:
+        abort(400)
+    results_per_page = min(results_per_page, max_results_per_page)
+
+    tagindex.sync()
+    try:
+        matches = tagindex.evaluate(query)
+    except QueryError as err:
+        resp = jsonify(dict(message=unicode(err)))
+        resp.status_code = 400
+        return resp
+    num_results = len(matches)
+    start = (page - 1) * results_per_page
+    ids = matches.slice(start, start + results_per_page)
+    objects = []
+    if ids:
+        objects = serialize_data(
+            Data.query.filter(Data.id.in_(ids)).order_by(Data.id))
+    total_pages = max(1, -(-num_results // results_per_page))
+    return jsonify(dict(num_results=num_results, page=page,
+                        total_pages=total_pages, objects=objects,
+                        more=page < total_pages))
+
+
+@query_blueprint.route('{0}/tags/keys'.format(api_v1_prefix),
+                       methods=['GET'])
+def tag_keys():
+    """Keys of key:value tags and how many tags have each, optionally only
+    the keys starting with the prefix argument.
+
+    """
+    query = db.session.query(Tag.key, func.count(Tag.id)).filter(
+        Tag.key != None)
+    prefix = request.args.get('prefix')
+    if prefix:
+        query = query.filter(startswith(Tag.key, prefix))
+    query = query.group_by(Tag.key).order_by(Tag.key)
+    return jsonify(dict(objects=[dict(key=key, num_tags=count)
+                                 for key, count in query]))
+
+
+def _count(model, preprocessors=()):
+    """Count the results of the search in the q argument, caching the count
+    for COUNT_CACHE_TTL seconds.
+
+    """
+    try:
+        search_params = json.loads(request.args.get('q', '{}'))
+    except ValueError:
+        abort(400)
+    if not isinstance(search_params, dict):
+        abort(400)
+    key = (model.__name__, json.dumps(search_params, sort_keys=True))
+    count = counts.get(key)
+    if count is None:
+        try:
+            for preprocessor in preprocessors:
+                preprocessor(search_params=search_params)
+            query = create_query(db.session, model, search_params,
+                                 _ignore_order_by=True)
+            count = query.count()
+        except Exception as err:
+            log.info(u'Unable to count {0}: {1!r}'.format(key, err))
+            abort(400)
+        counts.set(key, count)
+    return jsonify(dict(num_results=count))
+
+
+@query_blueprint.route('{0}/data/count'.format(api_v1_prefix),
+                       methods=['GET'])
+def data_count():
+    """Number of Data matching the q argument, for pages fetched with
+    count=false.
+
+    """
+    return _count(Data, [data_search])
+
+
+@query_blueprint.route('{0}/tags/count'.format(api_v1_prefix),
+                       methods=['GET'])
+def tags_count():
+    """Number of Tags matching the q argument."""
+    return _count(Tag)
+
+
+@query_blueprint.route('{0}/caches'.format(api_v1_prefix), methods=['GET'])
+def cache_stats():
+    """Sizes and hit rates of the caches of this process."""
+    return jsonify(dict(counts=counts.stats(), tag_ids=tag_id_cache.stats(),
+                        ofs_metadata=_ofs_metadata_cache_stats()))
+
+
+def _ofs_metadata_cache_stats():
+    """Stats of the OFS metadata caches of all shards together, or None if
+    metadata is not cached.
+
+    """
+    caches = [shard.ofs.metadata.cache for shard in ofs.shards
+              if isinstance(shard.ofs.metadata, CachedMetadata)]
+    if not caches:
+        return None
+    stats = dict(hits=0, misses=0, size=0, maxsize=0)
+    for cache in caches:
+        for key, value in cache.stats().items():
+            if key in stats:
+                stats[key] += value
+    lookups = stats['hits'] + stats['misses']
+    stats['hit_rate'] = None
+    if lookups:
+        stats['hit_rate'] = float(stats['hits']) / lookups
+    return stats
+
+
+bulk_blueprint = Blueprint('bulk', __name__, )
+
+
+def _data_records(objects):
+    """(uri, fname, tags) of the Data in objects, given as restless would
+    take them.
+
+    """
+    if not isinstance(objects, list):
+        raise ValueError(u'objects must be a list')
+    records = []
+    for obj in objects:
+        try:
+            uri = obj['uri']
+            fname = obj.get('fname')
+            tag_names = [tag['tag'] for tag in obj.get('tags') or []]
+        except (KeyError, TypeError, AttributeError):
+            raise ValueError(u'Invalid datum {0!r}'.format(obj))
+        if not isinstance(uri, basestring) or \
+                not isinstance(fname, (basestring, type(None))) or \
+                not all(isinstance(name, basestring) for name in tag_names):
+            raise ValueError(u'Invalid datum {0!r}'.format(obj))
+        records.append((uri, fname, tag_names))
+    return records
+
+
+@bulk_blueprint.route('{0}/data/bulk'.format(api_v1_prefix),
+                      methods=['POST'])
+def data_bulk_create():
+    """Create the Data in the objects of the JSON body in one transaction.
+
+    The tags of all of them are resolved at once and the Data and their tags
+    inserted MAX_IN_PARAMS at a time. Data whose URI is already present,
+    including earlier in the same request, are skipped.
+
+    Responds with the ids of the new Data in order, null for those skipped.
+
+    """
+    try:
+        records = _data_records((request.get_json(force=True) or {}).get(
+            'objects'))
+    except (ValueError, AttributeError) as err:
+        resp = jsonify(dict(message=unicode(err)))
+        resp.status_code = 400
+        return resp
+    if len(records) > current_app.config['MAX_BULK_DATA']:
+        abort(413)
+
+    try:
+        present = set()
+        for chunk in chunks(set(uri for uri, _, _ in records)):
+            present.update(uri for uri, in db.session.query(Data.uri).filter(
+                Data.uri.in_(chunk)))
+        new = []
+        for uri, fname, tag_names in records:
+            if uri in present:
+                new.append(None)
+            else:
+                present.add(uri)
+                new.append((uri, fname, set(tag_names)))
+        tag_ids = resolve_tags(db.session, (
+            name for record in new if record for name in record[2]),
+            tag_id_cache)
+
+        data_ids = {}
+        changes = set()
+        for batch in chunks([record for record in new if record]):
+            db.session.execute(Data.__table__.insert(), [
+                dict(uri=uri, fname=fname) for uri, fname, _ in batch])
+            data_ids.update(db.session.query(Data.uri, Data.id).filter(
+                Data.uri.in_([uri for uri, _, _ in batch])))
+            associations = []
+            for uri, _, tag_names in batch:
+                data_id = data_ids[uri]
+                changes.add((data_id, None))
+                for name in tag_names:
+                    associations.append(
+                        dict(data_id=data_id, tag_id=tag_ids[name]))
+                    changes.add((data_id, tag_ids[name]))
+            if associations:
+                db.session.execute(tags.insert(), associations)
+        log_changes(db.session, changes)
+        db.session.commit()
+    except IntegrityError as err:
+        # Raced with another writer
+        db.session.rollback()
+        log.info(u'Unable to create data in bulk: {0!r}'.format(err))
+        abort(409)
+    except Exception:
+        db.session.rollback()
+        raise
+
+    ids = [data_ids[record[0]] if record else None for record in new]
+    resp = jsonify(dict(ids=ids, num_created=len(data_ids)))
+    resp.status_code = 201
+    return resp
+
+
+def _searched_data_ids(search_params):
+    """Select of the ids of the Data matching restless search_params, or
+    None if they match every Data.
+
+    """
+    if not any(search_params.get(key)
+               for key in ('filters', 'limit', 'offset')):
+        return None
+    data_search(search_params=search_params)
+    searched = create_query(db.session, Data, search_params,
+                            _ignore_order_by=True).with_entities(
+        Data.id).subquery()
+    return select([searched.c.id])
+
+
+@bulk_blueprint.route('{0}/data/retag'.format(api_v1_prefix),
+                      methods=['POST'])
+def data_retag():
+    """Swap the tag old for the tag new on the Data matching q, given in the
+    JSON body as for GET /data, all of them if omitted, with retag().
+
+    Responds with the number of Data retagged.
+
+    """
+    body = request.get_json(force=True)
+    try:
+        old, new = body['old'], body['new']
+        search_params = body.get('q') or {}
+        if not isinstance(old, basestring) or \
+                not isinstance(new, basestring) or \
+                not isinstance(search_params, dict):
+            raise TypeError()
+    except (KeyError, TypeError, AttributeError):
+        abort(400)
+
+    old_id = db.session.query(Tag.id).filter(Tag.tag == old).scalar()
+    if old_id is None or old == new:
+        return jsonify(dict(num_results=0))
+
+    try:
+        try:
+            data_ids = _searched_data_ids(search_params)
+        except Exception as err:
+            log.info(u'Unable to search {0!r}: {1!r}'.format(
+                search_params, err))
+            abort(400)
+        new_id = resolve_tags(db.session, [new], tag_id_cache)[new]
+        num_results = retag(old_id, new_id, data_ids)
+        if num_results:
+            db.session.commit()
+        else:
+            # Not even the new tag
+            db.session.rollback()
+    except Exception:
+        db.session.rollback()
+        raise
+    return jsonify(dict(num_results=num_results))
+
+
+@bulk_blueprint.route('{0}/tags/<int:tag_id>/merge'.format(api_v1_prefix),
+                      methods=['POST'])
+def tag_merge(tag_id):
+    """Merge the tag into the tag with the id given as into in the JSON body
+    and delete it, in one transaction.
+
+    Responds with the tag merged into and the number of Data that had the
+    tag merged.
+
+    """
+    body = request.get_json(force=True)
+    try:
+        into = int(body['into'])
+    except (KeyError, TypeError, ValueError):
+        abort(400)
+    if into == tag_id:
+        abort(400)
+    tag = Tag.query.get_or_404(tag_id)
+    into = Tag.query.get_or_404(into)
+    result = dict(id=into.id, tag=into.tag)
+    try:
+        forget_tags()
+        result['num_results'] = merge_tags(tag.id, into.id)
+        db.session.commit()
+    except Exception:
+        db.session.rollback()
+        raise
+    return jsonify(result)
+
+
 store_blueprint = Blueprint('storage', __name__, )
 
 
+def _receive_blob(label):
+    """Stream an uploaded blob for label straight into the OFS.
+
+    A multipart body is parsed as it arrives and its blob file is written
+    directly beside its final location instead of being spooled by Werkzeug
+    first. A urlencoded body is a form without a blob, e.g. to rename it. Any
+    other body is the blob itself, named by the fname query argument.
+
+    Returns (form, writer, fname). writer is the uncommitted BlobWriter or None
+    if no blob was sent.
+
+    """
+    writers = []
+
+    def stream_factory(total_content_length, content_type, filename,
+                       content_length=None):
+        writer = ofs.call('open_blob', label, filename)
+        writers.append(writer)
+        return writer
+
+    blob = None
+    try:
+        if request.mimetype.startswith('multipart/'):
+            _, form, files = parse_form_data(
+                request.environ, stream_factory=stream_factory,
+                max_content_length=request.max_content_length)
+            try:
+                fobj = files['blob']
+            except KeyError:
+                fname = None
+            else:
+                blob = fobj.stream
+                fname = fobj.filename
+        elif request.mimetype == 'application/x-www-form-urlencoded':
+            form = request.form
+            fname = form.get('fname', '')
+        else:
+            form = request.args
+            fname = form.get('fname', '')
+            if request.content_length or \
+                    request.environ.get('wsgi.input_terminated'):
+                blob = stream_factory(None, None, fname)
+                copyfileobj(request.stream, blob, 2 ** 16)
+    except:
+        for writer in writers:
+            writer.abort()
+        raise
+    # Other files in the form are not stored
+    for writer in writers:
+        if writer is not blob:
+            writer.abort()
+    return form, blob, fname
+
+
+@store_blueprint.route('{0}/ofs'.format(api_v1_prefix), methods=['GET'])
+def ofs_info():
+    """Features of the OFS that clients may rely on.
+
+    dedup tells whether POST /ofs?sha256=<hex> may link known contents.
+
+    """
+    store = ofs.shards[0].ofs
+    return jsonify(dict(dedup=store.dedup, hashing_type=store.hashing_type))
+
+
 @store_blueprint.route('{0}/ofs'.format(api_v1_prefix), methods=['POST'])
 def ofs_create():
-    fobj = request.files['blob']
     label = str(uuid4())
-    ofs.call('put_stream', label, fobj)
-    fname = fobj.filename
-    ofs.call('update_metadata', label, {'fname': fname})
-    return jsonify(dict(uri='{0}/{1}'.format(request.url, label), fname=fname))
+    checksum = request.args.get('sha256')
+    if checksum is not None and not request.content_length:
+        # Probe for contents that are already stored
+        fname = request.args.get('fname', '')
+        if not ofs.call('link_blob', label, 'sha256:{0}'.format(checksum),
+                        {'fname': fname}):
+            abort(404)
+        return jsonify(dict(uri='{0}/{1}'.format(request.base_url, label),
+                            fname=fname))
+    _, blob, fname = _receive_blob(label)
+    if blob is None:
+        abort(400)
+    ofs.call('commit_blob', blob, {'fname': fname})
+    return jsonify(dict(uri='{0}/{1}'.format(request.base_url, label),
+                        fname=fname))
+
+
+def _get_upload_session(session_id):
+    try:
+        return uploads.get(session_id)
+    except KeyError:
+        abort(404)
+
+
+@store_blueprint.route('{0}/ofs/uploads'.format(api_v1_prefix),
+                       methods=['POST'])
+def ofs_upload_create():
+    """Start a resumable upload of a blob of size bytes in chunks."""
+    json = request.get_json(force=True, silent=True) or {}
+    try:
+        size = int(json['size'])
+        chunk_size = int(json['chunk_size'])
+    except (KeyError, TypeError, ValueError):
+        abort(400)
+    if chunk_size > current_app.config['OFS_UPLOAD_MAX_CHUNK_SIZE']:
+        abort(413)
+    try:
+        session = uploads.create(size, chunk_size, json.get('fname'))
+    except ValueError as err:
+        return make_response(unicode(err), 400)
+    resp = jsonify(session.to_dict())
+    resp.status_code = 201
+    resp.headers['Location'] = '{0}/{1}'.format(request.url, session.id)
+    return resp
+
+
+@store_blueprint.route('{0}/ofs/uploads/<session_id>'.format(api_v1_prefix),
+                       methods=['GET', 'DELETE'])
+def ofs_upload(session_id):
+    session = _get_upload_session(session_id)
+    if request.method == 'DELETE':
+        session.remove()
+        return make_response('', 204)
+    return jsonify(session.to_dict())
+
 
+@store_blueprint.route(
+    '{0}/ofs/uploads/<session_id>/<int:index>'.format(api_v1_prefix),
+    methods=['PUT'])
+def ofs_upload_chunk(session_id, index):
+    """Store chunk index of the upload. Chunks may be sent again."""
+    session = _get_upload_session(session_id)
+    try:
+        session.write_chunk(index, request.stream)
+    except ChunkError as err:
+        return make_response(unicode(err), 400)
+    return make_response('', 204)
+
+
+@store_blueprint.route(
+    '{0}/ofs/uploads/<session_id>/commit'.format(api_v1_prefix),
+    methods=['POST'])
+def ofs_upload_commit(session_id):
+    """Store the uploaded blob as label, a new one unless given."""
+    session = _get_upload_session(session_id)
+    json = request.get_json(force=True, silent=True) or {}
+    missing = session.missing()
+    if missing:
+        resp = jsonify(dict(missing=missing))
+        resp.status_code = 409
+        return resp
+    label = json.get('label') or str(uuid4())
+    if '/' in label or label.startswith('.'):
+        abort(400)
+    fname = json.get('fname') or session.fname or ''
+    writer = ofs.call('open_blob', label, fname)
+    try:
+        writer.adopt(session.blob_path)
+    except (IOError, OSError):
+        # Committed concurrently
+        writer.abort()
+        abort(409)
+    except:
+        writer.abort()
+        raise
+    ofs.call('commit_blob', writer, {'fname': fname})
+    session.remove()
+    return jsonify(dict(
+        uri=url_for('.ofs_get', label=label, _external=True), fname=fname))
 
-def _update_http_headers(headers, metadata, as_attachment=False):
+
+def _update_http_headers(headers, metadata, as_attachment=False,
+                         encoding=None):
     fname = metadata.get('fname', '')
     disposition = 'inline'
     if as_attachment:
@@ -236,6 +1112,191 @@ def _update_http_headers(headers, metadata, as_attachment=False):
         headers['Content-Length'] = metadata['_content_length']
     except KeyError:
         pass
+    headers['Accept-Ranges'] = 'bytes'
+    if '_encoding' in metadata:
+        headers['Vary'] = 'Accept-Encoding'
+    if encoding is not None:
+        headers['Content-Encoding'] = encoding
+    etag, last_modified = _validators(metadata)
+    if etag is not None:
+        headers['ETag'] = quote_etag(etag)
+    if last_modified is not None:
+        headers['Last-Modified'] = http_date(last_modified)
+
+
+def _representation(metadata):
+    """Return the metadata of the body to send for a blob and its encoding.
+
+    A blob stored compressed is sent as stored, with its Content-Encoding, if
+    the client accepts that encoding, and decoded otherwise. The encoding is
+    None if the blob is sent decoded. The stored bytes have their own length
+    and ETag.
+
+    """
+    encoding = metadata.get('_encoding')
+    if encoding is None or not request.accept_encodings[encoding]:
+        return metadata, None
+    stored = dict(metadata)
+    stored['_content_length'] = metadata['_stored_length']
+    if '_checksum' in metadata:
+        stored['_checksum'] = '{0}-{1}'.format(metadata['_checksum'], encoding)
+    return stored, encoding
+
+
+def _validators(metadata):
+    """Return the strong ETag and UTC Last-Modified of a blob.
+
+    The ETag is the checksum PTOFS recorded when the blob was stored. Either
+    may be None for blobs stored without them.
+
+    """
+    etag = None
+    checksum = metadata.get('_checksum')
+    if checksum:
+        etag = checksum.split(':', 1)[-1]
+    last_modified = None
+    try:
+        local = datetime.strptime(
+            metadata['_last_modified'], '%Y-%m-%dT%H:%M:%S')
+    except (KeyError, ValueError):
+        pass
+    else:
+        # PTOFS records local time
+        last_modified = datetime.utcfromtimestamp(mktime(local.timetuple()))
+    return etag, last_modified
+
+
+def _not_modified(metadata):
+    """Whether the client's copy is current per If-None-Match or
+    If-Modified-Since."""
+    etag, last_modified = _validators(metadata)
+    if 'If-None-Match' in request.headers:
+        return etag is not None and request.if_none_match.contains_weak(etag)
+    since = request.if_modified_since
+    if since is not None and last_modified is not None:
+        return last_modified <= since
+    return False
+
+
+def _not_modified_response(metadata):
+    resp = Response(status=304)
+    etag, last_modified = _validators(metadata)
+    if etag is not None:
+        resp.headers['ETag'] = quote_etag(etag)
+    if last_modified is not None:
+        resp.headers['Last-Modified'] = http_date(last_modified)
+    return resp
+
+
+def _if_range_matches(metadata):
+    """Whether the If-Range validator matches the current blob.
+
+    ETags are compared strongly and dates exactly.
+
+    """
+    etag, last_modified = _validators(metadata)
+    if_range = request.if_range
+    if if_range.etag is not None:
+        if request.headers['If-Range'].startswith('W/'):
+            return False
+        return etag is not None and if_range.etag == etag
+    if if_range.date is not None:
+        return last_modified is not None and if_range.date == last_modified
+    return False
+
+
+def _iter_range(stream, start, length, chunk_size=2 ** 16):
+    """Yield length bytes of stream starting at start, then close it."""
+    try:
+        stream.seek(start)
+        while length > 0:
+            chunk = stream.read(min(chunk_size, length))
+            if not chunk:
+                break
+            length -= len(chunk)
+            yield chunk
+    finally:
+        stream.close()
+
+
+def _requested_range(metadata, length):
+    """Return the single byte range requested as (start, stop).
+
+    Returns None to send the whole blob, which is allowed for any Range
+    request. Only single byte ranges are served and only if an If-Range
+    validator still matches. Aborts with 416 if the range is outside the
+    blob.
+
+    """
+    rng = request.range
+    if rng is None:
+        return None
+    if 'If-Range' in request.headers and not _if_range_matches(metadata):
+        return None
+    if rng.units != 'bytes' or len(rng.ranges) != 1:
+        return None
+    byte_range = rng.range_for_length(length)
+    if byte_range is None:
+        abort(Response(status=416, headers={
+            'Content-Range': 'bytes */{0}'.format(length)}))
+    return byte_range
+
+
+def _send_blob(label, metadata, as_attachment, encoding=None):
+    """Respond with the blob for label, honouring byte ranges.
+
+    With OFS_SENDFILE set the front end server is asked to send the file
+    with X-Sendfile or X-Accel-Redirect (which also handle ranges), unless it
+    is stored compressed. Otherwise whole blobs go through wsgi.file_wrapper
+    so that servers supporting it can use sendfile.
+
+    encoding is that of the stored bytes to send as they are, see
+    _representation().
+
+    """
+    sendfile = current_app.config['OFS_SENDFILE']
+    if sendfile and '_encoding' not in metadata:
+        shard = ofs.locate(label)
+        path = os.path.abspath(shard.call('get_path', label))
+        resp = Response(None, direct_passthrough=True)
+        _update_http_headers(resp.headers, metadata, as_attachment)
+        if sendfile == 'x-accel-redirect':
+            relpath = os.path.relpath(
+                path, os.path.abspath(shard.ofs.storage_dir))
+            prefix = current_app.config['OFS_ACCEL_REDIRECT_PREFIX'].rstrip('/')
+            if shard.shard_index is not None:
+                prefix = '{0}/{1}'.format(prefix, shard.shard_index)
+            resp.headers['X-Accel-Redirect'] = '{0}/{1}'.format(
+                prefix, quote(relpath))
+        else:
+            resp.headers['X-Sendfile'] = path
+        return resp
+
+    stream = ofs.call('get_stream', label, decode=encoding is None)
+    try:
+        length = metadata['_content_length']
+    except KeyError:
+        length = os.fstat(stream.fileno()).st_size
+    try:
+        byte_range = _requested_range(metadata, length)
+    except:
+        stream.close()
+        raise
+    if byte_range is None:
+        resp = Response(wrap_file(request.environ, stream),
+                        direct_passthrough=True)
+        _update_http_headers(resp.headers, metadata, as_attachment, encoding)
+        resp.headers['Content-Length'] = length
+        return resp
+
+    start, stop = byte_range
+    resp = Response(_iter_range(stream, start, stop - start), 206,
+                    direct_passthrough=True)
+    _update_http_headers(resp.headers, metadata, as_attachment, encoding)
+    resp.headers['Content-Length'] = stop - start
+    resp.headers['Content-Range'] = request.range.make_content_range(
+        length).to_header()
+    return resp
 
 
 @store_blueprint.route('{0}/ofs/<label>'.format(api_v1_prefix),
@@ -243,41 +1304,41 @@ def _update_http_headers(headers, metadata, as_attachment=False):
 def ofs_get(label):
     as_attachment = request.headers.get('X-As-Attachment', 'no') == 'yes'
     if request.method == 'HEAD':
-        metadata = ofs.call('get_metadata', label)
+        metadata, encoding = _representation(
+            ofs.call('get_metadata', label))
+        if _not_modified(metadata):
+            return _not_modified_response(metadata)
         headers = {}
-        _update_http_headers(headers, metadata, as_attachment)
+        _update_http_headers(headers, metadata, as_attachment, encoding)
         response = Response()
         response.headers.extend(headers)
         return response
     elif request.method == 'GET':
+        if not ofs.call('exists', label):
+            abort(404)
         try:
-            stream = ofs.call('get_stream', label)
+            metadata = ofs.call('get_metadata', label)
         except Exception as err:
+            abort(500)
+        metadata, encoding = _representation(metadata)
+        # Answered from metadata alone, without opening the blob
+        if _not_modified(metadata):
+            return _not_modified_response(metadata)
+        try:
+            return _send_blob(label, metadata, as_attachment, encoding)
+        except FileNotFoundException:
             abort(404)
-        else:
-            try:
-                metadata = ofs.call('get_metadata', label)
-            except Exception as err:
-                abort(500)
-            else:
-                # Flask converts the filename to an absolute path by prepending
-                # the app directory which is incorrect. This is only used to add
-                # etags, so just turn that off.
-                resp = send_file(stream, add_etags=False)
-                _update_http_headers(resp.headers, metadata, as_attachment)
-                return resp
     elif request.method == 'PUT':
+        form, blob, _ = _receive_blob(label)
+        params = {}
         try:
-            fname = request.form['fname']
+            params['fname'] = form['fname']
         except KeyError:
             pass
-        else:
-            params = {'fname': fname}
+        if blob is not None:
+            ofs.call('commit_blob', blob, params)
+        elif params:
             ofs.call('update_metadata', label, params)
-
-        if request.files:
-            fobj = request.files['blob']
-            ofs.call('put_stream', label, fobj)
         return make_response('', 200)
     elif request.method == 'DELETE':
         try:
@@ -288,57 +1349,90 @@ def ofs_get(label):
 
 
 def gc_ofs():
-    local_data = Data.query.filter(Data.uri.like('%/api/%/ofs/%')).all()
-    present_labels = set([os.path.basename(ddd.uri) for ddd in local_data])
-    for label in ofs.call('list_labels'):
-        meta = ofs.call('get_metadata', label)
-        mtime = datetime.strptime(meta['_last_modified'], '%Y-%m-%dT%H:%M:%S')
-        grace_time = datetime.now() - timedelta(seconds=60)
-        # Still within the grace period
-        if mtime >= grace_time:
-            continue
-        if label in present_labels:
-            continue
-        ofs.call('del_stream', label)
+    """Delete OFS blobs that no Data refers to. See ofsgc.collect()."""
+    collect(ofs)
+    uploads.expire(current_app.config['OFS_UPLOAD_EXPIRY'])
 
 
 def init_app(app):
     with app.app_context():
         db.init_app(app)
 
+    if app.config['PTOFS_DIRS']:
+        storage_kwargs = dict(storage_dirs=app.config['PTOFS_DIRS'])
+    else:
+        storage_kwargs = dict(storage_dir=app.config['PTOFS_DIR'])
+    app.extensions['tagstore_ofs'] = OFSEngine(
+        metadata=app.config['PTOFS_METADATA'],
+        metadata_cache_size=app.config['OFS_METADATA_CACHE_SIZE'],
+        metadata_cache_ttl=app.config['OFS_METADATA_CACHE_TTL'],
+        dedup=app.config['OFS_DEDUP'],
+        compression=app.config['OFS_COMPRESSION'],
+        compress_min_size=app.config['OFS_COMPRESS_MIN_SIZE'],
+        compress_types=app.config['OFS_COMPRESS_TYPES'],
+        lock_class=LOCK_BACKENDS[app.config['OFS_LOCK']],
+        **storage_kwargs)
+    app.extensions['tagstore_uploads'] = UploadSessions(
+        app.config['OFS_UPLOAD_DIR'] or app.config['PTOFS_DIR'] + '.uploads',
+        app.config['OFS_UPLOAD_MAX_CHUNKS'])
+    if app.config['TAGINDEX_ENABLED']:
+        app.extensions['tagstore_tagindex'] = TagIndex(
+            app.config['TAGINDEX_SNAPSHOT'])
+        log_tag_changes(app)
+    app.extensions['tagstore_counts'] = LRUCache(
+        app.config['COUNT_CACHE_SIZE'], app.config['COUNT_CACHE_TTL'])
+    app.extensions['tagstore_tag_ids'] = GenerationalLRUCache(
+        app.config['TAG_ID_CACHE_SIZE'], app.config['TAG_ID_CACHE_TTL'])
+
     app.register_blueprint(zip_blueprint)
+    app.register_blueprint(query_blueprint)
+    app.register_blueprint(bulk_blueprint)
     app.register_blueprint(store_blueprint)
 
     manager = APIManager(app, flask_sqlalchemy_db=db)
     manager.create_api(Data, url_prefix=api_v1_prefix,
                        max_results_per_page=app.config['MAX_RESULTS_PER_PAGE_DATA'],
                        preprocessors={
+                           'GET_MANY': [data_search, page_after],
                            'PATCH_SINGLE': [data_patch_single],
+                           'PATCH_MANY': [data_search],
                            'POST': [data_post],
                        },
+                       postprocessors={
+                           'GET_MANY': [next_cursor],
+                       },
                        methods=['GET', 'POST', 'PUT', 'PATCH', 'DELETE'],
                        allow_patch_many=True)
     manager.create_api(Tag, url_prefix=api_v1_prefix,
                        max_results_per_page=app.config['MAX_RESULTS_PER_PAGE_TAG'],
                        preprocessors={
-                           'PATCH_SINGLE': [TagPatchSingle.pre],
-                           'DELETE': [tag_delete],
+                           'GET_MANY': [page_after],
+                           'PATCH_SINGLE': [tag_patch_single],
+                           'DELETE_SINGLE': [tag_delete],
                        },
                        postprocessors={
-                           'PATCH_SINGLE': [TagPatchSingle.post],
+                           'GET_MANY': [next_cursor],
                        },
                        methods=['GET', 'PUT', 'PATCH', 'DELETE'],
                        include_columns=['id', 'tag'],
                        collection_name='tags')
 
 
-if __name__ == "__main__":
-    import sys
+def create_app(config_path=None):
+    """Create the tagstore app configured by the file at config_path."""
     app = Flask(__name__)
     app.config.from_object('tagstore.settings.default')
+    if config_path is not None:
+        app.config.from_pyfile(os.path.abspath(config_path))
+    init_app(app)
+    return app
+
+
+if __name__ == "__main__":
+    import sys
     try:
-        app.config.from_pyfile(sys.argv[1])
+        config_path = sys.argv[1]
     except IndexError:
         raise IndexError(u'Please supply a configuration file.')
-    init_app(app)
+    app = create_app(config_path)
     app.run('0.0.0.0', processes=4)
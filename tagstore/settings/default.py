@@ -1,3 +1,62 @@
 PTOFS_DIR = 'tagstore-data'
+# Spread OFS blobs over these storage directories, e.g. one per volume, by
+# consistent hashing of their labels. Each has its own lock files. Run
+# tagstore-rebalance-ofs after adding one. Gc checkpoints stay in PTOFS_DIR and
+# upload sessions next to it.
+PTOFS_DIRS = []
+# flock or lockfile (for filesystems without flock support)
+OFS_LOCK = 'flock'
+# json (PTOFS persisted state) or sqlite. Run tagstore-migrate-ofs on an
+# existing PTOFS_DIR before switching to sqlite.
+PTOFS_METADATA = 'json'
+# Entries of OFS metadata cached per process (0 disables) and their lifetime
+# in seconds
+OFS_METADATA_CACHE_SIZE = 10000
+OFS_METADATA_CACHE_TTL = 60
+# Store blobs with identical contents once, as hard links to a shared copy
+OFS_DEDUP = False
+# Compress blobs at rest with gzip, bzip2 or xz (if lzma is available), or
+# not at all with None. Only blobs of at least OFS_COMPRESS_MIN_SIZE bytes
+# whose fname has a type starting with one of OFS_COMPRESS_TYPES, or that look
+# like text if their type is unknown, are compressed. Clients accepting the
+# encoding are sent the compressed bytes.
+OFS_COMPRESSION = None
+OFS_COMPRESS_MIN_SIZE = 4096
+OFS_COMPRESS_TYPES = ['text/', 'application/json', 'application/xml']
+# Answer GET /data/tagquery from an in-memory tag index. Writes to the tags
+# of Data are then logged to the tag_changes table for every process's index
+# to catch up with. Run tagstore-migrate-tag-changes on an existing database
+# before enabling it.
+TAGINDEX_ENABLED = False
+# Snapshot of the tag index to start from instead of the tags table, saved
+# by tagstore-tagindex
+TAGINDEX_SNAPSHOT = None
 MAX_RESULTS_PER_PAGE_DATA = 200
 MAX_RESULTS_PER_PAGE_TAG = 500
+# Counts of searches cached per process for /data/count and /tags/count and
+# their lifetime in seconds
+COUNT_CACHE_SIZE = 1000
+COUNT_CACHE_TTL = 60
+# Ids of tags cached per process by tag, so that Data are usually created
+# without looking up their tags. Renaming or deleting a tag begins a new
+# generation in the tag_generations table, which clears the caches of all
+# processes. Tags changed other than through the API may be stale for up to
+# TAG_ID_CACHE_TTL seconds.
+TAG_ID_CACHE_SIZE = 10000
+TAG_ID_CACHE_TTL = 60
+# Most Data created by one POST /data/bulk
+MAX_BULK_DATA = 10000
+# Let the front end server send OFS blobs: None, 'x-sendfile' (Apache
+# mod_xsendfile, lighttpd) or 'x-accel-redirect' (nginx, with an internal
+# location at OFS_ACCEL_REDIRECT_PREFIX aliased to PTOFS_DIR, or one at
+# OFS_ACCEL_REDIRECT_PREFIX/<n> aliased to each PTOFS_DIRS[n])
+OFS_SENDFILE = None
+OFS_ACCEL_REDIRECT_PREFIX = '/_ofs'
+# Largest chunk accepted by resumable uploads, most chunks of one upload and
+# how long in seconds an unfinished upload session is kept. Sessions are kept
+# in OFS_UPLOAD_DIR, PTOFS_DIR + '.uploads' if None, which should be on the
+# same filesystem.
+OFS_UPLOAD_DIR = None
+OFS_UPLOAD_MAX_CHUNK_SIZE = 64 * 2 ** 20
+OFS_UPLOAD_MAX_CHUNKS = 10000
+OFS_UPLOAD_EXPIRY = 7 * 24 * 3600
@@ -5,3 +5,4 @@ TESTING = True
 SQLALCHEMY_DATABASE_URI = 'sqlite://'
 LIVESERVER_PORT = 8943
 PTOFS_DIR = 'tagstore-test'
+TAGINDEX_ENABLED = True
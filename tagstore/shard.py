@@ -0,0 +1,159 @@
+"""Consistent hashing of OFS labels over several storage directories.
+
+Each storage directory owns many points on a hash ring and a label belongs to
+the directory owning the first point after the label's hash. Adding a
+directory only takes over the labels between its points and their
+predecessors, about 1/N of them, so rebalancing moves no more than that.
+
+"""
+import sys
+from bisect import bisect
+from hashlib import md5
+from shutil import copyfileobj
+from operator import attrgetter
+from argparse import ArgumentParser
+from logging import getLogger
+
+from tagstore.store import CHUNK_SIZE
+
+
+log = getLogger(__name__)
+
+
+def _hash(key):
+    if isinstance(key, unicode):
+        key = key.encode('utf-8')
+    return int(md5(key).hexdigest()[:16], 16)
+
+
+class HashRing(object):
+    """Consistent hash ring of nodes with vnodes points each."""
+    def __init__(self, nodes, vnodes=160):
+        if not nodes:
+            raise ValueError(u'A ring needs at least one node')
+        self.nodes = list(nodes)
+        points = sorted(
+            (_hash(u'{0}#{1}'.format(node, iii)), node)
+            for node in self.nodes for iii in range(vnodes))
+        self._hashes = [point for point, _ in points]
+        self._nodes = [node for _, node in points]
+
+    def node_for(self, key):
+        iii = bisect(self._hashes, _hash(key)) % len(self._hashes)
+        return self._nodes[iii]
+
+
+def move_label(source, target, label):
+    """Move label with its metadata from one shard of a ShardedOFSWrapper to
+    another.
+
+    The blob is copied first and then committed while the moves locks of both
+    shards keep writes through any ShardedOFSWrapper out. A label written
+    meanwhile is not moved: one changed on source is left for the next
+    rebalance and one stored on target supersedes the copy on source, which
+    is dropped.
+
+    Returns whether label was moved.
+
+    """
+    meta = source.call('get_metadata', label)
+    stream = source.call('get_stream', label)
+    try:
+        writer = target.call('open_blob', label, meta.get('fname'))
+        try:
+            copyfileobj(stream, writer, CHUNK_SIZE)
+        except:
+            writer.abort()
+            raise
+    finally:
+        stream.close()
+    checksum = meta.get('_checksum')
+    if checksum and writer.checksum and writer.checksum != checksum:
+        writer.abort()
+        raise IOError(u'{0} does not match its checksum'.format(label))
+    locks = [shard.locks.moves for shard in sorted(
+        [source, target], key=attrgetter('shard_index'))]
+    held = []
+    try:
+        for lock in locks:
+            lock.acquire()
+            held.append(lock)
+        if target.call('exists', label):
+            writer.abort()
+            if source.call('exists', label):
+                source.call('del_stream', label)
+            return False
+        if not source.call('exists', label) or \
+                source.call('get_metadata', label) != meta:
+            writer.abort()
+            return False
+        target.call('commit_blob', writer)
+        target.call('replace_metadata', label, meta)
+        source.call('del_stream', label)
+        return True
+    finally:
+        for lock in reversed(held):
+            lock.release()
+
+
+def rebalance(sharded, dry_run=False, batch_size=1000, report=None):
+    """Move labels to the shards the ring of sharded assigns them to.
+
+    sharded is a ShardedOFSWrapper. Labels remain readable throughout as
+    lookups try every shard. A dry run only reports what would move. report
+    is called with each label moved and its source and target shard indices.
+
+    Returns the number of labels examined, moved and skipped as they were
+    written during their move.
+
+    """
+    stats = dict(examined=0, moved=0, skipped=0)
+    for shard in sharded.shards:
+        after = None
+        while True:
+            labels = shard.call('list_labels', after=after, limit=batch_size)
+            if not labels:
+                break
+            after = labels[-1]
+            for label in labels:
+                stats['examined'] += 1
+                target = sharded.shard_for(label)
+                if target is shard:
+                    continue
+                if not dry_run and not move_label(shard, target, label):
+                    stats['skipped'] += 1
+                    continue
+                stats['moved'] += 1
+                if report:
+                    report(label, shard.shard_index, target.shard_index)
+    return stats
+
+
+def main(argv=None):
+    parser = ArgumentParser(
+        description='Move OFS blobs to the shards of PTOFS_DIRS they belong '
+                    'to, e.g. after adding a shard.')
+    parser.add_argument('config', help='tagstore configuration file')
+    parser.add_argument('--batch-size', type=int, default=1000)
+    parser.add_argument('--dry-run', action='store_true',
+                        help='List the blobs that would move')
+    args = parser.parse_args(argv)
+
+    from tagstore.server import create_app, ofs
+    app = create_app(args.config)
+    if not app.config['PTOFS_DIRS']:
+        parser.error(u'PTOFS_DIRS is not configured')
+
+    def report(label, source, target):
+        if args.dry_run:
+            print u'{0} {1} -> {2}'.format(label, source, target)
+
+    with app.app_context():
+        stats = rebalance(ofs._get_current_object(), dry_run=args.dry_run,
+                          batch_size=args.batch_size, report=report)
+    print '{examined} examined, {moved} moved, {skipped} skipped'.format(
+        **stats)
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,923 @@
+"""PTOFS with pluggable metadata storage.
+
+Stock PTOFS keeps the metadata of every object in a bucket in one
+PersistentState JSON file that is read in full and rewritten on every call,
+under a lock that is global to the storage directory. TagstorePTOFS keeps
+the PTOFS interface and file layout but stores metadata through a backend:
+
+json
+    The PersistentState file, as PTOFS does.
+sqlite
+    One row per object in an indexed SQLite table next to the pairtree.
+    Readers and writers only contend per transaction, so OFSWrapper does not
+    need the global storage lock.
+
+Either backend may be fronted by an in-process LRU cache of metadata.
+
+Blobs are written once, straight into the object directory under a temporary
+name by a BlobWriter that computes their length and checksum on the way, and
+are committed with an atomic rename.
+
+With dedup enabled, each blob is a hard link to a shared copy of its contents
+in the bucket's .cas directory, named by checksum. The link count of the
+shared copy is its reference count: it is removed once no label links to it.
+
+With compression enabled, blobs of compressible types that reach a minimum
+size are compressed as they are written. Their metadata records the
+_encoding and _stored_length; _content_length and _checksum still describe
+the decoded contents, which get_stream returns unless asked for the stored
+bytes.
+
+"""
+import os
+import os.path
+import re
+import errno
+import json
+import sqlite3
+import hashlib
+import zlib
+import bz2
+from uuid import uuid4
+from StringIO import StringIO
+from shutil import copyfileobj
+from bisect import bisect_right
+from datetime import datetime
+from threading import local
+from time import time
+from logging import getLogger
+from mimetypes import guess_type
+
+from ofs.local import PTOFS
+from ofs.local.storedjson import PERSISTENCE_FILENAME
+from pairtree import FileNotFoundException
+
+from tagstore.cache import LRUCache
+
+try:
+    import lzma
+except ImportError:
+    try:
+        from backports import lzma
+    except ImportError:
+        lzma = None
+
+
+log = getLogger(__name__)
+
+
+SQLITE_FILENAME = 'metadata.sqlite'
+# Uncommitted blobs are named .<label>.part-<random>
+PART_INFIX = '.part-'
+CHUNK_SIZE = 2 ** 16
+# Shared copies of deduplicated blobs are .cas/<type>/<hex[:2]>/<hex>, with
+# .<encoding> appended if compressed
+CAS_DIRNAME = '.cas'
+
+
+def _gzip_compressor():
+    # A gzip member with no timestamp so equal contents compress equally
+    return zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+
+
+def _gzip_decompressor():
+    return zlib.decompressobj(16 + zlib.MAX_WBITS)
+
+
+# Content-Encoding: (compressor factory, decompressor factory)
+ENCODINGS = {
+    'gzip': (_gzip_compressor, _gzip_decompressor),
+    'bzip2': (bz2.BZ2Compressor, bz2.BZ2Decompressor),
+}
+if lzma is not None:
+    ENCODINGS['xz'] = (lzma.LZMACompressor, lzma.LZMADecompressor)
+
+_hexdigest_re = re.compile('^[0-9a-f]+$')
+
+
+def _now():
+    return datetime.now().isoformat().split('.')[0]
+
+
+def _userland(params):
+    """Only allow userland parameters, i.e. not starting with _."""
+    return dict((k, v) for k, v in params.items() if not k.startswith('_'))
+
+
+def _stat_version(*paths):
+    """Identify the current contents of files by their stat."""
+    version = []
+    for path in paths:
+        try:
+            stat = os.stat(path)
+        except OSError:
+            version.append(None)
+        else:
+            version.append((stat.st_ino, stat.st_size, stat.st_mtime))
+    return tuple(version)
+
+
+class JSONMetadata(object):
+    """Metadata in the PersistentState JSON file of each bucket."""
+    global_lock = True
+
+    def __init__(self, ptofs):
+        self.ptofs = ptofs
+
+    def get(self, bucket, label):
+        _, json_payload = self.ptofs._get_object(bucket)
+        return json_payload.state.get(label)
+
+    def update(self, bucket, label, func):
+        """Replace the metadata for label with func(old metadata).
+
+        func receives None if label has no metadata and may return None to
+        delete it.
+
+        """
+        _, json_payload = self.ptofs._get_object(bucket)
+        meta = func(json_payload.state.get(label))
+        if meta is None:
+            json_payload.state.pop(label, None)
+        else:
+            json_payload[label] = meta
+        json_payload.sync()
+        return meta
+
+    def update_labels(self, bucket, updates):
+        """Apply update for many labels at once.
+
+        updates is an iterable of (label, func) as for update().
+
+        """
+        _, json_payload = self.ptofs._get_object(bucket)
+        for label, func in updates:
+            meta = func(json_payload.state.get(label))
+            if meta is None:
+                json_payload.state.pop(label, None)
+            else:
+                json_payload[label] = meta
+        json_payload.sync()
+
+    def labels(self, bucket, after=None, limit=None):
+        _, json_payload = self.ptofs._get_object(bucket)
+        labels = sorted(json_payload.keys())
+        if after is not None:
+            labels = labels[bisect_right(labels, after):]
+        if limit is not None:
+            labels = labels[:limit]
+        return labels
+
+    def version(self, bucket):
+        """Changes whenever any process changes the metadata of bucket."""
+        return _stat_version(os.path.join(
+            self.ptofs._store._id_to_dirpath(bucket), PERSISTENCE_FILENAME))
+
+
+class SQLiteMetadata(object):
+    """Metadata in a SQLite table keyed by bucket and label."""
+    global_lock = False
+
+    def __init__(self, ptofs, path=None):
+        if path is None:
+            path = os.path.join(ptofs.storage_dir, SQLITE_FILENAME)
+        self.path = path
+        self._local = local()
+
+    @property
+    def connection(self):
+        """The connection for this thread.
+
+        Connections cannot be shared between threads or forked processes.
+
+        """
+        state = self._local
+        pid = os.getpid()
+        if getattr(state, 'pid', None) != pid:
+            conn = sqlite3.connect(self.path, timeout=60, isolation_level=None)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            conn.execute(
+                'CREATE TABLE IF NOT EXISTS ofs_metadata ('
+                'bucket TEXT NOT NULL, '
+                'label TEXT NOT NULL, '
+                'metadata TEXT NOT NULL, '
+                'PRIMARY KEY (bucket, label))')
+            state.connection = conn
+            state.pid = pid
+        return state.connection
+
+    def get(self, bucket, label):
+        row = self.connection.execute(
+            'SELECT metadata FROM ofs_metadata WHERE bucket = ? AND label = ?',
+            (bucket, label)).fetchone()
+        if row is None:
+            return None
+        return json.loads(row[0])
+
+    def update(self, bucket, label, func):
+        """Replace the metadata for label with func(old metadata).
+
+        func receives None if label has no metadata and may return None to
+        delete it. The read and write happen in one transaction.
+
+        """
+        conn = self.connection
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            meta = self._update(bucket, label, func)
+        except:
+            conn.execute('ROLLBACK')
+            raise
+        conn.execute('COMMIT')
+        return meta
+
+    def _update(self, bucket, label, func):
+        meta = func(self.get(bucket, label))
+        if meta is None:
+            self.connection.execute(
+                'DELETE FROM ofs_metadata WHERE bucket = ? AND label = ?',
+                (bucket, label))
+        else:
+            self.connection.execute(
+                'INSERT OR REPLACE INTO ofs_metadata '
+                '(bucket, label, metadata) VALUES (?, ?, ?)',
+                (bucket, label, json.dumps(meta)))
+        return meta
+
+    def update_labels(self, bucket, updates):
+        """Apply update for many labels in one transaction.
+
+        updates is an iterable of (label, func) as for update().
+
+        """
+        conn = self.connection
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            for label, func in updates:
+                self._update(bucket, label, func)
+        except:
+            conn.execute('ROLLBACK')
+            raise
+        conn.execute('COMMIT')
+
+    def update_many(self, bucket, items):
+        """Replace the metadata of many labels in one transaction.
+
+        items is an iterable of (label, metadata).
+
+        """
+        conn = self.connection
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            conn.executemany(
+                'INSERT OR REPLACE INTO ofs_metadata '
+                '(bucket, label, metadata) VALUES (?, ?, ?)',
+                ((bucket, label, json.dumps(meta)) for label, meta in items))
+        except:
+            conn.execute('ROLLBACK')
+            raise
+        conn.execute('COMMIT')
+
+    def labels(self, bucket, after=None, limit=None):
+        if after is None:
+            after = u''
+        if limit is None:
+            limit = -1
+        return [row[0] for row in self.connection.execute(
+            'SELECT label FROM ofs_metadata WHERE bucket = ? AND label > ? '
+            'ORDER BY label LIMIT ?', (bucket, after, limit))]
+
+    def version(self, bucket):
+        """Changes whenever any process changes the metadata.
+
+        Commits append to the write-ahead log and checkpoints rewrite the
+        database so between them both files cover every change.
+
+        """
+        return _stat_version(self.path, self.path + '-wal')
+
+
+class CachedMetadata(object):
+    """LRU cache in front of a metadata backend.
+
+    Updates made through the cache invalidate the label and the version they
+    leave the backend at is recorded, so they do not empty the cache. Updates
+    made by other processes are noticed by a change in the backend's version,
+    which empties the cache, or at the latest after ttl seconds. With a
+    backend without a global lock, an update by another process at the same
+    instant as one made through the cache may only be noticed after ttl.
+
+    """
+    def __init__(self, backend, maxsize=10000, ttl=60):
+        self.backend = backend
+        self.global_lock = backend.global_lock
+        self.cache = LRUCache(maxsize, ttl)
+        self._versions = {}
+
+    def _validate(self, bucket):
+        version = self.backend.version(bucket)
+        if self._versions.get(bucket) != version:
+            self.cache.clear()
+            self._versions[bucket] = version
+
+    def get(self, bucket, label):
+        self._validate(bucket)
+        key = (bucket, label)
+        meta = self.cache.get(key)
+        if meta is None:
+            meta = self.backend.get(bucket, label)
+            if meta is None:
+                return None
+            self.cache.set(key, meta)
+        return dict(meta)
+
+    def _written(self, bucket, before):
+        """Record the version of bucket after an update through the cache
+        if it was at the recorded version, before, until then.
+
+        """
+        if self._versions.get(bucket) == before:
+            self._versions[bucket] = self.backend.version(bucket)
+
+    def update(self, bucket, label, func):
+        key = (bucket, label)
+        before = self.backend.version(bucket)
+        self.cache.pop(key)
+        try:
+            return self.backend.update(bucket, label, func)
+        finally:
+            self.cache.pop(key)
+            self._written(bucket, before)
+
+    def update_labels(self, bucket, updates):
+        updates = list(updates)
+        before = self.backend.version(bucket)
+        for label, _ in updates:
+            self.cache.pop((bucket, label))
+        try:
+            return self.backend.update_labels(bucket, updates)
+        finally:
+            for label, _ in updates:
+                self.cache.pop((bucket, label))
+            self._written(bucket, before)
+
+    def labels(self, bucket, after=None, limit=None):
+        return self.backend.labels(bucket, after, limit)
+
+    def version(self, bucket):
+        return self.backend.version(bucket)
+
+    def __getattr__(self, name):
+        return getattr(self.backend, name)
+
+
+class DecodingReader(object):
+    """Read-only file of the decoded contents of a compressed file."""
+    def __init__(self, fileobj, encoding):
+        self._file = fileobj
+        self._decompressor = ENCODINGS[encoding][1]()
+        self._buffer = ''
+        self._eof = False
+        self._pos = 0
+
+    def read(self, size=-1):
+        while not self._eof and (size < 0 or len(self._buffer) < size):
+            data = self._file.read(CHUNK_SIZE)
+            if data:
+                self._buffer += self._decompressor.decompress(data)
+            else:
+                self._eof = True
+                flush = getattr(self._decompressor, 'flush', None)
+                if flush is not None:
+                    self._buffer += flush()
+        if size < 0:
+            size = len(self._buffer)
+        data = self._buffer[:size]
+        self._buffer = self._buffer[size:]
+        self._pos += len(data)
+        return data
+
+    def tell(self):
+        return self._pos
+
+    def seek(self, offset, whence=0):
+        """Skip forward to offset. Decoding cannot go backwards."""
+        if whence == 1:
+            offset += self._pos
+        if whence == 2 or offset < self._pos:
+            raise IOError(u'Cannot seek backwards in a compressed blob')
+        while self._pos < offset:
+            if not self.read(min(CHUNK_SIZE, offset - self._pos)):
+                break
+
+    def close(self):
+        self._file.close()
+
+
+class BlobWriter(object):
+    """Write-only file that becomes the blob for label when committed.
+
+    The data is written to a temporary file in the same directory as the blob
+    so that committing is a rename. The length and checksum are computed as
+    the data is written so the blob never has to be read back.
+
+    With an encoding, the data is compressed once min_size bytes have been
+    written; smaller blobs are stored as they are. text_only also stores
+    as they are blobs whose first min_size bytes contain a NUL byte.
+
+    """
+    def __init__(self, dirpath, label, hashing_type=None, encoding=None,
+                 min_size=0, text_only=False):
+        self.label = label
+        self.path = os.path.join(dirpath, label)
+        self.tmppath = os.path.join(dirpath, '.{0}{1}{2}'.format(
+            label, PART_INFIX, uuid4().hex))
+        self.hashing_type = hashing_type
+        self.length = 0
+        self._hash = None
+        if hashing_type:
+            self._hash = hashlib.new(hashing_type)
+        # The encoding used, known once min_size bytes have been written
+        self.encoding = None
+        self.stored_length = None
+        self._compressor = None
+        self._pending = None
+        if encoding:
+            self._wanted = (encoding, min_size, text_only)
+            self._pending = []
+            self._pending_length = 0
+        self._file = open(self.tmppath, 'wb')
+
+    def write(self, data):
+        if self._hash is not None:
+            self._hash.update(data)
+        self.length += len(data)
+        if self._pending is not None:
+            self._pending.append(data)
+            self._pending_length += len(data)
+            if self._pending_length >= self._wanted[1]:
+                self._start_encoding(True)
+            return
+        self._write_stored(data)
+
+    def _write_stored(self, data):
+        if self._compressor is not None:
+            data = self._compressor.compress(data)
+        self._file.write(data)
+
+    def _start_encoding(self, compress):
+        """Decide on the encoding and write the data held back until now."""
+        data = ''.join(self._pending)
+        self._pending = None
+        encoding, _, text_only = self._wanted
+        if compress and not (text_only and '\0' in data):
+            self._compressor = ENCODINGS[encoding][0]()
+            self.encoding = encoding
+        self._write_stored(data)
+
+    def adopt(self, path):
+        """Take the complete file at path as the data instead.
+
+        path is read once to compute the checksum and then moved, or copied
+        if it is on another filesystem. It is compressed instead if the
+        writer has an encoding.
+
+        """
+        if self._pending is not None:
+            with open(path, 'rb') as fff:
+                copyfileobj(fff, self, CHUNK_SIZE)
+            os.remove(path)
+            return
+        with open(path, 'rb') as fff:
+            for data in iter(lambda: fff.read(CHUNK_SIZE), ''):
+                if self._hash is not None:
+                    self._hash.update(data)
+                self.length += len(data)
+        self._file.close()
+        try:
+            os.rename(path, self.tmppath)
+        except OSError as exc:
+            if exc.errno != errno.EXDEV:
+                raise
+            with open(path, 'rb') as src:
+                with open(self.tmppath, 'wb') as dst:
+                    copyfileobj(src, dst, CHUNK_SIZE)
+                    dst.flush()
+                    os.fsync(dst.fileno())
+            os.remove(path)
+
+    def seek(self, offset, whence=0):
+        """Werkzeug rewinds uploaded files once written. Nothing is read
+        back so this does nothing."""
+        pass
+
+    @property
+    def checksum(self):
+        if self._hash is None:
+            return None
+        return '{0}:{1}'.format(self.hashing_type, self._hash.hexdigest())
+
+    def close(self):
+        """Flush the data to disk."""
+        if not self._file.closed:
+            if self._pending is not None:
+                # Shorter than min_size
+                self._start_encoding(False)
+            if self._compressor is not None:
+                self._file.write(self._compressor.flush())
+                self._compressor = None
+            self._file.flush()
+            self.stored_length = self._file.tell()
+            os.fsync(self._file.fileno())
+            self._file.close()
+
+    def commit(self):
+        """Atomically replace the blob with the data written."""
+        self.close()
+        os.rename(self.tmppath, self.path)
+
+    def abort(self):
+        """Discard the data written."""
+        self._file.close()
+        try:
+            os.remove(self.tmppath)
+        except OSError:
+            pass
+
+
+METADATA_BACKENDS = {
+    'json': JSONMetadata,
+    'sqlite': SQLiteMetadata,
+}
+
+
+class TagstorePTOFS(PTOFS):
+    """PTOFS storing object metadata through a metadata backend.
+
+    metadata_cache_size entries of metadata are cached for up to
+    metadata_cache_ttl seconds; a size of 0 disables the cache. dedup stores
+    blobs with the same contents once.
+
+    compression is one of ENCODINGS to compress blobs of at least
+    compress_min_size bytes with. Only blobs whose fname has a type starting
+    with one of compress_types are compressed, or that look like text if
+    their type is unknown.
+
+    """
+    def __init__(self, storage_dir='data', metadata='json',
+                 metadata_cache_size=0, metadata_cache_ttl=None, dedup=False,
+                 compression=None, compress_min_size=4096,
+                 compress_types=('text/', ), **kwargs):
+        PTOFS.__init__(self, storage_dir, **kwargs)
+        self.dedup = dedup and bool(self.hashing_type)
+        if compression and compression not in ENCODINGS:
+            raise ValueError(u'Unknown compression {0}'.format(compression))
+        self.compression = compression
+        self.compress_min_size = compress_min_size
+        self.compress_types = tuple(compress_types)
+        self.metadata = METADATA_BACKENDS[metadata](self)
+        if metadata_cache_size:
+            self.metadata = CachedMetadata(
+                self.metadata, metadata_cache_size, metadata_cache_ttl)
+
+    def list_labels(self, bucket, after=None, limit=None):
+        """Sorted labels in bucket, optionally only those after a label."""
+        if self.exists(bucket):
+            return self.metadata.labels(bucket, after, limit)
+
+    def put_stream(self, bucket, label, stream_object, params={}):
+        writer = self.open_blob(bucket, label, params.get('fname'))
+        try:
+            if isinstance(stream_object, basestring):
+                writer.write(stream_object)
+            else:
+                copyfileobj(stream_object, writer, CHUNK_SIZE)
+        except:
+            writer.abort()
+            raise
+        return self.commit_blob(bucket, writer, params)
+
+    def open_blob(self, bucket, label, fname=None):
+        """Return a BlobWriter for a new version of label.
+
+        Nothing is visible until the writer is passed to commit_blob and the
+        writer does not need the storage lock while it is written to. fname
+        decides whether the blob may be compressed.
+
+        """
+        self._store.get_object(bucket)
+        encoding = None
+        text_only = False
+        if self.compression:
+            mtype = None
+            if fname:
+                mtype = guess_type(fname)[0]
+            if mtype is None:
+                encoding = self.compression
+                text_only = True
+            elif mtype.startswith(self.compress_types):
+                encoding = self.compression
+        return BlobWriter(self._store._id_to_dirpath(bucket), label,
+                          self.hashing_type, encoding, self.compress_min_size,
+                          text_only)
+
+    def commit_blob(self, bucket, writer, params={}):
+        """Move the blob written by writer into place and record it."""
+        try:
+            if self.dedup:
+                self._commit_shared(bucket, writer)
+            else:
+                writer.commit()
+        except:
+            writer.abort()
+            raise
+        return self._record_blob(bucket, writer.label, writer.length,
+                                 writer.checksum, params, writer.encoding,
+                                 writer.stored_length)
+
+    def link_blob(self, bucket, label, checksum, params={}):
+        """Store label as another reference to the blob with checksum.
+
+        Returns the metadata or None if no such blob is stored.
+
+        """
+        if not self.dedup:
+            return None
+        dirpath = self._store._id_to_dirpath(bucket)
+        link_path = os.path.join(dirpath, '.{0}{1}{2}'.format(
+            label, PART_INFIX, uuid4().hex))
+        # The shared copy may be stored compressed
+        for encoding in [None] + sorted(ENCODINGS):
+            path = self._cas_path(bucket, checksum, encoding)
+            if path is None:
+                return None
+            try:
+                os.link(path, link_path)
+            except OSError as err:
+                if err.errno == errno.ENOENT:
+                    continue
+                raise
+            break
+        else:
+            return None
+        stored_length = os.stat(link_path).st_size
+        length = stored_length
+        if encoding is not None:
+            length = 0
+            with open(link_path, 'rb') as fff:
+                reader = DecodingReader(fff, encoding)
+                for data in iter(lambda: reader.read(CHUNK_SIZE), ''):
+                    length += len(data)
+        self._replace_with_link(link_path, os.path.join(dirpath, label))
+        return self._record_blob(bucket, label, length, checksum, params,
+                                 encoding, stored_length)
+
+    def _cas_path(self, bucket, checksum, encoding=None):
+        """Path of the shared copy of blobs with checksum stored with
+        encoding."""
+        try:
+            hashing_type, hexdigest = checksum.split(':', 1)
+        except (AttributeError, ValueError):
+            return None
+        if hashing_type != self.hashing_type or \
+                not _hexdigest_re.match(hexdigest):
+            return None
+        if encoding is not None:
+            hexdigest = '{0}.{1}'.format(hexdigest, encoding)
+        return os.path.join(self._store._id_to_dirpath(bucket), CAS_DIRNAME,
+                            hashing_type, hexdigest[:2], hexdigest)
+
+    def _replace_with_link(self, link_path, path):
+        os.rename(link_path, path)
+        # rename does nothing if both are already links to the same file
+        if os.path.lexists(link_path):
+            os.remove(link_path)
+
+    def _commit_shared(self, bucket, writer):
+        """Make the blob a link to the shared copy of its contents.
+
+        If there is none yet the data written becomes the shared copy,
+        otherwise it is discarded.
+
+        """
+        writer.close()
+        path = self._cas_path(bucket, writer.checksum, writer.encoding)
+        link_path = '{0}.link'.format(writer.tmppath)
+        try:
+            os.link(path, link_path)
+        except OSError as err:
+            if err.errno != errno.ENOENT:
+                raise
+            try:
+                os.makedirs(os.path.dirname(path))
+            except OSError as err:
+                if err.errno != errno.EEXIST:
+                    raise
+            os.rename(writer.tmppath, path)
+            os.link(path, link_path)
+        else:
+            writer.abort()
+        self._replace_with_link(link_path, writer.path)
+
+    def _release_shared(self, bucket, checksum, encoding=None):
+        """Remove the shared copy with checksum if no label links to it."""
+        path = self._cas_path(bucket, checksum, encoding)
+        if path is None:
+            return
+        try:
+            if os.stat(path).st_nlink <= 1:
+                os.remove(path)
+        except OSError:
+            pass
+
+    def refcount(self, bucket, label):
+        """Number of labels sharing the contents of label."""
+        meta = self.get_metadata(bucket, label)
+        path = self._cas_path(bucket, meta.get('_checksum'),
+                              meta.get('_encoding'))
+        try:
+            return os.stat(path).st_nlink - 1
+        except (OSError, TypeError, AttributeError):
+            return 1
+
+    def sweep_shared(self, bucket, grace=60):
+        """Remove shared copies no label links to that are older than grace
+        seconds, left behind by interrupted commits.
+
+        Returns the number removed.
+
+        """
+        root = os.path.join(self._store._id_to_dirpath(bucket), CAS_DIRNAME)
+        cutoff = time() - grace
+        removed = 0
+        for dirpath, dirnames, fnames in os.walk(root):
+            for fname in fnames:
+                path = os.path.join(dirpath, fname)
+                try:
+                    stat = os.stat(path)
+                    if stat.st_nlink <= 1 and stat.st_mtime < cutoff:
+                        os.remove(path)
+                        removed += 1
+                except OSError:
+                    pass
+        return removed
+
+    def mark_verified(self, bucket, labels, when=None):
+        """Record that the blobs of labels were found intact at when."""
+        if when is None:
+            when = _now()
+
+        def update(meta):
+            if meta is not None:
+                meta['_verified'] = when
+            return meta
+        self.metadata.update_labels(
+            bucket, [(label, update) for label in labels])
+
+    def sweep_parts(self, bucket, grace=60):
+        """Remove uncommitted blobs older than grace seconds, left behind
+        by interrupted uploads.
+
+        Returns the number removed.
+
+        """
+        dirpath = self._store._id_to_dirpath(bucket)
+        cutoff = time() - grace
+        removed = 0
+        try:
+            fnames = os.listdir(dirpath)
+        except OSError:
+            return 0
+        for fname in fnames:
+            if not (fname.startswith('.') and PART_INFIX in fname):
+                continue
+            path = os.path.join(dirpath, fname)
+            try:
+                if os.stat(path).st_mtime < cutoff:
+                    os.remove(path)
+                    removed += 1
+            except OSError:
+                pass
+        return removed
+
+    def _record_blob(self, bucket, label, length, checksum, params,
+                     encoding=None, stored_length=None):
+        now = _now()
+        replaced = []
+
+        def update(meta):
+            if meta is None:
+                meta = {
+                    '_label': params.get('_label', label),
+                    '_creation_date': now,
+                }
+            else:
+                replaced.append(
+                    (meta.get('_checksum'), meta.get('_encoding')))
+            meta.update(_userland(params))
+            meta['_content_length'] = length
+            meta['_last_modified'] = now
+            if checksum:
+                meta['_checksum'] = checksum
+            if encoding:
+                meta['_encoding'] = encoding
+                meta['_stored_length'] = stored_length
+            else:
+                meta.pop('_encoding', None)
+                meta.pop('_stored_length', None)
+            return meta
+        meta = self.metadata.update(bucket, label, update)
+        for old_checksum, old_encoding in replaced:
+            if (old_checksum, old_encoding) != (checksum, encoding):
+                self._release_shared(bucket, old_checksum, old_encoding)
+        return meta
+
+    def get_stream(self, bucket, label, as_stream=True, decode=True):
+        """The contents of label, decoded unless decode is false."""
+        if self.exists(bucket) and self.exists(bucket, label):
+            po = self._store.get_object(bucket)
+            stream = po.get_bytestream(label, streamable=as_stream)
+            if not decode:
+                return stream
+            encoding = (self.metadata.get(bucket, label) or {}).get(
+                '_encoding')
+            if encoding is None:
+                return stream
+            if not as_stream:
+                return DecodingReader(StringIO(stream), encoding).read()
+            return DecodingReader(stream, encoding)
+        raise FileNotFoundException
+
+    def get_path(self, bucket, label):
+        """Path of the file storing label."""
+        if self.exists(bucket) and self.exists(bucket, label):
+            return os.path.join(self._store._id_to_dirpath(bucket), label)
+        raise FileNotFoundException
+
+    def get_metadata(self, bucket, label):
+        meta = self.metadata.get(bucket, label)
+        if meta is None:
+            raise FileNotFoundException
+        return meta
+
+    def update_metadata(self, bucket, label, params):
+        if not (self.exists(bucket, label) and isinstance(params, dict)):
+            raise FileNotFoundException
+
+        def update(meta):
+            if meta is None:
+                raise FileNotFoundException
+            meta.update(_userland(params))
+            return meta
+        return self.metadata.update(bucket, label, update)
+
+    def replace_metadata(self, bucket, label, meta):
+        """Replace all of the metadata of label, including the reserved keys
+        other than those describing the stored blob, e.g. when moving it
+        between shards.
+
+        """
+        if not (self.exists(bucket, label) and isinstance(meta, dict)):
+            raise FileNotFoundException
+
+        def update(old):
+            if old is None:
+                raise FileNotFoundException
+            new = dict(meta)
+            for key in ('_content_length', '_checksum', '_encoding',
+                        '_stored_length'):
+                if key in old:
+                    new[key] = old[key]
+                else:
+                    new.pop(key, None)
+            return new
+        return self.metadata.update(bucket, label, update)
+
+    def del_metadata_keys(self, bucket, label, keys):
+        if not (self.exists(bucket, label) and isinstance(keys, list)):
+            raise FileNotFoundException
+
+        def update(meta):
+            if meta is None:
+                raise FileNotFoundException
+            for key in keys:
+                if not key.startswith('_'):
+                    meta.pop(key, None)
+            return meta
+        return self.metadata.update(bucket, label, update)
+
+    def del_stream(self, bucket, label):
+        if not self.exists(bucket, label):
+            raise FileNotFoundException
+        self._store.del_stream(bucket, label)
+        removed = []
+
+        def update(meta):
+            removed.append(meta)
+            return None
+        self.metadata.update(bucket, label, update)
+        for meta in removed:
+            if meta:
+                self._release_shared(bucket, meta.get('_checksum'),
+                                     meta.get('_encoding'))
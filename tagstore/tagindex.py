@@ -0,0 +1,438 @@
+"""Inverted index from tags to the Data tagged with them.
+
+Each tag id maps to a Bitmap of the ids of the Data it is on, so boolean
+combinations of tag predicates are answered with bitmap AND, OR and ANDNOT
+instead of EXISTS subqueries over the tags table.
+
+In apps with the tag index enabled, every flush that changes the tags of Data
+also logs the Data and tags concerned to the tag_changes table, in the same
+transaction. Before answering, an index rereads the current state of what was
+logged since it last looked, so it sees the writes of every process. Log ids
+below the highest one applied that were not there yet may belong to
+transactions that commit later, so they are looked for again until they turn
+up or GAP_TIMEOUT seconds have passed.
+
+An index starts from a snapshot file if one is configured and recent enough,
+otherwise from the tags table.
+
+"""
+import os
+import sys
+import zlib
+import marshal
+from collections import namedtuple
+from itertools import groupby
+from threading import Lock
+from time import time
+from uuid import uuid4
+from weakref import WeakSet
+from argparse import ArgumentParser
+from logging import getLogger
+
+from flask.ext.sqlalchemy import SignallingSession
+from sqlalchemy import event, func, or_
+from sqlalchemy.orm import attributes, scoped_session
+
+from tagstore.models import (
+    db, Data, Tag, TagChange, tags, startswith, chunks, MAX_IN_PARAMS
+)
+from tagstore.bitmap import Bitmap
+
+
+log = getLogger(__name__)
+
+
+SNAPSHOT_FORMAT = 2
+# Seconds after which a log id still missing below applied ones is taken to
+# be of a rolled back transaction
+GAP_TIMEOUT = 600
+# Log rows read and applied at a time
+BATCH_SIZE = 10000
+# Log rows kept below the lowest one a pruning index still needs, so that the
+# indices of other processes a little behind it need not rebuild
+PRUNE_MARGIN = 1000
+_CHANGES_KEY = 'tagstore_tag_changes'
+# Apps whose sessions log tag changes
+_logging_apps = WeakSet()
+_listen_lock = Lock()
+
+
+class QueryError(ValueError):
+    """A malformed tag query."""
+
+
+# Predicates on a column of Tag
+OPERATORS = {
+    'eq': lambda col, val: col == val,
+    'like': lambda col, val: col.like(val),
+    'ilike': lambda col, val: col.ilike(val),
+    'in': lambda col, val: col.in_(val),
+    'startswith': startswith,
+    'between': lambda col, val: col.between(*val),
+}
+# Columns of Tag predicates may name
+COLUMNS = {
+    'tag': Tag.tag,
+    'key': Tag.key,
+    'value': Tag.value,
+}
+
+
+def log_tag_changes(app):
+    """Log the changes to the tags of Data flushed by the sessions of app."""
+    with _listen_lock:
+        _logging_apps.add(app)
+        if not event.contains(
+                SignallingSession, 'before_flush', _collect_changes):
+            event.listen(SignallingSession, 'before_flush', _collect_changes)
+            event.listen(SignallingSession, 'after_flush', _log_changes)
+
+
+def logs_changes(session):
+    """Whether session belongs to an app that logs tag changes."""
+    if isinstance(session, scoped_session):
+        session = session()
+    return getattr(session, 'app', None) in _logging_apps
+
+
+def _collect_changes(session, flush_context, instances):
+    if not logs_changes(session):
+        return
+    changes = []
+    for obj in session.new:
+        if isinstance(obj, Data):
+            changes.append((obj, None))
+            changes.extend((obj, tag) for tag in obj.tags)
+    for obj in session.dirty:
+        if isinstance(obj, Data):
+            history = attributes.get_history(obj, 'tags')
+            changes.extend((obj, tag) for tag in history.added)
+            changes.extend((obj, tag) for tag in history.deleted)
+    for obj in session.deleted:
+        if isinstance(obj, Data):
+            changes.append((obj, None))
+            changes.extend((obj, tag) for tag in obj.tags)
+    session.info[_CHANGES_KEY] = changes
+
+
+def _log_changes(session, flush_context):
+    changes = session.info.pop(_CHANGES_KEY, None)
+    if not changes:
+        return
+    # Ids of new objects are known now
+    pairs = set()
+    for obj, tag in changes:
+        pairs.add((obj.id, None if tag is None else tag.id))
+    log_changes(session, pairs)
+
+
+def log_changes(session, pairs):
+    """Log changes to the (data id, tag id) pairs, a tag id of None meaning
+    the Data itself.
+
+    Writes that bypass the ORM, such as bulk updates of the tags table, must
+    log what they change for tag indices to see it. Nothing is logged unless
+    the app of session logs tag changes.
+
+    """
+    if pairs and logs_changes(session):
+        session.execute(TagChange.__table__.insert(), [
+            dict(data_id=data_id, tag_id=tag_id)
+            for data_id, tag_id in sorted(pairs)])
+
+
+def _subqueries(value):
+    if not isinstance(value, list) or not value:
+        raise QueryError(u'and/or take a non-empty list of queries')
+    return value
+
+
+def _tag_ids(predicate):
+    """Ids of the tags matching predicate, {"op": ..., "val": ...} with an
+    optional "name" of the column, tag by default.
+
+    """
+    try:
+        operator = OPERATORS[predicate['op']]
+        column = COLUMNS[predicate.get('name', 'tag')]
+        value = predicate['val']
+    except (KeyError, TypeError, AttributeError):
+        raise QueryError(u'Unknown query {0!r}'.format(predicate))
+    if predicate['op'] == 'in' and not isinstance(value, list):
+        raise QueryError(u'in takes a list')
+    if predicate['op'] == 'between' and \
+            not (isinstance(value, list) and len(value) == 2):
+        raise QueryError(u'between takes a list of two values')
+    return [tag_id for tag_id, in db.session.query(Tag.id).filter(
+        operator(column, value))]
+
+
+class Snapshot(namedtuple('Snapshot', 'tags data')):
+    """One version of an index: tags maps tag ids to Bitmaps of Data ids and
+    data is the Bitmap of the ids of all Data, for negations.
+
+    Neither is changed once the snapshot is in use; updates build a new one.
+
+    """
+    __slots__ = ()
+
+
+class TagIndex(object):
+    """Bitmaps of the Data ids of each tag, kept up to date by sync()."""
+    def __init__(self, snapshot_path=None):
+        self.snapshot_path = snapshot_path
+        self._lock = Lock()
+        # The current Snapshot, swapped whole so that queries, which do not
+        # take the lock, pair the tags and data of one version
+        self._snapshot = None
+        # Highest log id applied and, for the lower ids not seen yet, when
+        # they were found missing
+        self.seen = 0
+        self._gaps = {}
+
+    def sync(self):
+        """Catch up with changes to tags, loading the index first."""
+        with self._lock:
+            if self._snapshot is None:
+                if not (self.snapshot_path and self.load(self.snapshot_path)):
+                    self.rebuild()
+                    if self.snapshot_path:
+                        self.save(self.snapshot_path)
+            first = db.session.query(func.min(TagChange.id)).scalar()
+            if first is not None and first > self._low():
+                log.info(u'Tag changes from {0} were pruned, '
+                         u'rebuilding'.format(self._low()))
+                self.rebuild()
+            try:
+                self._catch_up()
+            except:
+                # Start over rather than miss the rows not applied
+                self._snapshot = None
+                raise
+
+    def _low(self):
+        """The lowest log id that may not have been applied."""
+        if self._gaps:
+            return min(self._gaps)
+        return self.seen + 1
+
+    def rebuild(self):
+        """Build the index from the tags table."""
+        # Ids missing from the log may be of transactions still open, whose
+        # writes the tags table does not show yet
+        seen = 0
+        gaps = {}
+        now = time()
+        for log_id, in db.session.query(TagChange.id).order_by(
+                TagChange.id).yield_per(BATCH_SIZE):
+            if seen:
+                gaps.update((gap, now) for gap in xrange(seen + 1, log_id))
+            seen = log_id
+        data = Bitmap(data_id for data_id, in db.session.query(
+            Data.id).yield_per(10000))
+        tags_map = {}
+        pairs = db.session.query(tags.c.tag_id, tags.c.data_id).order_by(
+            tags.c.tag_id).yield_per(10000)
+        for tag_id, group in groupby(pairs, lambda pair: pair[0]):
+            tags_map[tag_id] = Bitmap(data_id for _, data_id in group)
+        self._snapshot = Snapshot(tags_map, data)
+        self.seen = seen
+        self._gaps = gaps
+
+    def _catch_up(self):
+        """Apply the log rows after the last one seen and those that filled
+        gaps, BATCH_SIZE at a time. Queries see the new snapshot once all of
+        them are applied.
+
+        """
+        now = time()
+        snapshot = self._snapshot
+        new = TagChange.id > self.seen
+        if len(self._gaps) <= MAX_IN_PARAMS:
+            if self._gaps:
+                new = or_(new, TagChange.id.in_(sorted(self._gaps)))
+        else:
+            new = TagChange.id >= min(self._gaps)
+        rows = db.session.query(
+            TagChange.id, TagChange.data_id, TagChange.tag_id).filter(
+            new).order_by(TagChange.id).yield_per(BATCH_SIZE)
+        batch = []
+        for row in rows:
+            log_id = row[0]
+            if log_id <= self.seen:
+                if self._gaps.pop(log_id, None) is None:
+                    # Already applied
+                    continue
+            else:
+                self._gaps.update(
+                    (gap, now) for gap in xrange(self.seen + 1, log_id))
+                self.seen = log_id
+            batch.append(row)
+            if len(batch) >= BATCH_SIZE:
+                snapshot = self._apply(batch, snapshot)
+                batch = []
+        if batch:
+            snapshot = self._apply(batch, snapshot)
+        self._snapshot = snapshot
+        for gap, found in self._gaps.items():
+            if now - found > GAP_TIMEOUT:
+                log.info(u'Gave up on tag change {0}'.format(gap))
+                del self._gaps[gap]
+
+    def _apply(self, rows, snapshot):
+        """Return a copy of snapshot with the bits of the logged pairs set to
+        their current state.
+
+        """
+        data_ids = set(row[1] for row in rows)
+        existing = set()
+        current = set()
+        for chunk in chunks(data_ids):
+            existing.update(data_id for data_id, in db.session.query(
+                Data.id).filter(Data.id.in_(chunk)))
+            current.update(
+                (tag_id, data_id) for tag_id, data_id in db.session.query(
+                    tags.c.tag_id, tags.c.data_id).filter(
+                    tags.c.data_id.in_(chunk)))
+        tags_map = dict(snapshot.tags)
+        data = snapshot.data.copy()
+        copied = set()
+        for _, data_id, tag_id in rows:
+            if tag_id is None:
+                if data_id in existing:
+                    data.add(data_id)
+                else:
+                    data.discard(data_id)
+                continue
+            if tag_id not in copied:
+                bitmap = tags_map.get(tag_id)
+                tags_map[tag_id] = bitmap.copy() if bitmap else Bitmap()
+                copied.add(tag_id)
+            if (tag_id, data_id) in current:
+                tags_map[tag_id].add(data_id)
+            else:
+                tags_map[tag_id].discard(data_id)
+        return Snapshot(tags_map, data)
+
+    def evaluate(self, query):
+        """Return the Bitmap of the ids of Data that match query.
+
+        A query is a predicate on tags, {"op": "eq", "val": "a"} with op one
+        of OPERATORS, matched by Data with any such tag, or {"and": [queries]},
+        {"or": [queries]} or {"not": query}. Negations within a conjunction
+        are subtracted from it. Predicates may give the "name" of the key or
+        value of key:value tags to match instead of the whole tag.
+
+        """
+        return self._evaluate(query, self._snapshot)
+
+    def _evaluate(self, query, snapshot):
+        if not isinstance(query, dict):
+            raise QueryError(u'Unknown query {0!r}'.format(query))
+        if 'and' in query:
+            positives = []
+            negatives = []
+            for subquery in _subqueries(query['and']):
+                if isinstance(subquery, dict) and 'not' in subquery:
+                    negatives.append(subquery['not'])
+                else:
+                    positives.append(subquery)
+            result = snapshot.data
+            for subquery in positives:
+                result = result & self._evaluate(subquery, snapshot)
+                if not result:
+                    return result
+            for subquery in negatives:
+                result = result - self._evaluate(subquery, snapshot)
+                if not result:
+                    break
+            return result
+        if 'or' in query:
+            return Bitmap.union(self._evaluate(subquery, snapshot)
+                                for subquery in _subqueries(query['or']))
+        if 'not' in query:
+            return snapshot.data - self._evaluate(query['not'], snapshot)
+        return Bitmap.union(snapshot.tags[tag_id] for tag_id in _tag_ids(query)
+                            if tag_id in snapshot.tags)
+
+    def save(self, path):
+        """Write the index to a snapshot file at path."""
+        snapshot = self._snapshot
+        payload = marshal.dumps((
+            SNAPSHOT_FORMAT, self.seen, sorted(self._gaps),
+            snapshot.data.dump(),
+            dict((tag_id, bitmap.dump())
+                 for tag_id, bitmap in snapshot.tags.items())))
+        tmppath = '{0}.{1}'.format(path, uuid4().hex)
+        with open(tmppath, 'wb') as fff:
+            fff.write(zlib.compress(payload))
+        os.rename(tmppath, path)
+
+    def load(self, path):
+        """Read the index from a snapshot file. Returns whether it could."""
+        try:
+            with open(path, 'rb') as fff:
+                snapshot = marshal.loads(zlib.decompress(fff.read()))
+            if snapshot[0] != SNAPSHOT_FORMAT:
+                return False
+            version, seen, gaps, data, tags_map = snapshot
+        except (IOError, ValueError, TypeError, EOFError, zlib.error):
+            return False
+        self._snapshot = Snapshot(
+            dict((tag_id, Bitmap.load(bitmap))
+                 for tag_id, bitmap in tags_map.items()),
+            Bitmap.load(data))
+        self.seen = seen
+        now = time()
+        self._gaps = dict((gap, now) for gap in gaps)
+        return True
+
+    def snapshot(self, path=None, prune=False):
+        """Save an up to date snapshot, to path or the configured one.
+
+        With prune, log rows more than PRUNE_MARGIN before the lowest one
+        the snapshot may still need are deleted. Indices further behind
+        rebuild from the tags table.
+
+        Returns the number of log rows deleted.
+
+        """
+        self.sync()
+        with self._lock:
+            self.save(path or self.snapshot_path)
+            low = self._low()
+        if not prune:
+            return 0
+        deleted = TagChange.query.filter(
+            TagChange.id < low - PRUNE_MARGIN).delete(
+            synchronize_session=False)
+        db.session.commit()
+        return deleted
+
+
+def main(argv=None):
+    parser = ArgumentParser(
+        description='Save a snapshot of the tag index to start from.')
+    parser.add_argument('config', help='tagstore configuration file')
+    parser.add_argument('--snapshot', default=None,
+                        help='Snapshot file, default TAGINDEX_SNAPSHOT')
+    parser.add_argument('--prune', action='store_true',
+                        help='Delete the tag changes older than the snapshot')
+    args = parser.parse_args(argv)
+
+    from tagstore.server import create_app
+    app = create_app(args.config)
+    if not app.config['TAGINDEX_ENABLED']:
+        parser.error(u'TAGINDEX_ENABLED is not set')
+    path = args.snapshot or app.config['TAGINDEX_SNAPSHOT']
+    if not path:
+        parser.error(u'TAGINDEX_SNAPSHOT is not configured')
+    with app.app_context():
+        index = TagIndex()
+        deleted = index.snapshot(path, prune=args.prune)
+        print '{0} tags, {1} data, {2} log rows pruned'.format(
+            len(index._snapshot.tags), len(index._snapshot.data), deleted)
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,152 @@
+"""Set based plans for restless filters on the tags of Data.
+
+Restless compiles each tags any or not_any filter into an EXISTS subquery
+correlated with every Data row. rewrite_filters() replaces all such filters
+of a search with one in_tagset filter that compares Data.id with a set of
+data ids computed once from the tags association table:
+
+* Data with all of the wanted tags, counted with GROUP BY data_id HAVING
+  COUNT when they are single tags and INTERSECTed otherwise,
+* EXCEPT the Data with any unwanted tag.
+
+"""
+from inspect import getargspec
+
+from sqlalchemy import select, func, or_, intersect, except_
+
+from flask.ext.restless import search
+
+from tagstore.models import Tag, tags
+from tagstore.tagindex import COLUMNS
+
+
+OPERATOR = 'in_tagset'
+
+# Relation operators on Data.tags, negated or not
+RELATION_OPS = {
+    'any': False,
+    'not_any': True,
+}
+
+
+def _is_binary(op):
+    try:
+        return len(getargspec(search.OPERATORS[op]).args) == 2
+    except (KeyError, TypeError):
+        return False
+
+
+def tag_predicate(filt):
+    """Parse a restless filter on a column of the tags of Data.
+
+    Both {"name": "tags", "op": "any", "val": {"name": "tag", "op": "eq",
+    "val": "a"}} and the shorthand {"name": "tags__tag", "op": "any", "val":
+    "a"} are understood.
+
+    Returns (negated, [column, op, value]) or None for any other filter.
+
+    """
+    if not isinstance(filt, dict) or filt.get('op') not in RELATION_OPS:
+        return None
+    name = filt.get('name')
+    value = filt.get('val')
+    if name == 'tags' and isinstance(value, dict) and \
+            'or' not in value and 'and' not in value:
+        column, op, value = value.get('name'), value.get('op'), \
+            value.get('val')
+    elif isinstance(name, basestring) and name.startswith('tags__'):
+        column, op = name[len('tags__'):], 'eq'
+    else:
+        return None
+    if column not in COLUMNS or not _is_binary(op) or value is None:
+        return None
+    return RELATION_OPS[filt['op']], [column, op, value]
+
+
+def rewrite_filters(search_params):
+    """Replace the tag filters of restless search_params with one filter on
+    Data.id with the in_tagset operator.
+
+    Only the top level filters, which restless joins with AND, are rewritten.
+
+    """
+    filters = search_params.get('filters')
+    if not filters or not isinstance(filters, list):
+        # Left for restless to complain about
+        return
+    spec = dict(all=[], none=[])
+    rest = []
+    for filt in filters:
+        parsed = tag_predicate(filt)
+        if parsed is None:
+            rest.append(filt)
+        else:
+            negated, predicate = parsed
+            spec['none' if negated else 'all'].append(predicate)
+    if spec['all'] or spec['none']:
+        rest.append(dict(name='id', op=OPERATOR, val=spec))
+        search_params['filters'] = rest
+
+
+def _condition(predicate):
+    try:
+        column, op, value = predicate
+        return search.OPERATORS[op](COLUMNS[column], value)
+    except (KeyError, TypeError, ValueError):
+        raise ValueError(u'Unknown tag predicate {0!r}'.format(predicate))
+
+
+def _tagged(condition):
+    """Ids of Data with a tag meeting condition."""
+    return select([tags.c.data_id]).where(
+        tags.c.tag_id.in_(select([Tag.id]).where(condition))).where(
+        tags.c.data_id != None)
+
+
+def _tagged_all(predicates):
+    """Ids of Data with tags meeting every predicate."""
+    conditions = [_condition(predicate) for predicate in predicates]
+    if all(column == 'tag' and op == 'eq' and isinstance(value, basestring)
+           for column, op, value in predicates):
+        # Each tag is on a Data at most once
+        wanted = set(value for _, _, value in predicates)
+        return select([tags.c.data_id]).where(
+            tags.c.tag_id.in_(select([Tag.id]).where(Tag.tag.in_(wanted)))
+        ).where(tags.c.data_id != None).group_by(tags.c.data_id).having(
+            func.count(tags.c.tag_id) == len(wanted))
+    selects = [_tagged(condition) for condition in conditions]
+    if len(selects) == 1:
+        return selects[0]
+    both = intersect(*selects).alias()
+    return select([both.c.data_id])
+
+
+def tagset(spec):
+    """The select of the ids of Data matching an in_tagset spec,
+    {"all": [predicates], "none": [predicates]}.
+
+    Returns (select, negated). The Data wanted are those in the select, or
+    those not in it if negated, when only unwanted tags are given.
+
+    """
+    try:
+        wanted, unwanted = spec.get('all') or [], spec.get('none') or []
+    except AttributeError:
+        raise ValueError(u'Unknown tag set {0!r}'.format(spec))
+    if not wanted and not unwanted:
+        raise ValueError(u'Empty tag set')
+    if unwanted:
+        excluded = _tagged(or_(*[_condition(predicate)
+                                 for predicate in unwanted]))
+        if not wanted:
+            return excluded, True
+        return except_(_tagged_all(wanted), excluded), False
+    return _tagged_all(wanted), False
+
+
+def in_tagset(column, spec):
+    """Condition that column, Data.id, is in the tag set spec."""
+    ids, negated = tagset(spec)
+    if negated:
+        return ~column.in_(ids)
+    return column.in_(ids)
@@ -0,0 +1,202 @@
+"""Resumable uploads of blobs in chunks.
+
+An upload session is a directory holding the blob being assembled and a
+marker for each chunk received. Sessions are kept outside the pairtree of the
+OFS, which refuses to open a storage directory it did not create, but should
+be on the same filesystem. Chunks are written
+at their offset in the blob so they may arrive in any order, from any process,
+and be sent again. Committing moves the blob into the OFS without copying it.
+
+"""
+import os
+import os.path
+import re
+import json
+from uuid import uuid4
+from time import time
+from shutil import rmtree
+from logging import getLogger
+
+
+log = getLogger(__name__)
+
+
+SESSION_FILENAME = 'session.json'
+BLOB_FILENAME = 'blob'
+CHUNKS_DIRNAME = 'chunks'
+
+_session_id_re = re.compile('^[0-9a-f]{32}$')
+
+
+class ChunkError(ValueError):
+    """A chunk does not fit the session."""
+
+
+def _ranges(indices):
+    """[first, last] of each run of consecutive sorted indices."""
+    ranges = []
+    for index in indices:
+        if ranges and ranges[-1][1] == index - 1:
+            ranges[-1][1] = index
+        else:
+            ranges.append([index, index])
+    return ranges
+
+
+def _write_atomic(path, data):
+    tmppath = '{0}.{1}'.format(path, uuid4().hex)
+    with open(tmppath, 'wb') as fff:
+        fff.write(data)
+        fff.flush()
+        os.fsync(fff.fileno())
+    os.rename(tmppath, path)
+
+
+class UploadSession(object):
+    def __init__(self, path, info):
+        self.path = path
+        self.id = os.path.basename(path)
+        self.size = info['size']
+        self.chunk_size = info['chunk_size']
+        self.fname = info.get('fname')
+        self.created = info['created']
+
+    @property
+    def blob_path(self):
+        return os.path.join(self.path, BLOB_FILENAME)
+
+    @property
+    def num_chunks(self):
+        return max(1, (self.size + self.chunk_size - 1) // self.chunk_size)
+
+    def chunk_range(self, index):
+        """Return the (offset, length) of chunk index."""
+        if not 0 <= index < self.num_chunks:
+            raise ChunkError(u'Chunk {0} is not in 0..{1}'.format(
+                index, self.num_chunks - 1))
+        offset = index * self.chunk_size
+        return offset, min(self.chunk_size, self.size - offset)
+
+    def write_chunk(self, index, stream, buffer_size=2 ** 16):
+        """Write chunk index from stream, which must hold exactly its length.
+
+        The chunk is only marked received once it is on disk.
+
+        """
+        offset, length = self.chunk_range(index)
+        written = 0
+        with open(self.blob_path, 'r+b') as fff:
+            fff.seek(offset)
+            while written <= length:
+                data = stream.read(min(buffer_size, length + 1 - written))
+                if not data:
+                    break
+                if written + len(data) > length:
+                    raise ChunkError(
+                        u'Chunk {0} is longer than {1}'.format(index, length))
+                fff.write(data)
+                written += len(data)
+            if written != length:
+                raise ChunkError(u'Chunk {0} is {1} bytes, expected {2}'.format(
+                    index, written, length))
+            fff.flush()
+            os.fsync(fff.fileno())
+        _write_atomic(
+            os.path.join(self.path, CHUNKS_DIRNAME, str(index)), str(length))
+
+    def received(self):
+        """Sorted indices of the chunks received."""
+        chunks = []
+        for fname in os.listdir(os.path.join(self.path, CHUNKS_DIRNAME)):
+            try:
+                chunks.append(int(fname))
+            except ValueError:
+                # Marker being written
+                pass
+        return sorted(chunks)
+
+    def missing(self, received=None):
+        """[first, last] of each run of chunks still to be sent."""
+        if received is None:
+            received = self.received()
+        missing = []
+        first = 0
+        for index in received + [self.num_chunks]:
+            if index > first:
+                missing.append([first, index - 1])
+            first = index + 1
+        return missing
+
+    def to_dict(self):
+        received = self.received()
+        return dict(id=self.id, size=self.size, chunk_size=self.chunk_size,
+                    num_chunks=self.num_chunks, fname=self.fname,
+                    received=_ranges(received),
+                    missing=self.missing(received))
+
+    def remove(self):
+        rmtree(self.path, ignore_errors=True)
+
+
+class UploadSessions(object):
+    """Upload sessions of at most max_chunks chunks kept in the directory
+    root.
+
+    """
+    def __init__(self, root, max_chunks=None):
+        self.root = root
+        self.max_chunks = max_chunks
+
+    def create(self, size, chunk_size, fname=None):
+        if size < 0 or chunk_size < 1:
+            raise ValueError(u'Invalid size {0} or chunk size {1}'.format(
+                size, chunk_size))
+        num_chunks = (size + chunk_size - 1) // chunk_size
+        if self.max_chunks is not None and num_chunks > self.max_chunks:
+            raise ValueError(
+                u'{0} chunks of {1} bytes are more than {2}'.format(
+                    num_chunks, chunk_size, self.max_chunks))
+        path = os.path.join(self.root, uuid4().hex)
+        os.makedirs(os.path.join(path, CHUNKS_DIRNAME))
+        info = dict(size=size, chunk_size=chunk_size, fname=fname,
+                    created=time())
+        # Sparse until the chunks are written
+        with open(os.path.join(path, BLOB_FILENAME), 'wb') as fff:
+            fff.truncate(size)
+        _write_atomic(os.path.join(path, SESSION_FILENAME), json.dumps(info))
+        return UploadSession(path, info)
+
+    def get(self, session_id):
+        """Return the session with session_id or raise KeyError."""
+        if not _session_id_re.match(session_id):
+            raise KeyError(session_id)
+        path = os.path.join(self.root, session_id)
+        try:
+            with open(os.path.join(path, SESSION_FILENAME)) as fff:
+                info = json.load(fff)
+        except IOError:
+            raise KeyError(session_id)
+        return UploadSession(path, info)
+
+    def expire(self, max_age):
+        """Remove sessions created more than max_age seconds ago.
+
+        Returns the ids of the sessions removed.
+
+        """
+        try:
+            session_ids = os.listdir(self.root)
+        except OSError:
+            return []
+        expired = []
+        cutoff = time() - max_age
+        for session_id in session_ids:
+            try:
+                session = self.get(session_id)
+            except KeyError:
+                continue
+            if session.created < cutoff:
+                log.info(u'Expiring upload session {0}'.format(session_id))
+                session.remove()
+                expired.append(session_id)
+        return expired
@@ -0,0 +1,164 @@
+"""Inserts that settle conflicts on unique columns in the database.
+
+PostgreSQL settles them with INSERT ... ON CONFLICT, which also returns the
+row written. Elsewhere rows are inserted with OR IGNORE and read back in the
+same transaction, which SQLite makes safe by serializing writers.
+
+"""
+from sqlalchemy import func, literal_column
+from sqlalchemy.dialects import postgresql
+
+from tagstore.models import Data, Tag, TagGeneration, tags, split_tag, chunks
+from tagstore.tagindex import log_changes
+
+
+# How to treat Data whose URI is already present: leave it as it is, add the
+# new tags to its own and take the new fname if one is given, or make it
+# exactly as given
+ON_CONFLICT = ('ignore', 'merge', 'replace')
+
+
+def _is_postgresql(session):
+    return session.get_bind().dialect.name == 'postgresql'
+
+
+def insert_ignore(session, table, rows):
+    """Insert the rows that do not conflict with those present."""
+    if not rows:
+        return
+    if _is_postgresql(session):
+        insert = postgresql.insert(table).on_conflict_do_nothing()
+    else:
+        insert = table.insert().prefix_with(
+            'OR IGNORE', dialect='sqlite').prefix_with(
+            'IGNORE', dialect='mysql')
+    session.execute(insert, rows)
+
+
+def tag_generation(session):
+    """The current generation of the names of tags."""
+    return session.query(func.max(TagGeneration.id)).scalar() or 0
+
+
+def begin_tag_generation(session):
+    """Begin a generation of the names of tags in the current transaction,
+    which renames or deletes tags, so that every process drops the tag ids it
+    has cached once it commits.
+
+    """
+    table = TagGeneration.__table__
+    generation = session.execute(table.insert()).inserted_primary_key[0]
+    session.execute(table.delete().where(table.c.id < generation))
+
+
+def cached_tag_ids(session, names, cache):
+    """Map the tags named that are in cache, a GenerationalLRUCache of tag ids
+    by tag, to their ids.
+
+    cache is first cleared if the names of tags have changed since it was
+    filled, so one query covers all of the names.
+
+    """
+    cache.check_generation(tag_generation(session))
+    tag_ids = {}
+    for name in names:
+        tag_id = cache.get(name)
+        if tag_id is not None:
+            tag_ids[name] = tag_id
+    return tag_ids
+
+
+def resolve_tags(session, names, cache=None):
+    """Map the tags named to their ids, creating those missing.
+
+    The ids are taken from cache, a GenerationalLRUCache of tag ids by tag, if
+    given. The other existing tags are found by one query per
+    MAX_IN_PARAMS names and the missing ones inserted by a single statement,
+    skipping any created by another writer in the meantime.
+
+    """
+    names = set(names)
+    tag_ids = {}
+    if cache is not None:
+        tag_ids.update(cached_tag_ids(session, names, cache))
+    for chunk in chunks(names.difference(tag_ids)):
+        for name, tag_id in session.query(Tag.tag, Tag.id).filter(
+                Tag.tag.in_(chunk)):
+            tag_ids[name] = tag_id
+            # Only tags already committed, not those inserted below
+            if cache is not None:
+                cache.set(name, tag_id)
+    missing = sorted(names.difference(tag_ids))
+    if missing:
+        rows = []
+        for name in missing:
+            key, value = split_tag(name)
+            rows.append(dict(tag=name, key=key, value=value))
+        insert_ignore(session, Tag.__table__, rows)
+        for chunk in chunks(missing):
+            tag_ids.update(
+                session.query(Tag.tag, Tag.id).filter(Tag.tag.in_(chunk)))
+    return tag_ids
+
+
+def _upsert_row(session, uri, fname, on_conflict):
+    table = Data.__table__
+    if _is_postgresql(session):
+        insert = postgresql.insert(table).values(uri=uri, fname=fname)
+        if on_conflict == 'ignore':
+            # Updated to nothing so that the row is returned and locked
+            values = dict(uri=insert.excluded.uri)
+        elif on_conflict == 'merge':
+            values = dict(fname=func.coalesce(insert.excluded.fname,
+                                              table.c.fname))
+        else:
+            values = dict(fname=insert.excluded.fname)
+        # xmax is only zero for rows inserted rather than updated
+        return tuple(session.execute(insert.on_conflict_do_update(
+            index_elements=[table.c.uri], set_=values).returning(
+            table.c.id, literal_column('xmax = 0'))).first())
+
+    created = session.execute(table.insert().prefix_with(
+        'OR IGNORE', dialect='sqlite').prefix_with(
+        'IGNORE', dialect='mysql').values(uri=uri, fname=fname)).rowcount == 1
+    data_id = session.query(Data.id).filter(Data.uri == uri).scalar()
+    if not created and (on_conflict == 'replace' or
+                        on_conflict == 'merge' and fname is not None):
+        session.execute(table.update().where(table.c.id == data_id).values(
+            fname=fname))
+    return data_id, created
+
+
+def upsert_data(session, uri, fname, tag_names, on_conflict, cache=None):
+    """Create the Data with uri, or settle the conflict with the one present
+    as on_conflict, one of ON_CONFLICT, says. cache is passed on to
+    resolve_tags().
+
+    Returns the id of the Data and whether it was created. The caller
+    commits.
+
+    """
+    if on_conflict not in ON_CONFLICT:
+        raise ValueError(u'on_conflict must be one of {0}'.format(
+            u', '.join(ON_CONFLICT)))
+    tag_ids = set(resolve_tags(session, tag_names, cache).values())
+    data_id, created = _upsert_row(session, uri, fname, on_conflict)
+    if not created and on_conflict == 'ignore':
+        return data_id, created
+
+    current = set()
+    if not created:
+        current.update(tag_id for tag_id, in session.query(
+            tags.c.tag_id).filter(tags.c.data_id == data_id))
+    added = tag_ids - current
+    removed = current - tag_ids if on_conflict == 'replace' else set()
+    insert_ignore(session, tags, [dict(data_id=data_id, tag_id=tag_id)
+                                  for tag_id in sorted(added)])
+    for chunk in chunks(removed):
+        session.execute(tags.delete().where(tags.c.data_id == data_id).where(
+            tags.c.tag_id.in_(chunk)))
+    changes = set((data_id, tag_id) for tag_id in added | removed)
+    if created:
+        changes.add((data_id, None))
+    log_changes(session, changes)
+    return data_id, created
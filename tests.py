@@ -1,7 +1,10 @@
+import io
 import json
 import types
 import os.path
 from datetime import datetime, timedelta
+from hashlib import sha256
+from gzip import GzipFile
 from StringIO import StringIO
 import logging
 from time import sleep
@@ -20,11 +23,25 @@ from flask.ext.restless import ProcessingException
 
 import requests
 
+from ofs.local.storedjson import PersistentState
+
 import tagstore
 from tagstore import server
 from tagstore.server import ofs, OFSWrapper
 from tagstore.client import TagStoreClient, Query, DataResponse
-from tagstore.models import db, Tag, Data
+from tagstore.models import db, Tag, Data, TagChange
+from tagstore.patch.lockfile import FlockRLock, lockpath
+from tagstore.patch.restless import SERIALIZERS
+from tagstore.migrate import (
+    migrate_ofs_metadata, migrate_tag_keys, migrate_tag_changes,
+    migrate_tag_generations)
+from tagstore import ofsgc
+from tagstore.scrub import scrub
+from tagstore.shard import rebalance, move_label
+from tagstore.cache import LRUCache, GenerationalLRUCache
+from tagstore.upsert import begin_tag_generation
+from tagstore.tagindex import TagIndex
+from tagstore.tagsets import rewrite_filters
 
 
 API_ENDPOINT = '/api/v1'
@@ -38,23 +55,25 @@ def _create_test_app(self):
     return app
 
 
+def _remove_ofs_dirs(app):
+    for path in [app.config['PTOFS_DIR'], app.config['PTOFS_DIR'] + '.uploads']:
+        try:
+            rmtree(path)
+        except OSError:
+            pass
+
+
 class BaseTest(TestCase):
     create_app = _create_test_app
 
     def setUp(self):
         db.create_all()
-        try:
-            rmtree(self.app.config['PTOFS_DIR'])
-        except OSError:
-            pass
+        _remove_ofs_dirs(self.app)
 
     def tearDown(self):
         db.session.remove()
         db.drop_all()
-        try:
-            rmtree(self.app.config['PTOFS_DIR'])
-        except OSError:
-            pass
+        _remove_ofs_dirs(self.app)
 
 
 class TestUnit(BaseTest):
@@ -101,6 +120,79 @@ class TestUnit(BaseTest):
                          'inline; filename=test.txt')
         self.assertEqual(headers['Content-Type'], 'text/plain')
 
+    def test_flock_rlock(self):
+        """FlockRLock is reentrant per thread and excludes other threads."""
+        lock = FlockRLock(lockpath(self.app.config['PTOFS_DIR'], 'test'))
+        acquired = []
+
+        def run():
+            lock.acquire()
+            acquired.append(current_thread().name)
+            lock.release()
+
+        lock.acquire()
+        lock.acquire()
+        lock.release()
+        thread = Thread(target=run, name='other')
+        thread.start()
+        sleep(0.1)
+        self.assertEqual(acquired, [])
+        lock.release()
+        thread.join()
+        self.assertEqual(acquired, ['other'])
+        with self.assertRaises(RuntimeError):
+            lock.release()
+
+    def test_flock_rlock_shared(self):
+        """Shared holders do not block each other but block exclusive ones."""
+        lock = FlockRLock(lockpath(self.app.config['PTOFS_DIR'], 'test'))
+        acquired = []
+
+        def run(shared):
+            lock.acquire(shared=shared)
+            acquired.append(shared)
+            lock.release()
+
+        lock.acquire(shared=True)
+        self.assertTrue(lock.held_shared())
+        reader = Thread(target=run, args=(True, ))
+        reader.start()
+        reader.join()
+        self.assertEqual(acquired, [True])
+
+        writer = Thread(target=run, args=(False, ))
+        writer.start()
+        sleep(0.1)
+        self.assertEqual(acquired, [True])
+        lock.release()
+        writer.join()
+        self.assertEqual(acquired, [True, False])
+
+    def test_lru_cache(self):
+        cache = LRUCache(maxsize=2)
+        cache.set('a', 1)
+        cache.set('b', 2)
+        self.assertEqual(cache.get('a'), 1)
+        cache.set('c', 3)
+        # b was least recently used
+        self.assertEqual(cache.get('b'), None)
+        self.assertEqual(cache.get('c'), 3)
+        self.assertEqual(cache.stats()['hits'], 2)
+        self.assertEqual(cache.stats()['misses'], 1)
+
+        cache = LRUCache(maxsize=2, ttl=0)
+        cache.set('a', 1)
+        sleep(0.01)
+        self.assertEqual(cache.get('a'), None)
+
+        cache = GenerationalLRUCache(maxsize=2)
+        cache.check_generation(1)
+        cache.set('a', 1)
+        cache.check_generation(1)
+        self.assertEqual(cache.get('a'), 1)
+        cache.check_generation(2)
+        self.assertEqual(cache.get('a'), None)
+
     def test_zip_load(self):
         data = 'http://999.0.0.0'
         ddd = Data(data, 'broken')
@@ -186,6 +278,572 @@ class TestViews(RoutedTest):
         response = self.http('get', self.api_data_endpoint, data=params)
         self.assert_200(response)
 
+    def test_data_query_after(self):
+        for iii in range(25):
+            data = {'uri': 'u{0}'.format(iii), 'tags': [{'tag': 'm'}]}
+            response = self.http('post', self.api_data_endpoint,
+                                 data=json.dumps(data))
+            self.assert_status(response, 201, 'Failed to create data')
+        q = json.dumps(TagStoreClient.list_to_q(Query.tags_any('eq', 'm')))
+
+        uris = []
+        params = dict(q=q, results_per_page=10)
+        while True:
+            response = self.http('get', self.api_data_endpoint,
+                                 query_string=params)
+            self.assert_200(response)
+            uris += [datum['uri'] for datum in response.json['objects']]
+            if 'next' not in response.json:
+                break
+            params['after'] = response.json['next']
+        self.assertEqual(uris, ['u{0}'.format(iii) for iii in range(25)])
+
+        endpoint = '{0}/tags'.format(API_ENDPOINT)
+        response = self.http('get', endpoint,
+                             query_string=dict(results_per_page=1))
+        self.assertNotIn('next', response.json)
+
+        ordered = json.dumps(dict(order_by=[dict(field='uri',
+                                                 direction='desc')]))
+        response = self.http('get', self.api_data_endpoint,
+                             query_string=dict(q=ordered))
+        self.assertNotIn('next', response.json)
+        response = self.http('get', self.api_data_endpoint,
+                             query_string=dict(q=ordered, after=params['after']))
+        self.assert_400(response)
+        response = self.http('get', self.api_data_endpoint,
+                             query_string=dict(after='!'))
+        self.assert_400(response)
+
+        # Limited searches are paged by number, counted or not
+        limited = json.dumps(dict(limit=10, offset=3))
+        for count in ('true', 'false'):
+            uris = []
+            pages = dict(q=limited, results_per_page=4, count=count, page=1)
+            while True:
+                response = self.http('get', self.api_data_endpoint,
+                                     query_string=pages)
+                self.assert_200(response)
+                self.assertNotIn('next', response.json)
+                uris += [datum['uri'] for datum in response.json['objects']]
+                if pages['page'] >= response.json['total_pages']:
+                    break
+                pages['page'] += 1
+            self.assertEqual(uris, ['u{0}'.format(iii) for iii in range(3, 13)])
+        response = self.http('get', self.api_data_endpoint,
+                             query_string=dict(q=limited, after=params['after']))
+        self.assert_400(response)
+
+    def test_data_query_uncounted(self):
+        for iii in range(15):
+            data = {'uri': 'u{0}'.format(iii), 'tags': [{'tag': 'm'}]}
+            response = self.http('post', self.api_data_endpoint,
+                                 data=json.dumps(data))
+            self.assert_status(response, 201, 'Failed to create data')
+        q = json.dumps(TagStoreClient.list_to_q(Query.tags_any('eq', 'm')))
+
+        params = dict(q=q, results_per_page=10, count='false')
+        response = self.http('get', self.api_data_endpoint,
+                             query_string=params)
+        self.assert_200(response)
+        self.assertNotIn('num_results', response.json)
+        self.assertTrue(response.json['more'])
+        self.assertEqual(len(response.json['objects']), 10)
+        params['after'] = response.json['next']
+        response = self.http('get', self.api_data_endpoint,
+                             query_string=params)
+        self.assertFalse(response.json['more'])
+        self.assertEqual(len(response.json['objects']), 5)
+
+        count_endpoint = '{0}/count'.format(self.api_data_endpoint)
+        response = self.http('get', count_endpoint, query_string=dict(q=q))
+        self.assert_200(response)
+        self.assertEqual(response.json['num_results'], 15)
+        # Cached
+        db.session.delete(Data.query.first())
+        db.session.commit()
+        response = self.http('get', count_endpoint, query_string=dict(q=q))
+        self.assertEqual(response.json['num_results'], 15)
+        server.counts.clear()
+        response = self.http('get', count_endpoint, query_string=dict(q=q))
+        self.assertEqual(response.json['num_results'], 14)
+
+        response = self.http('get', '{0}/tags/count'.format(API_ENDPOINT))
+        self.assertEqual(response.json['num_results'], 1)
+        response = self.http('get', count_endpoint,
+                             query_string=dict(q='{"filters": 1}'))
+        self.assert_400(response)
+
+    def test_tag_id_cache(self):
+        def post(uri, *tags):
+            data = {'uri': uri, 'tags': [{'tag': tag} for tag in tags]}
+            response = self.http('post', self.api_data_endpoint,
+                                 data=json.dumps(data))
+            self.assert_status(response, 201, 'Failed to create data')
+            return response.json
+
+        post('u0', 'm', 'z')
+        post('u1', 'm', 'z')
+        self.assertEqual(server.tag_id_cache.stats()['hits'], 0)
+        datum = post('u2', 'm')
+        response = self.http('get', '{0}/caches'.format(API_ENDPOINT))
+        self.assert_200(response)
+        self.assertEqual(response.json['tag_ids']['hits'], 1)
+        self.assertIsNotNone(response.json['tag_ids']['hit_rate'])
+
+        # Renamed tags are forgotten
+        m_id = datum['tags'][0]['id']
+        response = self.http('patch', '{0}/tags/{1}'.format(API_ENDPOINT, m_id),
+                             data=json.dumps(dict(tag='m2')))
+        self.assert_200(response)
+        datum = post('u3', 'm')
+        self.assertNotEqual(datum['tags'][0]['id'], m_id)
+
+        # Deleted tags are forgotten
+        z_id = Tag.query.filter_by(tag=u'z').one().id
+        # Cleared by the rename
+        self.assertIsNone(server.tag_id_cache.get(u'z'))
+        server.tag_id_cache.set(u'z', z_id)
+        for uri in ('u0', 'u1'):
+            db.session.delete(Data.query.filter_by(uri=uri).one())
+        db.session.commit()
+        response = self.http('delete', '{0}/tags/{1}'.format(API_ENDPOINT, z_id))
+        self.assert_status(response, 204, 'Failed to delete tag')
+        datum = post('u4', 'z')
+        self.assertNotEqual(datum['tags'][0]['id'], z_id)
+
+        # Shared with bulk creates
+        response = self.http('post', '{0}/bulk'.format(self.api_data_endpoint),
+                             data=json.dumps(dict(objects=[
+                                 {'uri': 'u5', 'tags': [{'tag': 'z'}]}])))
+        self.assert_status(response, 201, 'Failed to create data in bulk')
+        self.assertEqual(server.tag_id_cache.get(u'z'), datum['tags'][0]['id'])
+
+        # Tags renamed by other processes are forgotten
+        z_id = datum['tags'][0]['id']
+        Tag.query.get(z_id).tag = u'z2'
+        begin_tag_generation(db.session)
+        db.session.commit()
+        self.assertEqual(server.tag_id_cache.get(u'z'), z_id)
+        datum = post('u6', 'z')
+        self.assertNotEqual(datum['tags'][0]['id'], z_id)
+        Tag.query.get(datum['tags'][0]['id']).tag = u'z3'
+        begin_tag_generation(db.session)
+        db.session.commit()
+        response = self.http('post', '{0}/bulk'.format(self.api_data_endpoint),
+                             data=json.dumps(dict(objects=[
+                                 {'uri': 'u7', 'tags': [{'tag': 'z'}]}])))
+        self.assert_status(response, 201, 'Failed to create data in bulk')
+        self.assertEqual(
+            [tag.tag for tag in Data.query.filter_by(uri=u'u7').one().tags],
+            [u'z'])
+
+    def test_data_post_on_conflict(self):
+        def post(on_conflict, **data):
+            return self.http('post', self.api_data_endpoint,
+                             query_string=dict(on_conflict=on_conflict),
+                             data=json.dumps(data))
+
+        response = post('ignore', uri='u', fname='f',
+                        tags=[{'tag': 'm'}, {'tag': 'n'}])
+        self.assert_status(response, 201, 'Failed to create data')
+        data_id = response.json['id']
+        self.assertEqual(sorted(tag['tag'] for tag in response.json['tags']),
+                         ['m', 'n'])
+
+        response = post('ignore', uri='u', fname='g', tags=[{'tag': 'o'}])
+        self.assert_200(response)
+        self.assertEqual(response.json['id'], data_id)
+        self.assertEqual(response.json['fname'], 'f')
+        self.assertEqual(len(response.json['tags']), 2)
+
+        response = post('merge', uri='u', tags=[{'tag': 'o'}, {'tag': 'm'}])
+        self.assert_200(response)
+        self.assertEqual(response.json['fname'], 'f')
+        self.assertEqual(sorted(tag['tag'] for tag in response.json['tags']),
+                         ['m', 'n', 'o'])
+
+        response = post('replace', uri='u', fname='g', tags=[{'tag': 'p'}])
+        self.assert_200(response)
+        self.assertEqual(response.json['fname'], 'g')
+        self.assertEqual([tag['tag'] for tag in response.json['tags']], ['p'])
+        self.assertEqual(Data.query.count(), 1)
+
+        # Seen by the tag index
+        tagquery_endpoint = '{0}/tagquery'.format(self.api_data_endpoint)
+        for tag, num_results in (('p', 1), ('m', 0)):
+            response = self.http('get', tagquery_endpoint, query_string=dict(
+                q=json.dumps({'op': 'eq', 'val': tag})))
+            self.assertEqual(response.json['num_results'], num_results)
+
+        self.assert_400(post('upsert', uri='u'))
+        self.assert_400(post('merge', fname='f'))
+        response = self.http('post', self.api_data_endpoint,
+                             data=json.dumps(dict(uri='u')))
+        self.assert_status(response, 409, 'Conflict without on_conflict')
+
+    def test_data_retag(self):
+        for uri, tags in (('u0', ['a']), ('u1', ['a', 'b']), ('u2', ['a', 'c']),
+                          ('u3', ['b'])):
+            data = {'uri': uri, 'tags': [{'tag': tag} for tag in tags]}
+            response = self.http('post', self.api_data_endpoint,
+                                 data=json.dumps(data))
+            self.assert_status(response, 201, 'Failed to create data')
+        retag_endpoint = '{0}/retag'.format(self.api_data_endpoint)
+
+        def retag(old, new, *filters):
+            body = dict(old=old, new=new,
+                        q=TagStoreClient.list_to_q(*filters))
+            response = self.http('post', retag_endpoint,
+                                 data=json.dumps(body))
+            self.assert_200(response)
+            return response.json['num_results']
+
+        def tags_of(uri):
+            return sorted(tag.tag for tag in
+                          Data.query.filter_by(uri=uri).one().tags)
+
+        self.assertEqual(retag('a', 'b', Query.tags_any('eq', 'c')), 1)
+        self.assertEqual(tags_of('u2'), ['b', 'c'])
+        self.assertEqual(tags_of('u0'), ['a'])
+
+        self.assertEqual(retag('a', 'b'), 2)
+        self.assertEqual([tags_of(uri) for uri in ('u0', 'u1', 'u3')],
+                         [['b'], ['b'], ['b']])
+        self.assertEqual(retag('a', 'b'), 0)
+        self.assertEqual(retag('missing', 'b'), 0)
+
+        self.assertEqual(retag('b', 'd', ['uri', 'eq', 'u3']), 1)
+        self.assertEqual(tags_of('u3'), ['d'])
+        self.assertEqual(Tag.query.filter_by(tag=u'd').one().key, None)
+
+        # Seen by the tag index
+        response = self.http(
+            'get', '{0}/tagquery'.format(self.api_data_endpoint),
+            query_string=dict(q=json.dumps({'op': 'eq', 'val': 'b'})))
+        self.assertEqual(response.json['num_results'], 3)
+
+        response = self.http('post', retag_endpoint,
+                             data=json.dumps(dict(old='b')))
+        self.assert_400(response)
+        response = self.http('post', retag_endpoint, data=json.dumps(
+            dict(old='b', new='e', q={'filters': [{'name': 'nope'}]})))
+        self.assert_400(response)
+
+    def test_tag_merge(self):
+        for uri, tags in (('u0', ['a']), ('u1', ['a', 'b']), ('u2', ['b']),
+                          ('u3', ['c'])):
+            data = {'uri': uri, 'tags': [{'tag': tag} for tag in tags]}
+            response = self.http('post', self.api_data_endpoint,
+                                 data=json.dumps(data))
+            self.assert_status(response, 201, 'Failed to create data')
+        a_id, b_id, c_id = [Tag.query.filter_by(tag=tag).one().id
+                            for tag in (u'a', u'b', u'c')]
+
+        def tags_of(uri):
+            return sorted(tag.tag for tag in
+                          Data.query.filter_by(uri=uri).one().tags)
+
+        def merge(tag_id, into):
+            return self.http('post', '{0}/tags/{1}/merge'.format(
+                API_ENDPOINT, tag_id), data=json.dumps(dict(into=into)))
+
+        response = merge(a_id, b_id)
+        self.assert_200(response)
+        self.assertEqual(response.json, dict(id=b_id, tag='b', num_results=2))
+        self.assertEqual([tags_of(uri) for uri in ('u0', 'u1', 'u2')],
+                         [['b'], ['b'], ['b']])
+        self.assertIsNone(Tag.query.get(a_id))
+
+        # Renaming to a present tag merges too
+        response = self.http('patch', '{0}/tags/{1}'.format(
+            API_ENDPOINT, c_id), data=json.dumps(dict(tag='b')))
+        self.assert_200(response)
+        self.assertEqual(response.json['id'], b_id)
+        self.assertEqual(tags_of('u3'), ['b'])
+        self.assertEqual(Tag.query.count(), 1)
+
+        response = self.http(
+            'get', '{0}/tagquery'.format(self.api_data_endpoint),
+            query_string=dict(q=json.dumps({'op': 'eq', 'val': 'b'})))
+        self.assertEqual(response.json['num_results'], 4)
+
+        self.assert_404(merge(a_id, b_id))
+        self.assert_400(merge(b_id, b_id))
+        self.assert_400(merge(b_id, 'b'))
+
+    def test_data_bulk_create(self):
+        data = {'uri': 'u0', 'tags': [{'tag': 'm'}]}
+        response = self.http('post', self.api_data_endpoint,
+                             data=json.dumps(data))
+        self.assert_status(response, 201, 'Failed to create data')
+
+        bulk_endpoint = '{0}/bulk'.format(self.api_data_endpoint)
+        objects = [
+            {'uri': 'u1', 'fname': 'f1', 'tags': [{'tag': 'm'}, {'tag': 'k:v'}]},
+            {'uri': 'u0', 'tags': [{'tag': 'n'}]},
+            {'uri': 'u2', 'tags': [{'tag': 'n'}, {'tag': 'n'}]},
+            {'uri': 'u1', 'tags': []},
+            {'uri': 'u3'},
+        ]
+        response = self.http('post', bulk_endpoint,
+                             data=json.dumps(dict(objects=objects)))
+        self.assert_status(response, 201, 'Failed to create data in bulk')
+        ids = response.json['ids']
+        self.assertEqual(response.json['num_created'], 3)
+        self.assertEqual([iid is None for iid in ids],
+                         [False, True, False, True, False])
+
+        datum = Data.query.get(ids[0])
+        self.assertEqual(datum.fname, 'f1')
+        self.assertEqual(sorted(tag.tag for tag in datum.tags), ['k:v', 'm'])
+        self.assertEqual(Tag.query.filter_by(tag='k:v').one().key, 'k')
+        self.assertEqual([tag.tag for tag in Data.query.get(ids[2]).tags],
+                         ['n'])
+        self.assertEqual(Data.query.get(ids[4]).tags, [])
+        self.assertEqual(Tag.query.count(), 3)
+
+        # Seen by the tag index
+        response = self.http(
+            'get', '{0}/tagquery'.format(self.api_data_endpoint),
+            query_string=dict(q=json.dumps({'op': 'eq', 'val': 'n'})))
+        self.assertEqual([obj['id'] for obj in response.json['objects']],
+                         [ids[2]])
+
+        response = self.http('post', bulk_endpoint, data=json.dumps(
+            dict(objects=[{'uri': 'u4', 'tags': ['m']}])))
+        self.assert_400(response)
+        response = self.http('post', bulk_endpoint, data='[]')
+        self.assert_400(response)
+        self.assertEqual(Data.query.count(), 4)
+
+    def test_data_listing_serializer(self):
+        for iii in range(12):
+            data = {'uri': 'u{0}'.format(iii), 'fname': 'f{0}'.format(iii),
+                    'tags': [{'tag': 'k:{0}'.format(jjj)}
+                             for jjj in range(iii % 4)]}
+            response = self.http('post', self.api_data_endpoint,
+                                 data=json.dumps(data))
+            self.assert_status(response, 201, 'Failed to create data')
+
+        def pages(**params):
+            result = []
+            for page in (1, 2, 3):
+                params['page'] = page
+                response = self.http('get', self.api_data_endpoint,
+                                     query_string=params)
+                self.assert_200(response)
+                for datum in response.json['objects']:
+                    datum['tags'].sort(key=lambda tag: tag['id'])
+                result.append(response.json)
+            return result
+
+        params = dict(results_per_page=5)
+        fast = pages(**params)
+        fast_uncounted = pages(count='false', **params)
+        serializer = SERIALIZERS.pop(Data)
+        try:
+            self.assertEqual(fast, pages(**params))
+            self.assertEqual(fast_uncounted, pages(count='false', **params))
+        finally:
+            SERIALIZERS[Data] = serializer
+        self.assertEqual(fast[0]['num_results'], 12)
+        self.assertEqual(fast[2]['objects'][0]['tags'][0]['key'], 'k')
+
+    def test_data_query_tagsets(self):
+        for uri, tags in [('a', ['m', 'n']), ('b', ['m', 'o']), ('c', ['o']),
+                          ('d', [])]:
+            data = {'uri': uri, 'tags': [{'tag': tag} for tag in tags]}
+            response = self.http('post', self.api_data_endpoint,
+                                 data=json.dumps(data))
+            self.assert_status(response, 201, 'Failed to create data')
+
+        def uris(*filters):
+            q = TagStoreClient.list_to_q(*filters)
+            response = self.http('get', self.api_data_endpoint,
+                                 query_string=dict(q=json.dumps(q)))
+            self.assert_200(response)
+            return sorted(datum['uri'] for datum in response.json['objects'])
+
+        m = Query.tags_any('eq', 'm')
+        not_n = ['tags', 'not_any', ['tag', 'eq', 'n']]
+        self.assertEqual(uris(m, Query.tags_any('eq', 'o')), ['b'])
+        self.assertEqual(uris(m, not_n), ['b'])
+        self.assertEqual(uris(not_n, ['tags__tag', 'not_any', 'o']), ['d'])
+        self.assertEqual(uris(Query.tags_any('like', '%'), not_n,
+                              ['uri', 'ne', 'c']), ['b'])
+        self.assertEqual(uris(Query.tags_any('in', ['n', 'o']),
+                              Query.tags_any('startswith', 'o')), ['b', 'c'])
+
+        q = TagStoreClient.list_to_q(m, not_n, ['uri', 'ne', 'c'])
+        rewrite_filters(q)
+        self.assertEqual(q['filters'], [
+            dict(name='uri', op='ne', val='c'),
+            dict(name='id', op='in_tagset',
+                 val=dict(all=[['tag', 'eq', 'm']],
+                          none=[['tag', 'eq', 'n']]))])
+
+    def test_data_tagquery(self):
+        endpoint = '{0}/tagquery'.format(self.api_data_endpoint)
+        for uri, tags in [('a', ['m', 'n']), ('b', ['m', 'o']), ('c', ['o'])]:
+            data = {'uri': uri, 'tags': [{'tag': tag} for tag in tags]}
+            response = self.http('post', self.api_data_endpoint,
+                                 data=json.dumps(data))
+            self.assert_status(response, 201, 'Failed to create data')
+
+        def uris(query):
+            response = self.http('get', endpoint,
+                                 query_string=dict(q=json.dumps(query)))
+            self.assert_200(response)
+            return [datum['uri'] for datum in response.json['objects']]
+
+        m_not_n = Query.all_of(Query.tag('eq', 'm'),
+                               Query.not_(Query.tag('eq', 'n')))
+        self.assertEqual(uris(m_not_n), ['b'])
+        self.assertEqual(
+            uris(Query.any_of(Query.tag('eq', 'n'), Query.tag('eq', 'o'))),
+            ['a', 'b', 'c'])
+        self.assertEqual(uris(Query.not_(Query.tag('in', ['m', 'n']))), ['c'])
+
+        # Writes are seen by the index
+        datum = Data.query.filter_by(uri='a').one()
+        datum.tags = [Tag.query.filter_by(tag=u'm').one()]
+        db.session.commit()
+        self.assertEqual(uris(m_not_n), ['a', 'b'])
+        db.session.delete(Data.query.filter_by(uri='b').one())
+        db.session.commit()
+        self.assertEqual(uris(m_not_n), ['a'])
+
+        response = self.http('get', endpoint, query_string=dict(
+            q=json.dumps({'op': 'eq', 'val': 'o'}), results_per_page=1))
+        self.assertEqual(response.json['num_results'], 1)
+        self.assertEqual(response.json['total_pages'], 1)
+
+        response = self.http('get', endpoint, query_string=dict(
+            q=json.dumps({'and': []})))
+        self.assert_400(response)
+
+        # A snapshot starts an index where it left off
+        try:
+            os.makedirs(self.app.config['PTOFS_DIR'])
+        except OSError:
+            pass
+        path = os.path.join(self.app.config['PTOFS_DIR'], 'tagindex')
+        server.tagindex.snapshot(path, prune=True)
+        index = TagIndex(path)
+        index.sync()
+        self.assertEqual(list(index.evaluate(m_not_n)),
+                         [Data.query.filter_by(uri='a').one().id])
+
+    def test_tagindex_gaps(self):
+        """Tag changes committed after ones with higher log ids are seen."""
+        a, b, m = Data(u'a'), Data(u'b'), Tag(u'm')
+        db.session.add_all([a, b, m])
+        db.session.commit()
+        index = TagIndex()
+        index.sync()
+        seen = index.seen
+        query = {'op': 'eq', 'val': 'm'}
+
+        def tag(datum, log_id):
+            db.session.execute(tagstore.models.tags.insert(), dict(
+                tag_id=m.id, data_id=datum.id))
+            db.session.execute(TagChange.__table__.insert(), dict(
+                id=log_id, data_id=datum.id, tag_id=m.id))
+            db.session.commit()
+
+        tag(b, seen + 5)
+        index.sync()
+        self.assertEqual(list(index.evaluate(query)), [b.id])
+        self.assertEqual(sorted(index._gaps), range(seen + 1, seen + 5))
+        before = index._snapshot
+
+        tag(a, seen + 2)
+        index.sync()
+        self.assertEqual(list(index.evaluate(query)), [a.id, b.id])
+        # Catching up leaves the snapshot queries may still be reading alone
+        self.assertEqual(list(index._evaluate(query, before)), [b.id])
+        self.assertEqual(sorted(index._gaps), [seen + 1, seen + 3, seen + 4])
+
+        # Gaps are given up on eventually
+        index._gaps = dict.fromkeys(index._gaps, 0)
+        index.sync()
+        self.assertEqual(index._gaps, {})
+
+    def test_tagindex_disabled(self):
+        """Apps without the tag index do not log tag changes."""
+        app = Flask(__name__)
+        app.config.from_object('tagstore.settings.default')
+        app.config.from_object('tagstore.settings.test')
+        app.config['TAGINDEX_ENABLED'] = False
+        server.init_app(app)
+        # The session of this thread belongs to the test app
+        db.session.remove()
+        try:
+            with app.app_context():
+                db.create_all()
+                datum = Data(u'a')
+                datum.tags = [Tag(u'm')]
+                db.session.add(datum)
+                db.session.commit()
+                self.assertEqual(TagChange.query.count(), 0)
+                response = app.test_client().get(
+                    '{0}/tagquery'.format(self.api_data_endpoint),
+                    query_string=dict(q=json.dumps({'op': 'eq', 'val': 'm'})))
+                self.assert_404(response)
+                db.session.remove()
+        finally:
+            db.session.remove()
+
+    def test_tag_key_value(self):
+        for uri, tags in [('a', ['cruise:1', 'expocode:33AB']),
+                          ('b', ['cruise:2', 'expocode:33CD', 'x']),
+                          ('c', ['cruise:3', 'expocode:49EF'])]:
+            data = {'uri': uri, 'tags': [{'tag': tag} for tag in tags]}
+            response = self.http('post', self.api_data_endpoint,
+                                 data=json.dumps(data))
+            self.assert_status(response, 201, 'Failed to create data')
+        tag = Tag.query.filter_by(tag=u'expocode:33AB').one()
+        self.assertEqual((tag.key, tag.value), (u'expocode', u'33AB'))
+        tag.tag = u'expocode:33AA'
+        self.assertEqual(tag.value, u'33AA')
+        db.session.commit()
+
+        response = self.http('get', '{0}/tags/keys'.format(API_ENDPOINT))
+        self.assert_200(response)
+        self.assertEqual(response.json['objects'], [
+            dict(key='cruise', num_tags=3), dict(key='expocode', num_tags=3)])
+        response = self.http('get', '{0}/tags/keys'.format(API_ENDPOINT),
+                             query_string=dict(prefix='exp'))
+        self.assertEqual(len(response.json['objects']), 1)
+
+        def uris(*filters):
+            q = TagStoreClient.list_to_q(*filters)
+            response = self.http('get', self.api_data_endpoint,
+                                 query_string=dict(q=json.dumps(q)))
+            self.assert_200(response)
+            return sorted(datum['uri'] for datum in response.json['objects'])
+
+        self.assertEqual(uris(Query.tags_key('cruise')), ['a', 'b', 'c'])
+        self.assertEqual(uris(Query.tags_startswith('expocode:33')),
+                         ['a', 'b'])
+        self.assertEqual(
+            uris(Query.tags_any('between', ['cruise:2', 'cruise:9'])),
+            ['b', 'c'])
+
+        q = TagStoreClient.list_to_q(['key', 'eq', 'expocode'],
+                                     ['value', 'startswith', '33'])
+        response = self.http('get', '{0}/tags'.format(API_ENDPOINT),
+                             query_string=dict(q=json.dumps(q)))
+        self.assertEqual(sorted(tag['tag'] for tag in response.json['objects']),
+                         ['expocode:33AA', 'expocode:33CD'])
+
+        server.tagindex.sync()
+        matches = server.tagindex.evaluate(Query.all_of(
+            Query.tag('eq', 'cruise', name='key'),
+            Query.not_(Query.tag('startswith', '4', name='value'))))
+        self.assertEqual(len(matches), 2)
+
     def test_ofs_get(self):
         filecontents = 'btlex'
         aaa = StringIO(filecontents)
@@ -209,6 +867,146 @@ class TestViews(RoutedTest):
         self.assertTrue(
             resp.headers['content-disposition'].startswith('attachment'))
 
+    def test_ofs_get_range(self):
+        resp = self.http('post', self.api_ofs_endpoint,
+                         data={'blob': (StringIO('btlex'), 'namea')},
+                         content_type='multipart/form-data')
+        path = urlsplit(json.loads(resp.data)['uri']).path
+
+        resp = self.http('get', path, headers={'Range': 'bytes=1-3'})
+        self.assert_status(resp, 206)
+        self.assertEqual(resp.data, 'tle')
+        self.assertEqual(resp.headers['Content-Range'], 'bytes 1-3/5')
+        self.assertEqual(resp.headers['Content-Length'], '3')
+
+        resp = self.http('get', path, headers={'Range': 'bytes=-2'})
+        self.assert_status(resp, 206)
+        self.assertEqual(resp.data, 'ex')
+
+        resp = self.http('get', path, headers={'Range': 'bytes=9-'})
+        self.assert_status(resp, 416)
+        self.assertEqual(resp.headers['Content-Range'], 'bytes */5')
+
+        # A stale If-Range sends everything.
+        resp = self.http('get', path, headers={
+            'Range': 'bytes=1-3', 'If-Range': '"stale"'})
+        self.assert_200(resp)
+        self.assertEqual(resp.data, 'btlex')
+
+        etag = self.http('head', path).headers['ETag']
+        resp = self.http('get', path, headers={
+            'Range': 'bytes=1-3', 'If-Range': etag})
+        self.assert_status(resp, 206)
+        self.assertEqual(resp.data, 'tle')
+
+        # Weak validators never match If-Range
+        resp = self.http('get', path, headers={
+            'Range': 'bytes=1-3', 'If-Range': 'W/' + etag})
+        self.assert_200(resp)
+
+    def test_ofs_get_conditional(self):
+        resp = self.http('post', self.api_ofs_endpoint,
+                         data={'blob': (StringIO('btlex'), 'namea')},
+                         content_type='multipart/form-data')
+        path = urlsplit(json.loads(resp.data)['uri']).path
+
+        resp = self.http('get', path)
+        self.assert_200(resp)
+        etag = resp.headers['ETag']
+        self.assertEqual(etag, '"{0}"'.format(sha256('btlex').hexdigest()))
+        last_modified = resp.headers['Last-Modified']
+
+        resp = self.http('head', path)
+        self.assertEqual(resp.headers['ETag'], etag)
+        self.assertEqual(resp.headers['Last-Modified'], last_modified)
+
+        for method in ['get', 'head']:
+            resp = self.http(method, path, headers={'If-None-Match': etag})
+            self.assert_status(resp, 304)
+            self.assertEqual(resp.data, '')
+            self.assertEqual(resp.headers['ETag'], etag)
+            resp = self.http(method, path,
+                             headers={'If-Modified-Since': last_modified})
+            self.assert_status(resp, 304)
+
+        resp = self.http('get', path, headers={'If-None-Match': 'W/' + etag})
+        self.assert_status(resp, 304)
+        resp = self.http('get', path, headers={'If-None-Match': '*'})
+        self.assert_status(resp, 304)
+
+        # If-None-Match takes precedence over If-Modified-Since
+        resp = self.http('get', path, headers={
+            'If-None-Match': '"other"', 'If-Modified-Since': last_modified})
+        self.assert_200(resp)
+        self.assertEqual(resp.data, 'btlex')
+
+        resp = self.http('get', path, headers={
+            'If-Modified-Since': 'Thu, 01 Jan 1970 00:00:00 GMT'})
+        self.assert_200(resp)
+
+    def test_ofs_get_sendfile(self):
+        resp = self.http('post', self.api_ofs_endpoint,
+                         data={'blob': (StringIO('btlex'), 'namea')},
+                         content_type='multipart/form-data')
+        path = urlsplit(json.loads(resp.data)['uri']).path
+        label = os.path.basename(path)
+
+        self.app.config['OFS_SENDFILE'] = 'x-sendfile'
+        resp = self.http('get', path)
+        self.assert_200(resp)
+        self.assertEqual(resp.data, '')
+        sendfile = resp.headers['X-Sendfile']
+        self.assertTrue(os.path.isabs(sendfile))
+        self.assertEqual(open(sendfile).read(), 'btlex')
+
+        self.app.config['OFS_SENDFILE'] = 'x-accel-redirect'
+        resp = self.http('get', path)
+        redirect = resp.headers['X-Accel-Redirect']
+        self.assertTrue(redirect.startswith(
+            self.app.config['OFS_ACCEL_REDIRECT_PREFIX'] + '/'))
+        self.assertTrue(redirect.endswith(label))
+
+    def test_ofs_metadata_cache(self):
+        resp = self.http('post', self.api_ofs_endpoint,
+                         data={'blob': (StringIO('btlex'), 'namea')},
+                         content_type='multipart/form-data')
+        path = urlsplit(json.loads(resp.data)['uri']).path
+
+        cache = ofs.ofs.metadata.cache
+        hits = cache.hits
+        self.http('head', path)
+        resp = self.http('head', path)
+        self.assertEqual(cache.hits, hits + 1)
+        self.assertTrue(resp.headers['content-disposition'].endswith('namea'))
+
+        # Updates invalidate the cached metadata.
+        resp = self.http('put', path, data={'fname': 'nameb'},
+                         content_type='multipart/form-data')
+        resp = self.http('head', path)
+        self.assertTrue(resp.headers['content-disposition'].endswith('nameb'))
+
+        # but only of the label updated by this process
+        resp = self.http('post', self.api_ofs_endpoint,
+                         data={'blob': (StringIO('btlex'), 'namec')},
+                         content_type='multipart/form-data')
+        pathc = urlsplit(json.loads(resp.data)['uri']).path
+        self.http('head', path)
+        hits = cache.hits
+        self.http('put', pathc, data={'fname': 'named'},
+                  content_type='multipart/form-data')
+        resp = self.http('head', path)
+        self.assertEqual(cache.hits, hits + 1)
+        self.assertTrue(resp.headers['content-disposition'].endswith('nameb'))
+        resp = self.http('get', '{0}/caches'.format(API_ENDPOINT))
+        self.assertEqual(resp.json['ofs_metadata']['hits'], cache.hits)
+
+        # Updates by other processes empty the cache
+        other = OFSWrapper(**self.app.extensions['tagstore_ofs'].kwargs)
+        other.call('update_metadata', os.path.basename(path),
+                   {'fname': 'namee'})
+        resp = self.http('head', path)
+        self.assertTrue(resp.headers['content-disposition'].endswith('namee'))
+
     def test_ofs_put(self):
         filecontents0 = 'btlex'
         filecontents1 = 'btlex'
@@ -233,6 +1031,109 @@ class TestViews(RoutedTest):
         self.assert_200(resp)
         self.assertEqual(resp.data, filecontents1)
 
+    def test_ofs_put_streamed(self):
+        resp = self.http('post', self.api_ofs_endpoint,
+                         data={'blob': (StringIO('btlex'), 'namea'),
+                               'other': (StringIO('ignored'), 'nameb')},
+                         content_type='multipart/form-data')
+        self.assert_200(resp)
+        path = urlsplit(json.loads(resp.data)['uri']).path
+        label = os.path.basename(path)
+
+        # Raw bodies are the blob itself
+        resp = self.http('put', path + '?fname=raw.txt', data='raw blob',
+                         content_type='application/octet-stream')
+        self.assert_200(resp)
+        resp = self.http('get', path)
+        self.assertEqual(resp.data, 'raw blob')
+        self.assertEqual(resp.headers['ETag'],
+                         '"{0}"'.format(sha256('raw blob').hexdigest()))
+        self.assertEqual(resp.headers['Content-Length'], '8')
+        self.assertTrue('raw.txt' in resp.headers['Content-Disposition'])
+
+        # Urlencoded forms only rename the blob
+        resp = self.client.put(path, data={'fname': 'renamed.txt'})
+        self.assert_200(resp)
+        resp = self.http('get', path)
+        self.assertEqual(resp.data, 'raw blob')
+        self.assertTrue('renamed.txt' in resp.headers['Content-Disposition'])
+
+        # Nothing is left behind beside the blob
+        dirpath = os.path.dirname(ofs.call('get_path', label))
+        self.assertEqual(
+            [fname for fname in os.listdir(dirpath) if '.part-' in fname], [])
+
+        resp = self.http('post', self.api_ofs_endpoint,
+                         content_type='application/octet-stream')
+        self.assert_400(resp)
+
+    def test_ofs_upload_session(self):
+        uploads_endpoint = '{0}/uploads'.format(self.api_ofs_endpoint)
+        resp = self.http('post', uploads_endpoint,
+                         data=json.dumps(dict(size=10, chunk_size=4,
+                                              fname='chunked')))
+        self.assert_status(resp, 201)
+        session = json.loads(resp.data)
+        self.assertEqual(session['num_chunks'], 3)
+        self.assertEqual(session['missing'], [[0, 2]])
+        path = urlsplit(resp.headers['Location']).path
+
+        # Chunks may arrive out of order and be sent again
+        self.assert_status(self.http('put', path + '/2', data='89'), 204)
+        self.assert_status(self.http('put', path + '/0', data='0123'), 204)
+        self.assert_status(self.http('put', path + '/0', data='0123'), 204)
+        self.assert_400(self.http('put', path + '/1', data='45'))
+        self.assert_400(self.http('put', path + '/1', data='456789'))
+        self.assert_400(self.http('put', path + '/3', data='x'))
+
+        resp = self.http('get', path)
+        self.assertEqual(json.loads(resp.data)['received'], [[0, 0], [2, 2]])
+        resp = self.http('post', path + '/commit')
+        self.assert_status(resp, 409)
+        self.assertEqual(json.loads(resp.data)['missing'], [[1, 1]])
+
+        self.assert_status(self.http('put', path + '/1', data='4567'), 204)
+        resp = self.http('post', path + '/commit')
+        self.assert_200(resp)
+        data = json.loads(resp.data)
+        self.assertEqual(data['fname'], 'chunked')
+        resp = self.http('get', urlsplit(data['uri']).path)
+        self.assertEqual(resp.data, '0123456789')
+        self.assertEqual(resp.headers['ETag'],
+                         '"{0}"'.format(sha256('0123456789').hexdigest()))
+
+        # Committed sessions are gone
+        self.assert_404(self.http('get', path))
+        self.assert_404(self.http('get', uploads_endpoint + '/unknown'))
+
+        # Too many chunks
+        max_chunks = self.app.config['OFS_UPLOAD_MAX_CHUNKS']
+        resp = self.http('post', uploads_endpoint, data=json.dumps(dict(
+            size=max_chunks + 1, chunk_size=1)))
+        self.assert_400(resp)
+        resp = self.http('post', uploads_endpoint, data=json.dumps(dict(
+            size=max_chunks, chunk_size=1)))
+        self.assert_status(resp, 201)
+        self.assertEqual(json.loads(resp.data)['missing'],
+                         [[0, max_chunks - 1]])
+
+    def test_ofs_upload_session_new_store(self):
+        """Upload sessions do not keep a new OFS from being created."""
+        ofs_dir = self.app.config['PTOFS_DIR']
+        self.assertFalse(os.path.exists(ofs_dir))
+        uploads_endpoint = '{0}/uploads'.format(self.api_ofs_endpoint)
+        resp = self.http('post', uploads_endpoint,
+                         data=json.dumps(dict(size=3, chunk_size=4)))
+        self.assert_status(resp, 201)
+        path = urlsplit(resp.headers['Location']).path
+        self.assertFalse(os.path.exists(ofs_dir))
+
+        self.assert_status(self.http('put', path + '/0', data='abc'), 204)
+        resp = self.http('post', path + '/commit')
+        self.assert_200(resp)
+        resp = self.http('get', urlsplit(json.loads(resp.data)['uri']).path)
+        self.assertEqual(resp.data, 'abc')
+
     def test_ofs_delete(self):
         filecontents0 = 'btlex'
         aaa = StringIO(filecontents0)
@@ -281,6 +1182,35 @@ class TestViews(RoutedTest):
         threada.join()
         threadb.join()
 
+    def test_ofs_shared(self):
+        """The OFS engine is built once and shared between requests."""
+        with self.app.test_request_context():
+            first = server.get_ofs()
+        with self.app.test_request_context():
+            self.assertIs(server.get_ofs(), first)
+
+    def test_patch_ptofs_idempotent(self):
+        """Creating more OFSWrappers must not stack PersistentState patches."""
+        ofs_dir = self.app.config['PTOFS_DIR']
+        OFSWrapper(storage_dir=ofs_dir)
+        init = PersistentState.__init__
+        OFSWrapper(storage_dir=ofs_dir)
+        self.assertEqual(PersistentState.__init__, init)
+
+    def test_ofs_create_failure_releases_lock(self):
+        """A failed OFSWrapper init does not keep the OFS lock held."""
+        ofs_dir = self.app.config['PTOFS_DIR']
+        with self.assertRaises(TypeError):
+            OFSWrapper(storage_dir=ofs_dir, no_such_option=True)
+
+        created = []
+        thread = Thread(target=lambda: created.append(
+            OFSWrapper(storage_dir=ofs_dir)))
+        thread.daemon = True
+        thread.start()
+        thread.join(5)
+        self.assertEqual(len(created), 1)
+
     def test_ofs_create_processsafe(self):
         """Creating OFSWrapper needs to be processsafe.
 
@@ -420,24 +1350,33 @@ class TestViews(RoutedTest):
         def runa():
             ofs = OFSWrapper(storage_dir=ofs_dir)
 
-            _, json_payload = ofs.ofs._get_object(bucket)
-            json_payload.update(dict(aaa=111))
-            log.debug('aaa {0}'.format(json_payload))
+            ofs.locks.ptofs.acquire()
+            try:
+                _, json_payload = ofs.ofs._get_object(bucket)
+                json_payload.update(dict(aaa=111))
+                log.debug('aaa {0}'.format(json_payload))
 
-            # Avoid deadlock when B correctly waits for PTOFS lock and A is
-            # already holding it. Allow A to continue and release the lock.
-            count = 0
-            while count < 1 and not pausea.acquire(False):
-                sleep(0.1)
-                count += 1
-            json_payload.sync()
+                # Avoid deadlock when B correctly waits for PTOFS lock and A
+                # is already holding it. Allow A to continue and release the
+                # lock.
+                count = 0
+                while count < 1 and not pausea.acquire(False):
+                    sleep(0.1)
+                    count += 1
+                json_payload.sync()
+            finally:
+                ofs.locks.ptofs.release()
 
         def runb():
             ofs = OFSWrapper(storage_dir=ofs_dir)
-            _, json_payload = ofs.ofs._get_object(bucket)
-            json_payload.update(dict(bbb=222))
-            log.debug('bbb {0}'.format(json_payload))
-            json_payload.sync()
+            ofs.locks.ptofs.acquire()
+            try:
+                _, json_payload = ofs.ofs._get_object(bucket)
+                json_payload.update(dict(bbb=222))
+                log.debug('bbb {0}'.format(json_payload))
+                json_payload.sync()
+            finally:
+                ofs.locks.ptofs.release()
 
         pa = Process(target=runa)
         pb = Process(target=runb)
@@ -496,6 +1435,332 @@ class TestViews(RoutedTest):
                          sorted([os.path.basename(dataa['uri']),
                           os.path.basename(datab['uri'])]))
 
+    def test_gc_incremental(self):
+        labels = []
+        for name in ['namea', 'nameb', 'namec', 'named']:
+            resp = self.http('post', self.api_ofs_endpoint,
+                             data={'blob': (StringIO(name), name)},
+                             content_type='multipart/form-data')
+            labels.append(os.path.basename(json.loads(resp.data)['uri']))
+        labels.sort()
+        db.session.add(Data('http://localhost{0}/{1}'.format(
+            self.api_ofs_endpoint, labels[1])))
+        db.session.flush()
+        olddate = (datetime.now() - timedelta(seconds=61)).strftime(
+            '%Y-%m-%dT%H:%M:%S')
+        _, json_payload = ofs.ofs._get_object(ofs.BUCKET_LABEL)
+        for label in labels:
+            json_payload[label]['_last_modified'] = olddate
+        json_payload.sync()
+        del json_payload
+
+        reported = []
+        stats = ofsgc.collect(ofs, batch_size=1, dry_run=True,
+                              report=reported.append)
+        self.assertEqual(stats['deleted'], 3)
+        self.assertEqual(stats['referenced'], 1)
+        self.assertEqual(reported, [labels[0], labels[2], labels[3]])
+        self.assertEqual(ofs.call('list_labels'), labels)
+
+        class Interrupted(Exception):
+            pass
+
+        def interrupt(label):
+            if label == labels[2]:
+                raise Interrupted()
+        checkpoint = os.path.join(self.app.config['PTOFS_DIR'], 'gc.checkpoint')
+        with self.assertRaises(Interrupted):
+            ofsgc.collect(ofs, batch_size=1, checkpoint=checkpoint,
+                          report=interrupt)
+        self.assertTrue(os.path.exists(checkpoint))
+        # Referenced through a host first seen after the interruption
+        db.session.add(Data('http://otherhost{0}/{1}'.format(
+            self.api_ofs_endpoint, labels[3])))
+        db.session.flush()
+        stats = ofsgc.collect(ofs, batch_size=1, checkpoint=checkpoint)
+        self.assertEqual(stats['examined'], 4)
+        self.assertFalse(os.path.exists(checkpoint))
+        self.assertEqual(ofs.call('list_labels'), [labels[1], labels[3]])
+
+    def test_scrub(self):
+        for label in ['aaa', 'bbb', 'ccc', 'ddd']:
+            ofs.call('put_stream', label, StringIO(label * 10))
+        dirpath = os.path.dirname(ofs.call('get_path', 'aaa'))
+        os.remove(os.path.join(dirpath, 'bbb'))
+        with open(os.path.join(dirpath, 'ccc'), 'wb') as fff:
+            fff.write('ccc')
+        with open(os.path.join(dirpath, 'ddd'), 'wb') as fff:
+            fff.write('x' * 30)
+        with open(os.path.join(dirpath, 'eee'), 'wb') as fff:
+            fff.write('eee')
+
+        problems = []
+        stats = scrub(ofs._get_current_object(), processes=2,
+                      report=lambda name, problem: problems.append(
+                          (os.path.basename(name), problem)))
+        self.assertEqual(sorted(problems), [
+            ('bbb', 'missing'), ('ccc', 'truncated'), ('ddd', 'corrupt'),
+            ('eee', 'orphan')])
+        self.assertEqual(stats['ok'], 1)
+        self.assertTrue('_verified' in ofs.call('get_metadata', 'aaa'))
+
+        # Recently verified blobs are not read again
+        stats = scrub(ofs._get_current_object(), processes=2, max_age=1,
+                      orphans=False, report=lambda name, problem: None)
+        self.assertEqual(stats['skipped'], 1)
+        self.assertEqual(stats['checked'], 2)
+
+    def test_ofs_sqlite_metadata(self):
+        """Metadata can be kept in SQLite instead of PersistentState."""
+        ofs_dir = self.app.config['PTOFS_DIR']
+        wrapper = OFSWrapper(storage_dir=ofs_dir, metadata='sqlite')
+        wrapper.call('put_stream', 'bbb', StringIO('bbb'))
+        wrapper.call('put_stream', 'aaa', StringIO('aaa'))
+        wrapper.call('update_metadata', 'aaa', {'fname': 'namea'})
+
+        meta = wrapper.call('get_metadata', 'aaa')
+        self.assertEqual(meta['fname'], 'namea')
+        self.assertEqual(meta['_content_length'], 3)
+        self.assertEqual(wrapper.call('list_labels'), ['aaa', 'bbb'])
+        self.assertEqual(wrapper.call('list_labels', after='aaa'), ['bbb'])
+
+        wrapper.call('del_stream', 'bbb')
+        self.assertEqual(wrapper.call('list_labels'), ['aaa'])
+        with self.assertRaises(Exception):
+            wrapper.call('get_metadata', 'bbb')
+
+        _, json_payload = wrapper.ofs._get_object(wrapper.BUCKET_LABEL)
+        self.assertEqual(len(json_payload), 0)
+
+    def test_ofs_dedup(self):
+        """Identical blobs are stored once and freed with their last label."""
+        resp = self.http('get', self.api_ofs_endpoint)
+        self.assertFalse(json.loads(resp.data)['dedup'])
+        kwargs = dict(self.app.extensions['tagstore_ofs'].kwargs, dedup=True)
+        self.app.extensions['tagstore_ofs'] = server.OFSEngine(**kwargs)
+        resp = self.http('get', self.api_ofs_endpoint)
+        self.assertTrue(json.loads(resp.data)['dedup'])
+
+        labels = []
+        for fname in ['namea', 'nameb']:
+            resp = self.http('post', self.api_ofs_endpoint,
+                             data={'blob': (StringIO('btlex'), fname)},
+                             content_type='multipart/form-data')
+            labels.append(os.path.basename(json.loads(resp.data)['uri']))
+        patha, pathb = [ofs.call('get_path', label) for label in labels]
+        self.assertEqual(os.stat(patha).st_ino, os.stat(pathb).st_ino)
+        self.assertEqual(ofs.call('refcount', labels[0]), 2)
+
+        # Known contents are linked without being sent
+        checksum = sha256('btlex').hexdigest()
+        resp = self.http('post', '{0}?sha256={1}&fname=namec'.format(
+            self.api_ofs_endpoint, checksum))
+        self.assert_200(resp)
+        path = urlsplit(json.loads(resp.data)['uri']).path
+        resp = self.http('get', path)
+        self.assertEqual(resp.data, 'btlex')
+        self.assertTrue('namec' in resp.headers['Content-Disposition'])
+        labels.append(os.path.basename(path))
+        self.assertEqual(ofs.call('refcount', labels[0]), 3)
+
+        resp = self.http('post', '{0}?sha256={1}'.format(
+            self.api_ofs_endpoint, sha256('other').hexdigest()))
+        self.assert_404(resp)
+
+        for label in labels:
+            self.http('delete', '{0}/{1}'.format(self.api_ofs_endpoint, label))
+        cas = os.path.join(os.path.dirname(patha), '.cas')
+        self.assertEqual([fname for _, _, fnames in os.walk(cas)
+                          for fname in fnames], [])
+
+    def test_ofs_compression(self):
+        """Text blobs are stored compressed and sent as the client accepts."""
+        kwargs = dict(self.app.extensions['tagstore_ofs'].kwargs,
+                      compression='gzip')
+        self.app.extensions['tagstore_ofs'] = server.OFSEngine(**kwargs)
+
+        text = ''.join('{0:5d}, 12.345, 2.0\n'.format(iii)
+                       for iii in range(10000))
+        resp = self.http('post', self.api_ofs_endpoint,
+                         data={'blob': (StringIO(text), 'a_hy1.csv')},
+                         content_type='multipart/form-data')
+        label = os.path.basename(json.loads(resp.data)['uri'])
+        meta = ofs.call('get_metadata', label)
+        self.assertEqual(meta['_encoding'], 'gzip')
+        self.assertEqual(meta['_content_length'], len(text))
+        self.assertEqual(os.path.getsize(ofs.call('get_path', label)),
+                         meta['_stored_length'])
+        self.assertTrue(meta['_stored_length'] < len(text) / 5)
+
+        path = '{0}/{1}'.format(self.api_ofs_endpoint, label)
+        resp = self.http('get', path)
+        self.assertEqual(resp.data, text)
+        self.assertTrue('Content-Encoding' not in resp.headers)
+        self.assertEqual(resp.headers['Vary'], 'Accept-Encoding')
+        resp = self.http('get', path, headers={'Range': 'bytes=100-109'})
+        self.assertEqual(resp.data, text[100:110])
+
+        resp = self.http('get', path, headers={'Accept-Encoding': 'gzip'})
+        self.assertEqual(resp.headers['Content-Encoding'], 'gzip')
+        self.assertEqual(int(resp.headers['Content-Length']),
+                         meta['_stored_length'])
+        self.assertEqual(GzipFile(fileobj=StringIO(resp.data)).read(), text)
+        self.assertNotEqual(resp.headers['ETag'],
+                            self.http('get', path).headers['ETag'])
+
+        # Binary and small blobs are stored as they are
+        for fname, data in [('b.zip', text), ('c.txt', 'ccc'),
+                            ('d', '\0' * 10000)]:
+            ofs.call('put_stream', fname, StringIO(data), {'fname': fname})
+            self.assertTrue('_encoding' not in ofs.call('get_metadata', fname))
+        stats = scrub(ofs._get_current_object(), processes=1)
+        self.assertEqual(stats['ok'], 4)
+
+    def test_ofs_sharded(self):
+        """Labels are spread over shards and rebalanced onto a new one."""
+        ofs_dir = self.app.config['PTOFS_DIR']
+        os.makedirs(ofs_dir)
+        shard_dirs = [os.path.join(ofs_dir, 'shard{0}'.format(iii))
+                      for iii in range(3)]
+        kwargs = dict(self.app.extensions['tagstore_ofs'].kwargs)
+        del kwargs['storage_dir']
+        self.app.extensions['tagstore_ofs'] = server.OFSEngine(
+            storage_dirs=shard_dirs[:2], **kwargs)
+
+        labels = ['label{0:02d}'.format(iii) for iii in range(60)]
+        for label in labels:
+            ofs.call('put_stream', label, StringIO(label))
+        for shard in ofs.shards:
+            self.assertTrue(shard.call('list_labels'))
+        self.assertEqual(ofs.call('list_labels'), labels)
+        self.assertEqual(ofs.call('list_labels', after=labels[9], limit=5),
+                         labels[10:15])
+
+        self.app.extensions['tagstore_ofs'] = server.OFSEngine(
+            storage_dirs=shard_dirs, **kwargs)
+        # Readable before being moved
+        for label in labels:
+            resp = self.http('get', '{0}/{1}'.format(
+                self.api_ofs_endpoint, label))
+            self.assertEqual(resp.data, label)
+
+        meta = ofs.call('get_metadata', labels[0])
+        stats = rebalance(ofs._get_current_object())
+        self.assertEqual(stats['moved'],
+                         len(ofs.shards[2].call('list_labels')))
+        self.assertTrue(0 < stats['moved'] < len(labels) / 2)
+        for label in labels:
+            self.assertTrue(ofs.shard_for(label).call('exists', label))
+            resp = self.http('get', '{0}/{1}'.format(
+                self.api_ofs_endpoint, label))
+            self.assertEqual(resp.data, label)
+        self.assertEqual(ofs.call('get_metadata', labels[0]), meta)
+        self.assertEqual(ofs.call('list_labels'), labels)
+        self.assertEqual(rebalance(ofs._get_current_object())['moved'], 0)
+
+    def test_ofs_sharded_move_written(self):
+        """Labels written while they are moved are not overwritten."""
+        ofs_dir = self.app.config['PTOFS_DIR']
+        os.makedirs(ofs_dir)
+        shard_dirs = [os.path.join(ofs_dir, 'shard{0}'.format(iii))
+                      for iii in range(2)]
+        kwargs = dict(self.app.extensions['tagstore_ofs'].kwargs)
+        del kwargs['storage_dir']
+        self.app.extensions['tagstore_ofs'] = server.OFSEngine(
+            storage_dirs=shard_dirs, **kwargs)
+        sharded = ofs._get_current_object()
+        source, target = sharded.shards
+        labels = [label for label in ['label{0:02d}'.format(iii)
+                                      for iii in range(20)]
+                  if sharded.shard_for(label) is target][:2]
+        for label in labels:
+            source.call('put_stream', label, StringIO('old'))
+
+        class WrittenSource(object):
+            """source, with write() run once label has been read."""
+            def __init__(self, write):
+                self.write = write
+
+            def call(self, method, *args, **kwargs):
+                result = source.call(method, *args, **kwargs)
+                if method == 'get_stream':
+                    self.write()
+                return result
+
+            def __getattr__(self, name):
+                return getattr(source, name)
+
+        # Stored on its shard meanwhile
+        moved = move_label(WrittenSource(lambda: sharded.call(
+            'put_stream', labels[0], StringIO('new'))), target, labels[0])
+        self.assertFalse(moved)
+        self.assertFalse(source.call('exists', labels[0]))
+        self.assertEqual(sharded.call('get_stream', labels[0]).read(), 'new')
+
+        # Renamed where it was
+        moved = move_label(WrittenSource(lambda: sharded.call(
+            'update_metadata', labels[1], {'fname': 'new'})), target,
+            labels[1])
+        self.assertFalse(moved)
+        self.assertFalse(target.call('exists', labels[1]))
+        self.assertEqual(
+            sharded.call('get_metadata', labels[1])['fname'], 'new')
+        # Examined again on target once moved
+        self.assertEqual(rebalance(sharded),
+                         dict(examined=3, moved=1, skipped=0))
+        self.assertEqual(target.call('get_metadata', labels[1])['fname'],
+                         'new')
+
+    def test_migrate_ofs_metadata(self):
+        ofs_dir = self.app.config['PTOFS_DIR']
+        wrapper = OFSWrapper(storage_dir=ofs_dir)
+        wrapper.call('put_stream', 'aaa', StringIO('aaa'))
+        wrapper.call('update_metadata', 'aaa', {'fname': 'namea'})
+        meta = wrapper.call('get_metadata', 'aaa')
+
+        counts = migrate_ofs_metadata(ofs_dir)
+        self.assertEqual(counts[wrapper.BUCKET_LABEL], 1)
+
+        wrapper = OFSWrapper(storage_dir=ofs_dir, metadata='sqlite')
+        self.assertEqual(wrapper.call('get_metadata', 'aaa'), meta)
+        self.assertEqual(wrapper.call('list_labels'), ['aaa'])
+
+    def test_migrate_tag_keys(self):
+        # A tag table from before key and value
+        db.session.execute('DROP TABLE tag')
+        db.session.execute(
+            'CREATE TABLE tag (id INTEGER PRIMARY KEY, tag VARCHAR(512) UNIQUE)')
+        db.session.execute(
+            "INSERT INTO tag (tag) VALUES ('cruise:a'), ('b'), ('c:d:e')")
+        db.session.commit()
+
+        self.assertEqual(migrate_tag_keys(batch_size=2), 2)
+        self.assertEqual(migrate_tag_keys(), 2)
+        self.assertEqual(
+            [(tag.key, tag.value) for tag in Tag.query.order_by(Tag.id)],
+            [(u'cruise', u'a'), (None, None), (u'c', u'd:e')])
+
+    def test_migrate_tag_changes(self):
+        db.session.execute('DROP TABLE tag_changes')
+        db.session.commit()
+
+        self.assertTrue(migrate_tag_changes())
+        self.assertFalse(migrate_tag_changes())
+        self.assertEqual(TagChange.query.count(), 0)
+
+    def test_migrate_tag_generations(self):
+        db.session.execute('DROP TABLE tag_generations')
+        db.session.commit()
+
+        self.assertTrue(migrate_tag_generations())
+        self.assertFalse(migrate_tag_generations())
+        begin_tag_generation(db.session)
+        begin_tag_generation(db.session)
+        db.session.commit()
+        self.assertEqual(
+            db.session.execute('SELECT id FROM tag_generations').fetchall(),
+            [(2, )])
+
     def test_zip(self):
         faa = StringIO('aaa')
         resp = self.http('post', self.api_ofs_endpoint,
@@ -532,18 +1797,12 @@ class TestClient(LiveServerTestCase):
 
     def setUp(self):
         super(TestClient, self).setUp()
-        try:
-            rmtree(self.app.config['PTOFS_DIR'])
-        except OSError:
-            pass
+        _remove_ofs_dirs(self.app)
         self.tstore = TagStoreClient(self.FQ_API_ENDPOINT)
 
     def tearDown(self):
         super(TestClient, self).tearDown()
-        try:
-            rmtree(self.app.config['PTOFS_DIR'])
-        except OSError:
-            pass
+        _remove_ofs_dirs(self.app)
         with self.app.app_context():
             db.session.remove()
             db.drop_all()
@@ -564,6 +1823,33 @@ class TestClient(LiveServerTestCase):
         resp = self.tstore.create('aaa', None, [u'm', u'n'])
         self.assertEqual(resp, None)
 
+        resp = self.tstore.create('aaa', None, [u'o'], on_conflict='merge')
+        self.assertEqual(sorted(resp.tags), [u'm', u'n', u'o'])
+
+    def test_create_stream(self):
+        """Streams that cannot be rewound are sent without being read."""
+        read_fd, write_fd = os.pipe()
+        os.write(write_fd, 'btlex')
+        os.close(write_fd)
+        with io.open(read_fd, 'rb') as fobj:
+            resp = self.tstore.create(fobj, 'piped', [u'm'])
+        self.assertEqual(resp.fname, 'piped')
+        self.assertEqual(requests.get(resp.uri).content, 'btlex')
+
+    def test_create_many(self):
+        self.tstore.create('aaa', None, [u'm'])
+        records = ((u'test:{0}'.format(iii), None, [u'm', u'n{0}'.format(iii)])
+                   for iii in range(5))
+        ids = self.tstore.create_many(records, chunk_size=2)
+        self.assertEqual(len(ids), 5)
+        ids = self.tstore.create_many([('aaa', None, []), ('bbb', 'b', [])])
+        self.assertIsNone(ids[0])
+
+        resp = self.tstore.query_data(Query.tags_any('eq', u'm'))
+        self.assertEqual(len(resp), 6)
+        self.assertEqual(resp[1].fname, u'test:0')
+        self.assertEqual(sorted(resp[1].tags), [u'm', u'n0'])
+
     def test_query_data(self):
         self.tstore.create('aaa', None, [u'm', u'n'])
         self.tstore.create('bbb', None, [u'm', u'o'])
@@ -581,6 +1867,17 @@ class TestClient(LiveServerTestCase):
         resp = self.tstore.query_tags(['tag', 'like', u'n:/asdf%'])
         self.assertEquals(len(resp), 2)
 
+    def test_tag_keys(self):
+        self.tstore.create('aaa', None, [u'cruise:1', u'm'])
+        self.tstore.create('bbb', None, [u'cruise:2', u'expocode:x'])
+
+        self.assertEqual(self.tstore.tag_keys(),
+                         [(u'cruise', 2), (u'expocode', 1)])
+        resp = self.tstore.query_data(Query.tags_key(u'expocode'))
+        self.assertEquals(len(resp), 1)
+        resp = self.tstore.query_tags(['tag', 'in', [u'm', u'cruise:1']])
+        self.assertEquals(len(resp), 2)
+
     def test_edit(self):
         resp = self.tstore.create('aaa', None, [u'm', u'n'])
 
@@ -616,6 +1913,29 @@ class TestClient(LiveServerTestCase):
         self.assertTrue(headers['content-disposition'].endswith('blob'))
         self.assertEqual(headers['content-length'], '5')
 
+    def test_upload(self):
+        contents = ''.join(chr(iii % 256) for iii in range(1000))
+        uri = self.tstore.upload(StringIO(contents), 'chunked', chunk_size=64,
+                                 parallelism=3)
+        self.assertTrue(uri.startswith(self.tstore._api_endpoint('ofs')))
+        resp = requests.get(uri)
+        self.assertEqual(resp.content, contents)
+        self.assertTrue(resp.headers['content-disposition'].endswith('chunked'))
+
+        # Resume an interrupted upload into the same label
+        resp = requests.post(self.tstore._api_endpoint('ofs', 'uploads'),
+                             data=json.dumps(dict(size=1000, chunk_size=300)))
+        session = resp.headers['Location']
+        requests.put(session + '/1', data=contents[::-1][300:600])
+        resp = requests.post(session + '/commit', data='{}')
+        self.assertEqual(resp.status_code, 409)
+        self.assertEqual(resp.json()['missing'], [[0, 0], [2, 3]])
+
+        label = os.path.basename(uri)
+        self.assertEqual(self.tstore.upload(
+            StringIO(contents[::-1]), session=session, label=label), uri)
+        self.assertEqual(requests.get(uri).content, contents[::-1])
+
     def test_delete_tag(self):
         resp = self.tstore.create('aaa', 'aname', ['taga'])
         tag = self.tstore.query_tags(['tag', 'eq', 'taga'])[0]
@@ -659,6 +1979,28 @@ class TestClient(LiveServerTestCase):
         resp = self.tstore.query_data(Query.tags_any('eq', u'asdf'), single=True)
         self.assertIsNone(resp)
 
+    def test_query_response_after(self):
+        for iii in range(25):
+            self.tstore.create(u'test:{0:02d}'.format(iii), None, [u'm'])
+        tstore = TagStoreClient(self.FQ_API_ENDPOINT, results_per_page=10)
+
+        resp = tstore.query_data(Query.tags_any('eq', u'm'))
+        # Counted when asked for
+        self.assertIsNone(resp.num_results)
+        self.assertEqual(len(resp), 25)
+        self.assertEqual([datum.uri for datum in resp],
+                         [u'test:{0:02d}'.format(iii) for iii in range(25)])
+        self.assertTrue(resp.by_cursor)
+        self.assertEqual(resp[24].uri, u'test:24')
+
+        resp = tstore.query_data(Query.tags_any('eq', u'm'), preload=True)
+        self.assertEqual(len(resp.objects), 25)
+
+        resp = tstore.query_data(Query.tags_any('eq', u'm'), limit=12)
+        self.assertEqual([datum.uri for datum in resp],
+                         [u'test:{0:02d}'.format(iii) for iii in range(12)])
+        self.assertFalse(resp.by_cursor)
+
     def test_data_response(self):
         """Reading from a Data pointing to a URL should make the request."""
         data = self.tstore.create(self.FQ_API_ENDPOINT + '/data')
@@ -698,6 +2040,17 @@ class TestClient(LiveServerTestCase):
         tags = self.tstore.query_tags()
         self.assertEqual(len(tags), 1)
 
+    def test_merge_tags(self):
+        self.tstore.create('uri0', 'fname', ['oldtag1'])
+        self.tstore.create('uri1', 'fname', ['oldtag2', 'oldtag1'])
+        tag1, tag2 = [self.tstore.query_tags(
+            ['tag', 'eq', tag], limit=1, single=True)
+            for tag in ('oldtag1', 'oldtag2')]
+        tag = self.tstore.merge_tags(tag1.id, tag2.id)
+        self.assertEqual(tag.id, tag2.id)
+        for data in self.tstore.query_data():
+            self.assertEqual(data.tags, ['oldtag2'])
+
     def test_swap_tags(self):
         data = self.tstore.create('uri0', 'fname', ['oldtag1'])
         data = self.tstore.create('uri1', 'fname', ['oldtag2', 'oldtag1'])